@@ -19,6 +19,8 @@ import sys
 from os.path import join
 import glob
 import time
+import itertools
+import logging
 import argparse
 import subprocess
 import atexit
@@ -29,7 +31,7 @@ import nibabel as nib
 import numpy as np
 import zmq
 
-from src.pynealLogger import createLogger
+from src.pynealLogger import createLogger, switchLogFile
 from src.scanReceiver import ScanReceiver
 from src.pynealPreprocessing import Preprocessor
 from src.pynealAnalysis import Analyzer
@@ -136,46 +138,147 @@ def launchPyneal(headless=False, customSettingsFile=None):
         # s = '127.0.0.1:{}'.format(settings['dashboardClientPort'])
         # print(s)
         # web.open('127.0.0.1:{}'.format(settings['dashboardClientPort']))
+    else:
+        dashboardSocket = None
+
+    ### Process series -------------------------------------
+    # In session mode, keep all of the components running, and process one
+    # series after another, each with its own output dir, until interrupted
+    try:
+        while True:
+            runSeries(settings, scanReceiver, preprocessor, analyzer,
+                      resultsServer, dashboardSocket)
+
+            if not settings.get('sessionMode', False):
+                break
+
+            # get everything ready for the next series
+            outputDir = createOutputDir(settings['outputPath'])
+            settings['seriesOutputDir'] = outputDir
+            logFname = join(outputDir, 'pynealLog.log')
+            switchLogFile(logFname)
+            print('Logs written to: {}'.format(logFname))
+
+            scanReceiver.resetSeries(outputDir)
+            resultsServer.resetSeries(outputDir)
+            preprocessor.resetSeries()
+            analyzer.resetSeries()
+            logger.info('Ready for next series')
+    except KeyboardInterrupt:
+        # save whatever has arrived of the series in progress (if any)
+        logger.info('Interrupted')
+        if scanReceiver.scan_started.is_set():
+            saveSeries(scanReceiver, preprocessor, analyzer, resultsServer)
+    finally:
+        ### Figure out how to clean everything up nicely at the end
+        resultsServer.killServer()
+        scanReceiver.killServer()
+        analyzer.stop()
+
+
+def runSeries(settings, scanReceiver, preprocessor, analyzer, resultsServer,
+              dashboardSocket=None):
+    """ Process a single series, from the first volume to saving the results
+
+    Parameters:
+    -----------
+    settings : dict
+        dictionary of all of the Pyneal settings for the current session,
+        including the 'seriesOutputDir' for this series
+    scanReceiver : ScanReceiver
+        running scan receiver thread, ready for this series
+    preprocessor : Preprocessor
+        preprocessor, reset for this series
+    analyzer : Analyzer
+        analyzer, reset for this series
+    resultsServer : ResultsServer
+        running results server thread, reset for this series
+    dashboardSocket : zmq socket object, optional
+        socket to communicate with the dashboard, if it was launched
+
+    """
+    logger = logging.getLogger('PynealLog')
 
+    if dashboardSocket is not None:
         # send configuration settings to dashboard
         configDict = {'mask': os.path.split(settings['maskFile'])[1],
                       'analysisChoice': (settings['analysisChoice'] if settings['analysisChoice'] in ['Average', 'Median'] else 'Custom'),
                       'volDims': str(nib.load(settings['maskFile']).shape),
                       'numTimepts': settings['numTimepts'],
-                      'outputPath': outputDir}
+                      'outputPath': settings['seriesOutputDir']}
         sendToDashboard(dashboardSocket,
                         topic='configSettings',
                         content=configDict)
 
     ### Wait For Scan To Start -----------------------------
-    while not scanReceiver.scanStarted:
-        time.sleep(.5)
+    scanReceiver.scan_started.wait()
     logger.debug('Scan started')
 
     ### Set up remaining configuration settings after first volume arrives
-    while not scanReceiver.completedVols[0]:
-        time.sleep(.1)
+    scanReceiver.wait_for_vol(0)
     preprocessor.set_affine(scanReceiver.get_affine())
 
-    ### Process scan  -------------------------------------
-    # Loop over all expected volumes
-    for volIdx in range(settings['numTimepts']):
+    # When slices are streamed from the scanner, a volume can be analyzed as
+    # soon as the slices covered by the mask have arrived. Some preprocessing
+    # stages (e.g. motion estimation) need the full volume, so in that case
+    # wait for every slice
+    maskSlices = None
+    if settings.get('waitForMaskSlices', False) and not preprocessor.needsFullVolume:
+        mask = nib.load(settings['maskFile']).get_data() > 0
+        maskSlices = scanReceiver.get_maskSlices(mask)
+        logger.debug('Waiting for mask slices only: {}'.format(maskSlices))
 
-        ### make sure this volume has arrived before continuing
-        while not scanReceiver.completedVols[volIdx]:
-            time.sleep(.1)
+    ### Process scan  -------------------------------------
+    # Loop over all expected volumes. If the number of volumes is not known
+    # (ring buffer mode), keep going until no new volume has arrived for
+    # 'scanEndTimeout' seconds
+    if settings['numTimepts']:
+        volIdxs = range(settings['numTimepts'])
+        volTimeout = None
+    else:
+        volIdxs = itertools.count()
+        volTimeout = settings.get('scanEndTimeout', 30)
+
+    # In ring buffer mode, a volume's slot is reused K volumes later, while
+    # this loop may still be working on it. Work on copies instead
+    copyVols = bool(settings.get('ringBufferSize'))
+    for volIdx in volIdxs:
+
+        ### make sure this volume (or the part of it we need) has arrived
+        # before continuing
+        if maskSlices is None:
+            volArrived = scanReceiver.wait_for_vol(volIdx, timeout=volTimeout)
+        else:
+            volArrived = scanReceiver.wait_for_slices(volIdx, maskSlices,
+                                                      timeout=volTimeout)
+        if not volArrived:
+            logger.info('No new volumes after {}s, ending scan at {} volumes'.format(
+                volTimeout, volIdx))
+            break
 
         ### start timer
         startTime = time.time()
 
-        ### Retrieve the raw volume
-        rawVol = scanReceiver.get_vol(volIdx)
+        ### Retrieve the raw volume. In ring buffer mode, it may already have
+        # been overwritten if processing has fallen far enough behind
+        rawVol = scanReceiver.get_vol(volIdx, allowPartial=maskSlices is not None,
+                                      copy=copyVols)
+        if rawVol is None:
+            logger.warning('volIdx {} was overwritten in the ring buffer before it could be processed; skipping it'.format(
+                volIdx))
+            continue
 
         ### Preprocess the raw volume
         preprocVol = preprocessor.runPreprocessing(rawVol, volIdx)
 
-        ### Analyze this volume
-        result = analyzer.runAnalysis(preprocVol, volIdx)
+        ### Analyze this volume. Use the preprocessed mask voxels if there
+        # are any (e.g. motion corrected). Otherwise, if preprocessing doesn't
+        # alter the voxel data, the mask voxels stored by the scan receiver
+        # (if any) still apply
+        maskedVol = preprocessor.get_maskedVol(volIdx)
+        if maskedVol is None and not preprocessor.altersVoxels:
+            maskedVol = scanReceiver.get_maskedVol(volIdx, copy=copyVols)
+        result = analyzer.runAnalysis(preprocVol, volIdx, maskedVol=maskedVol)
 
         # send result to the resultsServer
         resultsServer.updateResults(volIdx, result)
@@ -184,23 +287,33 @@ def launchPyneal(headless=False, customSettingsFile=None):
         elapsedTime = time.time() - startTime
 
         # update dashboard (if dashboard is launched)
-        if settings['launchDashboard']:
+        if dashboardSocket is not None:
             # completed volIdx
             sendToDashboard(dashboardSocket, topic='volIdx', content=volIdx)
 
             # timePerVol
+            # (analyses that timed out have no time)
+            stageTimes = preprocessor.get_stageTimes(volIdx)
+            analysisTimes = analyzer.get_analysisTimes(volIdx)
             timingParams = {'volIdx': volIdx,
-                            'processingTime': np.round(elapsedTime, decimals=3)}
+                            'processingTime': np.round(elapsedTime, decimals=3),
+                            'preprocessingTimes': {name: np.round(t, decimals=4)
+                                                   for name, t in stageTimes.items()},
+                            'analysisTimes': {name: None if np.isnan(t) else np.round(t, decimals=4)
+                                              for name, t in analysisTimes.items()}}
             sendToDashboard(dashboardSocket, topic='timePerVol',
                             content=timingParams)
 
     ### Save output files
+    saveSeries(scanReceiver, preprocessor, analyzer, resultsServer)
+
+
+def saveSeries(scanReceiver, preprocessor, analyzer, resultsServer):
+    """ Save the output files of every component for the current series """
     resultsServer.saveResults()
     scanReceiver.saveResults()
-
-    ### Figure out how to clean everything up nicely at the end
-    resultsServer.killServer()
-    scanReceiver.killServer()
+    preprocessor.saveResults()
+    analyzer.saveResults()
 
 
 def sendToDashboard(dashboardSocket, topic=None, content=None):
@@ -23,6 +23,7 @@ from __future__ import division
 import os
 import time
 import json
+import struct
 import argparse
 
 import zmq
@@ -68,9 +69,21 @@ def launchPynealReceiver(port, nVols, saveImage=True):
     firstVolHasArrived = False
     print('Waiting for first volume data to appear...')
 
+    seriesInfo = None
     while True:
-        # receive header info as json
-        volInfo = sock.recv_json(flags=0)
+        # receive header info. With protocol version 1 this is a json header
+        # for each volume. With version 2, a json series header is sent once,
+        # and each volume gets a binary header: (magic, volIdx, flags, timestamp)
+        header = sock.recv(flags=0)
+        if header[:1] == b'{':
+            volInfo = json.loads(header.decode())
+            if 'protocolVersion' in volInfo:
+                seriesInfo = volInfo
+                sock.send_string('received seriesHeader')
+                continue
+        else:
+            volInfo = dict(seriesInfo)
+            volInfo['volIdx'] = struct.unpack('<4sIId', header)[1]
 
         # retrieve relevant values about this slice
         volIdx = volInfo['volIdx']
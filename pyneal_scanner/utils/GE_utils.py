@@ -14,7 +14,8 @@ from queue import Queue
 import numpy as np
 import pydicom
 import nibabel as nib
-import zmq
+
+from .general_utils import PynealSender, PROTOCOL_VERSION
 
 # default path to where new series directories
 # will appear (e.g. [baseDir]/p###/e###/s###)
@@ -786,8 +787,15 @@ class GE_processSlice(Thread):
     containing metadata on that volume, will be sent out over the socket
     connection to Pyneal
 
+    Alternatively, in slice streaming mode, each slice is reformatted and sent
+    to Pyneal as soon as it is available, without waiting for the rest of the
+    volume. That lets Pyneal start on analyses that only need a few slices
+    (e.g. a small ROI) before the volume is complete.
+
     """
-    def __init__(self, dicomQ, pynealSocket, interval=.2):
+    def __init__(self, dicomQ, pynealSocket, interval=.2,
+                 protocolVersion=PROTOCOL_VERSION, sendWindow=1,
+                 streamSlices=False, compression=None):
         """ Initialize the class
 
         Parameters
@@ -803,6 +811,18 @@ class GE_processSlice(Thread):
         interval : float, optional
             time, in seconds, to wait before repolling the queue to see if
             there are any new file names to process
+        protocolVersion : int, optional
+            version of the Pyneal transfer protocol to use when sending data.
+            See also: general_utils.PynealSender()
+        sendWindow : int, optional
+            number of volumes that can be sent to Pyneal before waiting for
+            confirmation. Default of 1 waits for every volume
+        streamSlices : bool, optional
+            if True, send each slice to Pyneal as soon as it is available
+            instead of sending whole volumes. Requires protocol version 2
+        compression : string, optional
+            codec to use to compress the voxel data, if Pyneal accepts it
+            (e.g. 'zlib', or 'zlib-delta'). Default of None sends raw data
 
         """
         # start the thread upon creation
@@ -816,9 +836,17 @@ class GE_processSlice(Thread):
         self.interval = interval
         self.alive = True
         self.pynealSocket = pynealSocket
+        self.pynealSender = PynealSender(pynealSocket, protocolVersion,
+                                         window=sendWindow,
+                                         compression=compression)
         self.totalProcessed = 0             # counter for total number of slices processed
         self.volCounter = 0
 
+        self.streamSlices = streamSlices
+        if self.streamSlices and protocolVersion < 2:
+            self.logger.warning('slice streaming requires protocol version 2; sending whole volumes')
+            self.streamSlices = False
+
         # parameters we'll build once dicom data starts arriving
         self.firstSliceHasArrived = False
         self.nSlicesPerVol = None
@@ -833,6 +861,11 @@ class GE_processSlice(Thread):
         self.firstSlice_IPP = None   # first slice ImagePositionPatient tag
         self.lastSlice_IPP = None    # last slice ImagePositionPatient tag
 
+        # slice streaming parameters, built once the affine is available
+        self.sentSlices = None       # store which slices have been sent
+        self.rasOrnt = None          # orientation transform to RAS+
+        self.rasSliceHeader = None   # series metadata for the RAS+ volume
+
     def run(self):
         self.logger.debug('GE_processSlice thread started')
 
@@ -933,13 +966,19 @@ class GE_processSlice(Thread):
         # update this slice location in completedSlices
         self.completedSlices[sliceIdx, volIdx] = True
 
+        ### In streaming mode, send every slice that can be sent by now
+        if self.streamSlices:
+            self.processPendingSlices()
+
         ### Check if full volume is here, and process if so
         if self.completedSlices[:, self.volCounter].all():
-            self.processVolume(self.volCounter)
+            if not self.streamSlices:
+                self.processVolume(self.volCounter)
 
             # increment volCounter
             self.volCounter += 1
             if self.volCounter >= self.nVols:
+                self.pynealSender.flush()
                 self.stop()
 
     def processFirstSlice(self, dcm_fname):
@@ -977,6 +1016,8 @@ class GE_processSlice(Thread):
                                     self.nVols), dtype=np.uint16)
         self.completedSlices = np.zeros(shape=(self.nSlicesPerVol,
                                         self.nVols), dtype=bool)
+        self.sentSlices = np.zeros(shape=(self.nSlicesPerVol,
+                                   self.nVols), dtype=bool)
 
         self.logger.debug('Incoming 4D series dimensions: {}'.format(self.imageMatrix.shape))
 
@@ -1067,6 +1108,87 @@ class GE_processSlice(Thread):
         ### Send the voxel array and header to the pynealSocket
         self.sendVolToPynealSocket(volHeader, thisVol_RAS_data)
 
+    def buildSliceOrientation(self):
+        """ Work out where each slice lands once its volume is made RAS+
+
+        This mirrors what `nib.as_closest_canonical` does to a full volume
+        in `processVolume`: the voxel axes are permuted and flipped according
+        to the affine. The slice axis of the acquisition ends up as the
+        'sliceAxis' of the RAS+ volume, possibly in reversed order.
+
+        """
+        affine = np.asarray(self.affine)
+        self.rasOrnt = nib.orientations.io_orientation(affine)
+
+        # shape and affine of the RAS+ volume
+        acqShape = (int(self.sliceDims[0]), int(self.sliceDims[1]),
+                    int(self.nSlicesPerVol))
+        rasShape = [0, 0, 0]
+        for ax in range(3):
+            rasShape[int(self.rasOrnt[ax, 0])] = acqShape[ax]
+        rasAffine = affine.dot(nib.orientations.inv_ornt_aff(self.rasOrnt,
+                                                              acqShape))
+
+        self.rasSliceHeader = {
+            'TR': str(self.tr),
+            'dtype': str(self.imageMatrix.dtype),
+            'shape': tuple(rasShape),
+            'affine': json.dumps(rasAffine.tolist()),
+            'sliceAxis': int(self.rasOrnt[2, 0])}
+
+    def processPendingSlices(self):
+        """ Send every slice that has arrived but not yet been sent
+
+        Slices can only be reoriented once the affine has been built, so any
+        slices that arrive before that are held back, and sent (in volume
+        order) as soon as it is available.
+
+        """
+        if self.affine is None:
+            return
+        if self.rasOrnt is None:
+            self.buildSliceOrientation()
+
+        pending = self.completedSlices & ~self.sentSlices
+        for volIdx, sliceIdx in np.argwhere(pending.T):
+            self.processSlice(int(volIdx), int(sliceIdx))
+            self.sentSlices[sliceIdx, volIdx] = True
+
+    def processSlice(self, volIdx, sliceIdx):
+        """ Process a single slice from the series (slice streaming mode)
+
+        Reorient the slice the same way its volume would be reoriented to RAS+,
+        and send it out over the socket connection to Pyneal
+
+        Parameters
+        ----------
+        volIdx : int
+            index (0-based) of the volume the slice belongs to
+        sliceIdx : int
+            index (0-based) of the slice, in acquisition order
+
+        """
+        sliceAxis = self.rasSliceHeader['sliceAxis']
+
+        # reorient as a one-slice volume, then drop the slice axis
+        thisSlice = self.imageMatrix[:, :, sliceIdx:sliceIdx + 1, volIdx]
+        thisSlice_RAS = nib.orientations.apply_orientation(thisSlice, self.rasOrnt)
+        thisSlice_RAS_data = np.ascontiguousarray(np.squeeze(thisSlice_RAS,
+                                                             axis=sliceAxis))
+
+        # the position of the slice is reversed if the slice axis was flipped
+        if self.rasOrnt[2, 1] < 0:
+            rasSliceIdx = self.nSlicesPerVol - 1 - sliceIdx
+        else:
+            rasSliceIdx = sliceIdx
+
+        sliceHeader = dict(self.rasSliceHeader, volIdx=volIdx, sliceIdx=rasSliceIdx)
+
+        self.logger.debug('TO pynealSocket: vol {}, slice {}'.format(volIdx, rasSliceIdx))
+        pynealSocketResponse = self.pynealSender.sendSlice(sliceHeader,
+                                                           thisSlice_RAS_data)
+        self.logger.debug('FROM pynealSocket (latest confirmation): {}'.format(pynealSocketResponse))
+
     def sendVolToPynealSocket(self, volHeader, voxelArray):
         """ Send the volume data to Pyneal
 
@@ -1084,15 +1206,14 @@ class GE_processSlice(Thread):
         self.logger.debug('TO pynealSocket: vol {}'.format(volHeader['volIdx']))
 
         ### Send data out the socket, listen for response
-        self.pynealSocket.send_json(volHeader, zmq.SNDMORE)  # header as json
-        self.pynealSocket.send(voxelArray, flags=0, copy=False, track=False)
-        pynealSocketResponse = self.pynealSocket.recv_string()
+        pynealSocketResponse = self.pynealSender.sendVolume(volHeader, voxelArray)
 
         # log the success
-        self.logger.debug('FROM pynealSocket: {}'.format(pynealSocketResponse))
+        self.logger.debug('FROM pynealSocket (latest confirmation): {}'.format(pynealSocketResponse))
 
     def stop(self):
         """ set the `alive` flag to False, stopping the thread """
+        self.pynealSender.logCompressionStats()
         self.alive = False
 
 
@@ -1172,5 +1293,9 @@ def GE_launch_rtfMRI(scannerSettings, scannerDirs):
     # create an instance of the class that will grab slice dicoms
     # from the queue, reformat the data, and pass over the socket
     # to pyneal. Start the thread going
-    sliceProcessor = GE_processSlice(dicomQ, pynealSocket)
+    sliceProcessor = GE_processSlice(dicomQ, pynealSocket,
+                                     protocolVersion=scannerSettings.get_pynealProtocolVersion(),
+                                     sendWindow=scannerSettings.get_pynealSendWindow(),
+                                     compression=scannerSettings.get_pynealCompression(),
+                                     streamSlices=scannerSettings.get_pynealSliceStreaming())
     sliceProcessor.start()
@@ -18,7 +18,8 @@ from queue import Queue
 
 import numpy as np
 import nibabel as nib
-import zmq
+
+from .general_utils import PynealSender, PROTOCOL_VERSION
 
 
 class Philips_DirStructure():
@@ -511,7 +512,9 @@ class Philips_processVolume(Thread):
     RAS+, and then sending the volume and header out over the pynealSocket
 
     """
-    def __init__(self, parQ, pynealSocket, interval=.2):
+    def __init__(self, parQ, pynealSocket, interval=.2,
+                 protocolVersion=PROTOCOL_VERSION, sendWindow=1,
+                 compression=None):
         """ Initialize the class
 
         Parameters
@@ -527,6 +530,15 @@ class Philips_processVolume(Thread):
         interval : float, optional
             time, in seconds, to wait before repolling the queue to see if
             there are any new file names to process
+        protocolVersion : int, optional
+            version of the Pyneal transfer protocol to use when sending data.
+            See also: general_utils.PynealSender()
+        sendWindow : int, optional
+            number of volumes that can be sent to Pyneal before waiting for
+            confirmation. Default of 1 waits for every volume
+        compression : string, optional
+            codec to use to compress the voxel data, if Pyneal accepts it
+            (e.g. 'zlib', or 'zlib-delta'). Default of None sends raw data
 
         """
         # start the threat upon creation
@@ -540,6 +552,9 @@ class Philips_processVolume(Thread):
         self.interval = interval        # interval between polling queue for new files
         self.alive = True
         self.pynealSocket = pynealSocket
+        self.pynealSender = PynealSender(pynealSocket, protocolVersion,
+                                         window=sendWindow,
+                                         compression=compression)
         self.totalProcessed = 0         # counter for total number of slices processed
 
     def run(self):
@@ -642,12 +657,10 @@ class Philips_processVolume(Thread):
         self.logger.debug('TO pynealSocket: vol {}'.format(volHeader['volIdx']))
 
         ### Send data out the socket, listen for response
-        self.pynealSocket.send_json(volHeader, zmq.SNDMORE)  # header as json
-        self.pynealSocket.send(voxelArray, flags=0, copy=False, track=False)
-        pynealSocketResponse = self.pynealSocket.recv_string()
+        pynealSocketResponse = self.pynealSender.sendVolume(volHeader, voxelArray)
 
         # log the success
-        self.logger.debug('FROM pynealSocket: {}'.format(pynealSocketResponse))
+        self.logger.debug('FROM pynealSocket (latest confirmation): {}'.format(pynealSocketResponse))
 
         # check if that was the last volume, and if so, stop
         if 'STOP' in pynealSocketResponse:
@@ -655,6 +668,9 @@ class Philips_processVolume(Thread):
 
     def stop(self):
         """ set the `alive` flag to False, stopping the thread """
+        # wait for Pyneal to confirm any volumes still in the send window
+        self.pynealSender.flush()
+        self.pynealSender.logCompressionStats()
         self.alive = False
 
 
@@ -733,5 +749,8 @@ def Philips_launch_rtfMRI(scannerSettings, scannerDirs):
     # create an instance of the class that will grab par/rec files
     # from the queue, reformat the data, and pass over the socket
     # to pyneal. Start the thread going
-    volumeProcessor = Philips_processVolume(parQ, pynealSocket)
+    volumeProcessor = Philips_processVolume(parQ, pynealSocket,
+                                            protocolVersion=scannerSettings.get_pynealProtocolVersion(),
+                                            sendWindow=scannerSettings.get_pynealSendWindow(),
+                                            compression=scannerSettings.get_pynealCompression())
     volumeProcessor.start()
@@ -19,7 +19,8 @@ import numpy as np
 import pydicom
 import nibabel as nib
 from nibabel.nicom import dicomreaders
-import zmq
+
+from .general_utils import PynealSender, PROTOCOL_VERSION
 
 # regEx for Siemens style file naming
 Siemens_filePattern = re.compile('\d{3}_\d{6}_\d{6}.dcm')
@@ -557,7 +558,9 @@ class Siemens_processMosaic(Thread):
     pynealSocket
 
     """
-    def __init__(self, dicomQ, pynealSocket, interval=.2):
+    def __init__(self, dicomQ, pynealSocket, interval=.2,
+                 protocolVersion=PROTOCOL_VERSION, sendWindow=1,
+                 compression=None):
         """ Initialize the class
 
         Parameters
@@ -573,6 +576,15 @@ class Siemens_processMosaic(Thread):
         interval : float, optional
             time, in seconds, to wait before repolling the queue to see if
             there are any new file names to process
+        protocolVersion : int, optional
+            version of the Pyneal transfer protocol to use when sending data.
+            See also: general_utils.PynealSender()
+        sendWindow : int, optional
+            number of volumes that can be sent to Pyneal before waiting for
+            confirmation. Default of 1 waits for every volume
+        compression : string, optional
+            codec to use to compress the voxel data, if Pyneal accepts it
+            (e.g. 'zlib', or 'zlib-delta'). Default of None sends raw data
 
         """
         # start the threat upon creation
@@ -586,6 +598,9 @@ class Siemens_processMosaic(Thread):
         self.interval = interval        # interval between polling queue for new files
         self.alive = True
         self.pynealSocket = pynealSocket
+        self.pynealSender = PynealSender(pynealSocket, protocolVersion,
+                                         window=sendWindow,
+                                         compression=compression)
         self.totalProcessed = 0         # counter for total number of slices processed
 
     def run(self):
@@ -685,12 +700,10 @@ class Siemens_processMosaic(Thread):
         self.logger.debug('TO pynealSocket: vol {}'.format(volHeader['volIdx']))
 
         ### Send data out the socket, listen for response
-        self.pynealSocket.send_json(volHeader, zmq.SNDMORE)  # header as json
-        self.pynealSocket.send(voxelArray, flags=0, copy=False, track=False)
-        pynealSocketResponse = self.pynealSocket.recv_string()
+        pynealSocketResponse = self.pynealSender.sendVolume(volHeader, voxelArray)
 
         # log the success
-        self.logger.debug('FROM pynealSocket: {}'.format(pynealSocketResponse))
+        self.logger.debug('FROM pynealSocket (latest confirmation): {}'.format(pynealSocketResponse))
 
         # check if that was the last volume, and if so, stop
         if 'STOP' in pynealSocketResponse:
@@ -698,6 +711,9 @@ class Siemens_processMosaic(Thread):
 
     def stop(self):
         """ set the `alive` flag to False, stopping the thread """
+        # wait for Pyneal to confirm any volumes still in the send window
+        self.pynealSender.flush()
+        self.pynealSender.logCompressionStats()
         self.alive = False
 
 
@@ -759,5 +775,8 @@ def Siemens_launch_rtfMRI(scannerSettings, scannerDirs):
     # create an instance of the class that will grab mosaic dicoms
     # from the queue, reformat the data, and pass over the socket
     # to pyneal. Start the thread going
-    mosaicProcessor = Siemens_processMosaic(dicomQ, pynealSocket)
+    mosaicProcessor = Siemens_processMosaic(dicomQ, pynealSocket,
+                                            protocolVersion=scannerSettings.get_pynealProtocolVersion(),
+                                            sendWindow=scannerSettings.get_pynealSendWindow(),
+                                            compression=scannerSettings.get_pynealCompression())
     mosaicProcessor.start()
@@ -4,11 +4,41 @@ specific scanning environment
 """
 import os
 import sys
+import time
+import struct
+import zlib
+import logging
 from os.path import join
 
 import yaml
 import zmq
 
+# Pyneal transfer protocol. In version 1, every volume is sent with a JSON
+# header that repeats all of the series metadata. In version 2, the series
+# metadata (affine, TR, dtype, shape) is sent once as a JSON series header
+# before the first volume, and each volume is then preceded by a small,
+# fixed-size binary header: (magic, volIdx, flags, timestamp)
+PROTOCOL_VERSION = 2
+VOL_HEADER_FORMAT = '<4sIId'
+VOL_HEADER_MAGIC = b'PNV2'
+VOL_FLAG_TIMESTAMP = 1      # timestamp field holds the send time (epoch secs)
+
+# In slice streaming mode (version 2 only), individual slices are sent as soon
+# as they are available. Each slice is preceded by a binary slice header:
+# (magic, volIdx, flags, timestamp, sliceIdx). The slice index refers to the
+# position along the 'sliceAxis' of the RAS+ volume, given in the series header
+SLICE_HEADER_FORMAT = '<4sIIdI'
+SLICE_HEADER_MAGIC = b'PNS2'
+
+# Optional lossless compression of the voxel data (version 2 only). The codec is
+# proposed in the series header ('compression' key), and only used if Pyneal
+# accepts it in its reply. With 'zlib-delta', each volume (or slice) is sent as
+# the difference from the same voxels in the previous volume, computed on the
+# raw bit patterns (modulo 2**bits), before compressing.
+COMPRESSION_CODECS = ('zlib', 'zlib-delta')
+VOL_FLAG_ZLIB = 2           # payload is zlib compressed
+VOL_FLAG_DELTA = 4          # payload is the difference from the previous volume
+
 
 class ScannerSettings():
     """ Read the scanner config file to retrieve variables specific to this
@@ -170,6 +200,69 @@ class ScannerSettings():
         # return response
         return self.allSettings['pynealSocketPort']
 
+    def get_pynealProtocolVersion(self):
+        """ Return the protocol version to use when sending data to Pyneal.
+
+        This setting is optional. If it is not in the config file, the most
+        recent protocol version is used. Set it to 1 in order to send data to
+        older versions of Pyneal.
+
+        Returns
+        -------
+        int
+            version of the Pyneal transfer protocol
+
+        """
+        return int(self.allSettings.get('pynealProtocolVersion', PROTOCOL_VERSION))
+
+    def get_pynealSendWindow(self):
+        """ Return the number of volumes that can be in flight to Pyneal.
+
+        This setting is optional. With a window of 1 (the default), Pyneal
+        Scanner waits for Pyneal to confirm each volume before sending the
+        next. Larger windows allow several volumes to be sent before any of
+        them are confirmed.
+
+        Returns
+        -------
+        int
+            maximum number of unconfirmed volumes
+
+        """
+        return int(self.allSettings.get('pynealSendWindow', 1))
+
+    def get_pynealSliceStreaming(self):
+        """ Return whether slices should be streamed to Pyneal individually.
+
+        This setting is optional, and only applies to scanning environments
+        that write one file per slice (GE). If True, each slice is sent to
+        Pyneal as soon as it is available, instead of waiting for the full
+        volume. Requires protocol version 2.
+
+        Returns
+        -------
+        bool
+            True if slices are streamed individually
+
+        """
+        return bool(self.allSettings.get('pynealSliceStreaming', False))
+
+    def get_pynealCompression(self):
+        """ Return the codec to use to compress voxel data sent to Pyneal.
+
+        This setting is optional. Options are 'zlib', which compresses each
+        volume, or 'zlib-delta', which compresses the difference from the
+        previous volume. If it is not in the config file, data is sent
+        uncompressed. Requires protocol version 2.
+
+        Returns
+        -------
+        string or None
+            name of the compression codec, or None for no compression
+
+        """
+        return self.allSettings.get('pynealCompression', None)
+
     def get_allSettings(self):
         """ Return the allSettings dictionary
 
@@ -308,3 +401,346 @@ def create_pynealSocket(host, port):
     socket.connect('tcp://{}:{}'.format(host, port))
 
     return socket
+
+
+def packVolHeader(volIdx, flags=VOL_FLAG_TIMESTAMP, timestamp=None):
+    """ Pack the fixed-size binary header that precedes each volume
+
+    Parameters
+    ----------
+    volIdx : int
+        index (0-based) of the volume
+    flags : int, optional
+        bit field describing the volume message
+    timestamp : float, optional
+        time the volume was sent (seconds since the epoch). If None, and the
+        VOL_FLAG_TIMESTAMP flag is set, the current time is used
+
+    Returns
+    -------
+    bytes
+        binary volume header
+
+    """
+    if timestamp is None:
+        timestamp = time.time() if flags & VOL_FLAG_TIMESTAMP else 0.0
+    return struct.pack(VOL_HEADER_FORMAT, VOL_HEADER_MAGIC, volIdx, flags, timestamp)
+
+
+def packSliceHeader(volIdx, sliceIdx, flags=VOL_FLAG_TIMESTAMP, timestamp=None):
+    """ Pack the fixed-size binary header that precedes each streamed slice
+
+    Parameters
+    ----------
+    volIdx : int
+        index (0-based) of the volume the slice belongs to
+    sliceIdx : int
+        index (0-based) of the slice along the slice axis of the RAS+ volume
+    flags : int, optional
+        bit field describing the slice message
+    timestamp : float, optional
+        time the slice was sent (seconds since the epoch). If None, and the
+        VOL_FLAG_TIMESTAMP flag is set, the current time is used
+
+    Returns
+    -------
+    bytes
+        binary slice header
+
+    """
+    if timestamp is None:
+        timestamp = time.time() if flags & VOL_FLAG_TIMESTAMP else 0.0
+    return struct.pack(SLICE_HEADER_FORMAT, SLICE_HEADER_MAGIC, volIdx, flags,
+                       timestamp, sliceIdx)
+
+
+class PynealSender():
+    """ Send volume data to Pyneal over the pynealSocket
+
+    Takes care of formatting each volume according to the Pyneal transfer
+    protocol version in use. For version 2, the series metadata is pulled
+    from the header of the first volume and sent once, before that volume.
+
+    Pyneal replies to every volume with a confirmation message. Flow control
+    is credit-based: up to `window` volumes can be sent before their
+    confirmations arrive. Confirmations are collected as they come in, and
+    sending only blocks once the window is full. With a window of 1, every
+    volume waits for its confirmation (lockstep).
+
+    The voxel data can optionally be compressed (see COMPRESSION_CODECS). The
+    codec is negotiated in the series header, and data is sent uncompressed if
+    Pyneal does not accept it.
+
+    """
+    def __init__(self, pynealSocket, protocolVersion=PROTOCOL_VERSION, window=1,
+                 compression=None, compressionLevel=1):
+        """ Initialize the class
+
+        Parameters
+        ----------
+        pynealSocket : object
+            instance of ZMQ style socket that will be used to communicate with
+            Pyneal. See also: create_pynealSocket()
+        protocolVersion : int, optional
+            version of the Pyneal transfer protocol to use (1 or 2)
+        window : int, optional
+            maximum number of volumes that can be sent without having been
+            confirmed by Pyneal (default: 1, lockstep)
+        compression : string, optional
+            codec to propose for compressing voxel data, one of
+            COMPRESSION_CODECS. None (default) sends raw voxel data
+        compressionLevel : int, optional
+            zlib compression level (1-9). Lower levels are faster
+
+        """
+        self.logger = logging.getLogger(__name__)
+
+        self.pynealSocket = pynealSocket
+        self.protocolVersion = protocolVersion
+        self.seriesHeaderSent = False
+        self.window = max(1, int(window))
+        self.inFlight = 0           # volumes sent, but not yet confirmed
+        self.lastResponse = ''      # most recent response from Pyneal
+
+        if compression is not None:
+            if compression not in COMPRESSION_CODECS:
+                raise ValueError('Unrecognized compression codec: {}'.format(compression))
+            if protocolVersion < 2:
+                self.logger.warning('compression requires protocol version 2; sending raw data')
+                compression = None
+        self.compression = compression
+        self.compressionLevel = compressionLevel
+        self.prevPayloads = {}      # last raw data sent, for delta encoding
+        self.compressionStats = {'nMessages': 0, 'rawBytes': 0,
+                                 'sentBytes': 0, 'encodeTime': 0.0}
+
+    def sendSeriesHeader(self, volHeader):
+        """ Send the metadata that is constant across the series
+
+        Parameters
+        ----------
+        volHeader : dict
+            header of the first volume, with entries for 'TR', 'dtype',
+            'shape', and 'affine'. For slice streaming, it also needs a
+            'sliceAxis' entry
+
+        Returns
+        -------
+        string
+            response from Pyneal
+
+        """
+        # make sure Pyneal has confirmed everything from the previous series
+        self.flush()
+
+        seriesHeader = {'protocolVersion': self.protocolVersion,
+                        'TR': volHeader['TR'],
+                        'dtype': volHeader['dtype'],
+                        'shape': volHeader['shape'],
+                        'affine': volHeader['affine']}
+        if 'sliceAxis' in volHeader:
+            seriesHeader['sliceAxis'] = volHeader['sliceAxis']
+        if self.compression is not None:
+            seriesHeader['compression'] = self.compression
+        self.pynealSocket.send_json(seriesHeader)
+        self.seriesHeaderSent = True
+        response = self.pynealSocket.recv_string()
+
+        # Pyneal names the codec in its reply if it accepts it
+        if self.compression is not None:
+            if response == 'received seriesHeader compression={}'.format(self.compression):
+                self.logger.info('Pyneal accepted {} compression'.format(self.compression))
+            else:
+                self.logger.warning('Pyneal declined {} compression; sending raw data'.format(
+                    self.compression))
+                self.compression = None
+        self.prevPayloads = {}
+        return response
+
+    def sendVolume(self, volHeader, voxelArray):
+        """ Send a volume to Pyneal
+
+        Blocks until there is room in the send window. With the default
+        window of 1, that means waiting for Pyneal to confirm this volume.
+
+        Parameters
+        ----------
+        volHeader : dict
+            key:value pairs for all of the relevant metadata for this volume
+        voxelArray : numpy array
+            3D numpy array of voxel data from the volume, reoriented to RAS+
+
+        Returns
+        -------
+        string
+            most recent response from Pyneal (empty string if no volumes have
+            been confirmed yet)
+
+        """
+        if self.protocolVersion == 1:
+            self.pynealSocket.send_json(volHeader, zmq.SNDMORE)  # header as json
+        else:
+            if not self.seriesHeaderSent:
+                self.sendSeriesHeader(volHeader)
+            flags, voxelArray = self.encodePayload(None, volHeader['volIdx'],
+                                                   voxelArray)
+            self.pynealSocket.send(packVolHeader(volHeader['volIdx'], flags),
+                                   zmq.SNDMORE)
+        self.pynealSocket.send(voxelArray, flags=0, copy=False, track=False)
+        self.inFlight += 1
+
+        self.collectResponses()
+        return self.lastResponse
+
+    def sendSlice(self, sliceHeader, sliceArray):
+        """ Send a single slice to Pyneal (protocol version 2 only)
+
+        Slices count against the send window in the same way volumes do, and
+        Pyneal confirms each one.
+
+        Parameters
+        ----------
+        sliceHeader : dict
+            key:value pairs for 'volIdx', 'sliceIdx', and the series metadata
+            ('TR', 'dtype', 'shape', 'affine', 'sliceAxis'), where 'shape' is
+            the shape of the full RAS+ volume
+        sliceArray : numpy array
+            2D numpy array of voxel data from the slice, oriented to RAS+ (i.e.
+            the RAS+ volume with the slice axis removed)
+
+        Returns
+        -------
+        string
+            most recent response from Pyneal
+
+        """
+        if self.protocolVersion < 2:
+            raise ValueError('slice streaming requires protocol version 2')
+        if not self.seriesHeaderSent:
+            self.sendSeriesHeader(sliceHeader)
+        flags, sliceArray = self.encodePayload(sliceHeader['sliceIdx'],
+                                               sliceHeader['volIdx'], sliceArray)
+        self.pynealSocket.send(packSliceHeader(sliceHeader['volIdx'],
+                                               sliceHeader['sliceIdx'], flags),
+                               zmq.SNDMORE)
+        self.pynealSocket.send(sliceArray, flags=0, copy=False, track=False)
+        self.inFlight += 1
+
+        self.collectResponses()
+        return self.lastResponse
+
+    def encodePayload(self, key, volIdx, voxelArray):
+        """ Compress the voxel data, if compression is in use
+
+        For delta encoding, the data is differenced against the data sent with
+        the same `key` for the previous volume. If that was not the last thing
+        sent for this key (e.g. a volume was skipped), the data is compressed
+        without delta encoding.
+
+        Parameters
+        ----------
+        key : int or None
+            None for full volumes, or the sliceIdx for slices
+        volIdx : int
+            index (0-based) of the volume
+        voxelArray : numpy array
+            contiguous array of voxel data
+
+        Returns
+        -------
+        flags : int
+            flags for the binary header, describing the encoding
+        payload : numpy array or bytes
+            the data to send
+
+        """
+        flags = VOL_FLAG_TIMESTAMP
+        if self.compression is None:
+            return flags, voxelArray
+
+        startTime = time.time()
+
+        # work on the raw bit patterns, so the delta is lossless for any dtype
+        rawArray = voxelArray.view('u{}'.format(voxelArray.dtype.itemsize))
+        prevVolIdx, prevArray = self.prevPayloads.get(key, (None, None))
+        if self.compression == 'zlib-delta':
+            self.prevPayloads[key] = (volIdx, rawArray.copy())
+            if prevVolIdx == volIdx - 1:
+                rawArray = rawArray - prevArray
+                flags |= VOL_FLAG_DELTA
+        payload = zlib.compress(rawArray, self.compressionLevel)
+        flags |= VOL_FLAG_ZLIB
+
+        encodeTime = time.time() - startTime
+        self.compressionStats['nMessages'] += 1
+        self.compressionStats['rawBytes'] += voxelArray.nbytes
+        self.compressionStats['sentBytes'] += len(payload)
+        self.compressionStats['encodeTime'] += encodeTime
+        self.logger.debug('vol {} compressed {} -> {} bytes in {:.4f}s'.format(
+            volIdx, voxelArray.nbytes, len(payload), encodeTime))
+        return flags, payload
+
+    def get_compressionStats(self):
+        """ Return a summary of the compression achieved so far
+
+        Returns
+        -------
+        dict
+            'codec', 'nMessages', 'rawBytes', 'sentBytes', 'ratio' (raw/sent),
+            and 'encodeTime' (total seconds spent compressing)
+
+        """
+        stats = dict(self.compressionStats, codec=self.compression)
+        if stats['sentBytes'] > 0:
+            stats['ratio'] = stats['rawBytes'] / stats['sentBytes']
+        else:
+            stats['ratio'] = None
+        return stats
+
+    def logCompressionStats(self):
+        """ Write a summary of the compression achieved to the log """
+        stats = self.get_compressionStats()
+        if stats['nMessages'] > 0:
+            self.logger.info('{} compression: {} messages, {} -> {} bytes (ratio {:.2f}), {:.3f}s encoding'.format(
+                stats['codec'], stats['nMessages'], stats['rawBytes'],
+                stats['sentBytes'], stats['ratio'], stats['encodeTime']))
+
+    def collectResponses(self):
+        """ Collect confirmations from Pyneal, freeing up the send window
+
+        Reads every confirmation that has already arrived, and blocks only
+        while the send window is full.
+
+        """
+        while self.inFlight > 0:
+            if self.inFlight >= self.window:
+                response = self.pynealSocket.recv_string()
+            else:
+                try:
+                    response = self.pynealSocket.recv_string(flags=zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+            self.inFlight -= 1
+            self.checkResponse(response)
+
+    def flush(self):
+        """ Wait until Pyneal has confirmed every volume sent so far
+
+        Returns
+        -------
+        string
+            most recent response from Pyneal
+
+        """
+        while self.inFlight > 0:
+            self.checkResponse(self.pynealSocket.recv_string())
+            self.inFlight -= 1
+        return self.lastResponse
+
+    def checkResponse(self, response):
+        """ Store a confirmation from Pyneal, logging it if Pyneal reports an
+        error with the message it confirms
+        """
+        if response.startswith('error'):
+            self.logger.error('Pyneal could not handle a message: {}'.format(response))
+        self.lastResponse = response
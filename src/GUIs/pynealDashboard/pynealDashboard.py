@@ -127,6 +127,12 @@ class DashboardIPCServer(Thread):
 
         """
         if msg['topic'] == 'configSettings':
+            # config settings mark the start of a new series, so clear out
+            # the data from any previous series
+            existingData['currentVolIdx'] = 0
+            existingData['motion'] = []
+            existingData['timePerVol'] = []
+
             # update existing data
             existingData['mask'] = msg['content']['mask']
             existingData['analysisChoice'] = msg['content']['analysisChoice']
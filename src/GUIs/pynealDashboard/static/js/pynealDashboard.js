@@ -70,8 +70,9 @@ socket.on('motion', function(msg) {
 
 // handle incoming messages about current timing params
 socket.on('timePerVol', function(msg) {
-    // 'msg' will be JSON object with vals for volIdx, and any other motion
-    // parameters you want. Add it to the 'motion' array, then update plot
+    // 'msg' will be JSON object with vals for volIdx, the total processingTime,
+    // and the time each preprocessing stage took (preprocessingTimes). Add it
+    // to the 'timePerVol' array, then update plot
     timePerVol.push(msg);
     //drawMotionPlot();
     updateTimingPlot();
@@ -388,6 +389,28 @@ function updateMotionPlot(){
 var timingScale_x, timingAxis_x;
 var timingScale_y, timingAxis_y;
 var timingPlotWidth, timingPlotHeight;
+var stageColors = d3.scaleOrdinal(d3.schemeCategory10);
+
+function getStageNames() {
+    // names of the preprocessing stages timed so far, in pipeline order
+    var stageNames = [];
+    timePerVol.forEach(function(d){
+        for (var name in (d.preprocessingTimes || {})) {
+            if (stageNames.indexOf(name) == -1) {
+                stageNames.push(name);
+            }
+        }
+    });
+    return stageNames;
+}
+
+function stageTime_line(name) {
+    // line for the time a single preprocessing stage took on each vol
+    return d3.line()
+            .defined(function(d){ return d.preprocessingTimes && d.preprocessingTimes[name] != null})
+            .x(function(d){ return timingScale_x(d.volIdx+1)})
+            .y(function(d){ return timingScale_y(d.preprocessingTimes[name])});
+}
 
 function drawTimingPlot() {
     var timingPlotDiv = d3.select('#timingPlotDiv');
@@ -443,6 +466,14 @@ function drawTimingPlot() {
         .attr('id', 'volTime_line')
         .attr('d', volTime_line);
 
+    // groups for the preprocessing stage lines and their legend, filled in
+    // by updateStageTimes as stage timings arrive
+    timingPlotSVG.append('g')
+        .attr('id', 'stageTimeLines');
+    timingPlotSVG.append('g')
+        .attr('id', 'stageTimeLegend')
+        .attr('transform', 'translate(' + timingPlotWidth*.7 + ',10)');
+
     // call the axes to draw it to the div
     timingPlotSVG.append('g')
         .attr("id", "timingPlot_xAxis")
@@ -537,6 +568,40 @@ function drawTimingPlot() {
                 .attr("x", timingScale_x(xInPlot))
                 .attr("y", timingScale_y(thisTime))
         })
+
+    updateStageTimes();
+}
+
+function updateStageTimes(){
+    // draw a line for each preprocessing stage, adding any new stages
+    var stageNames = getStageNames();
+    var stageLines = d3.select('#stageTimeLines')
+        .selectAll('.stageTime_line')
+        .data(stageNames);
+    stageLines.enter()
+        .append('path')
+        .attr('class', 'stageTime_line')
+        .style('stroke', function(name){ return stageColors(name)})
+        .merge(stageLines)
+        .attr('d', function(name){ return stageTime_line(name)(timePerVol)});
+
+    // legend, with the total time per vol first
+    var legendKeys = d3.select('#stageTimeLegend')
+        .selectAll('.legendKey')
+        .data(['total'].concat(stageNames));
+    var newKeys = legendKeys.enter()
+        .append('g')
+        .attr('class', 'legendKey')
+        .attr('transform', function(d, i){ return 'translate(0,' + i*16 + ')'});
+    newKeys.append('rect')
+        .attrs({'x':0, 'y':0, 'width':12, 'height':12})
+        .style('fill', function(d){
+            return (d == 'total') ? '#A44754' : stageColors(d);
+        });
+    newKeys.append('text')
+        .attrs({'x': 20, 'y':12})
+        .text(function(d) {return d})
+        .style('font-size', 12);
 }
 
 function updateTimingPlot(){
@@ -563,6 +628,7 @@ function updateTimingPlot(){
     d3.select('#volTime_line')
         .datum(timePerVol)
         .attr('d', volTime_line);
+    updateStageTimes();
 }
 
 
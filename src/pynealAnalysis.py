@@ -3,15 +3,62 @@
 These tools will set up and apply the specified analysis steps to incoming
 volume data during a real-time scan
 
+The mask is compiled once into a MaskPlan: the flat indices of the voxels
+within the mask, and their weights, normalized to sum to one. The built-in
+analyses then gather the mask voxels of each volume with a single `np.take`.
+With the 'maskPlanCache' setting, the plan is saved next to the mask file,
+and loaded from there (instead of decoding the NIfTI mask) as long as the
+mask file hasn't changed.
+
+The 'Atlas' analysis computes the average of every labelled ROI in a label
+image ('atlasFile'), in one pass: the labelled voxels are gathered with one
+`np.take`, and summed per ROI with `np.bincount`, using weights normalized
+within each ROI.
+
+'analysisChoice' can also be a list of analyses, to run on every volume. Each
+entry is an analysisChoice, or a dict of settings for that analysis (e.g.
+{'name': 'control', 'analysisChoice': 'Average', 'maskFile': ...}), which
+override the main settings. The analyses run concurrently, each on its own
+thread (NumPy releases the GIL for most of the work), and their results are
+merged into one dict per volume. Each analysis's results are prefixed with
+its 'name', if it has one. An analysis that takes longer than its
+'analysisTimeout' (seconds) is left out of the results for that volume, and
+listed under 'timedOut'. It carries on with that volume (on its own copy of
+the data) in the background, and any volume that arrives while it is still
+busy is skipped for that analysis (also listed under 'timedOut'), so a slow
+analysis doesn't fall further behind with every volume. The time each analysis takes is logged, sent to the
+dashboard, and written to 'analysisTimes.tsv' in the series output directory.
+
+With the 'customAnalysisProcess' setting, a custom analysis runs in a
+dedicated worker process (see CustomAnalysisHost), so it doesn't compete for
+the GIL with the rest of Pyneal. Volumes are handed to it through a ring
+buffer in shared memory, rather than pickled. If the result for a volume
+doesn't come back within 'customAnalysisDeadline' seconds, the volume's
+result is reported as {'late': True}, and the scan moves on.
+
 """
 import os
+from os.path import join
 import sys
 import logging
+import multiprocessing
+import queue
 import importlib
+import inspect
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 
 import numpy as np
 import nibabel as nib
 
+from src.weightedStats import WeightedStats
+
+# analyses that are built in (any other analysisChoice is a custom script)
+BUILTIN_ANALYSES = ['Average', 'Median', 'Atlas']
+
+# seconds between checks that a custom analysis worker process is still alive
+WORKER_POLL_INTERVAL = 1
+
 
 class Analyzer:
     """ Analysis Class
@@ -39,41 +86,139 @@ class Analyzer:
 
         # create reference to settings dict
         self.settings = settings
+        self.analysisTimes = []
 
-        ### Format the mask. If the settings specify that the the mask should
-        # be weighted, create separate vars for the weights and mask. Convert
-        # mask to boolean array
-        mask_img = nib.load(settings['maskFile'])
-        if settings['maskIsWeighted'] is True:
-            self.weightMask = True
-            self.weights = mask_img.get_data().copy()
-            self.mask = mask_img.get_data() > 0
+        if isinstance(settings['analysisChoice'], list):
+            self.createConcurrentAnalyses()
         else:
-            self.weightMask = False
-            self.mask = mask_img.get_data() > 0
+            self.createAnalysis()
+
+    def createAnalysis(self):
+        """ Set up the analysis chosen by 'analysisChoice' """
+        settings = self.settings
+        self.analyzers = None
+        self.analysisNames = [analysisName(settings)]
+
+        ### Format the mask. If the settings specify that the the mask should
+        # be weighted, the mask values are used as weights
+        self.weightMask = settings['maskIsWeighted'] is True
+        self.maskPlan = loadMaskPlan(settings['maskFile'], self.weightMask,
+                                     useCache=settings.get('maskPlanCache', False),
+                                     logger=self.logger)
+        self.mask = self.maskPlan.mask
+
+        # weighted statistics engine, with the weights normalized once
+        self.weightedStats = WeightedStats(self.maskPlan.weights if self.weightMask else None)
 
         ### Set the appropriate analysis function based on the settings
         if settings['analysisChoice'] == 'Average':
             self.analysisFunc = self.averageFromMask
+            self.takesMaskedVol = True
         elif settings['analysisChoice'] == 'Median':
             self.analysisFunc = self.medianFromMask
+            self.takesMaskedVol = True
+        elif settings['analysisChoice'] == 'Atlas':
+            self.atlasPlan = loadAtlasPlan(settings['atlasFile'],
+                                           settings.get('atlasWeightsFile'),
+                                           useCache=settings.get('maskPlanCache', False),
+                                           logger=self.logger)
+            self.logger.debug('Atlas ROI labels: {}'.format(self.atlasPlan.labels.tolist()))
+            self.analysisFunc = self.averageFromAtlas
+            self.takesMaskedVol = False
+        elif settings.get('customAnalysisProcess', False):
+            # custom analysis script, run in a worker process
+            self.customAnalysisHost = CustomAnalysisHost(settings['analysisChoice'],
+                                                         settings['maskFile'],
+                                                         settings['maskIsWeighted'],
+                                                         settings['numTimepts'],
+                                                         deadline=settings.get('customAnalysisDeadline'),
+                                                         logger=self.logger)
+            self.analysisFunc = self.customAnalysisHost.compute
+            self.takesMaskedVol = False
         else:
             # must be a custom analysis script
             # get the path to the custom analysis file and import it
             customAnalysisDir, customAnalysisName = os.path.split(settings['analysisChoice'])
             sys.path.append(customAnalysisDir)
-            customAnalysisModule = importlib.import_module(customAnalysisName.split('.')[0])
+            self.customAnalysisModule = importlib.import_module(customAnalysisName.split('.')[0])
+            self.createCustomAnalysis()
 
-            # create instance of customAnalysis class, pass in mask reference
-            customAnalysis = customAnalysisModule.CustomAnalysis(settings['maskFile'],
-                                                                 settings['maskIsWeighted'],
-                                                                 settings['numTimepts'])
+    def createConcurrentAnalyses(self):
+        """ Set up each analysis in the 'analysisChoice' list
+
+        Each analysis gets its own Analyzer, with the main settings updated by
+        the settings for that analysis, and its own single-thread executor, so
+        the analyses run concurrently with each other, but a (stateful) custom
+        analysis never runs concurrently with itself.
+
+        """
+        self.analyzers = []
+        self.analysisNames = []
+        self.resultPrefixes = []
+        for entry in self.settings['analysisChoice']:
+            if not isinstance(entry, dict):
+                entry = {'analysisChoice': entry}
+            analysisSettings = dict(self.settings)
+            analysisSettings.update(entry)
+            self.analyzers.append(Analyzer(analysisSettings))
 
-            # define the analysis func for the custom analysis (should be 'compute'
-            # method of the customAnaylsis template)
-            self.analysisFunc = customAnalysis.compute
+            # analysis names have to be unique, for the timing table
+            name = analysisName(analysisSettings)
+            if name in self.analysisNames:
+                name = '{}{}'.format(name, len(self.analysisNames))
+            self.analysisNames.append(name)
+            self.resultPrefixes.append('{}_'.format(entry['name']) if 'name' in entry else '')
 
-    def runAnalysis(self, vol, volIdx):
+        self.executors = [ThreadPoolExecutor(max_workers=1) for analyzer in self.analyzers]
+        self.lateFutures = [None] * len(self.analyzers)     # still running after a timeout
+        self.analysisFunc = self.analyzeConcurrently
+        self.takesMaskedVol = True
+        self.logger.debug('Concurrent analyses: {}'.format(self.analysisNames))
+
+    def createCustomAnalysis(self):
+        """ Create a new instance of the CustomAnalysis class
+
+        The custom analysis module has already been imported. Any state the
+        custom analysis keeps (e.g. previous volumes) starts out empty.
+
+        """
+        # create instance of customAnalysis class, pass in mask reference
+        customAnalysis = self.customAnalysisModule.CustomAnalysis(self.settings['maskFile'],
+                                                                  self.settings['maskIsWeighted'],
+                                                                  self.settings['numTimepts'])
+
+        # define the analysis func for the custom analysis (should be 'compute'
+        # method of the customAnaylsis template)
+        self.analysisFunc = customAnalysis.compute
+
+        # custom analyses can opt in to receiving the masked vol
+        self.takesMaskedVol = 'maskedVol' in inspect.signature(self.analysisFunc).parameters
+
+    def resetSeries(self):
+        """ Get ready to analyze the next series (session mode)
+
+        The built-in analyses don't keep any state between volumes, so only
+        a custom analysis needs to be recreated.
+
+        """
+        if self.analyzers is not None:
+            for analyzer in self.analyzers:
+                analyzer.resetSeries()
+        elif self.settings.get('customAnalysisProcess', False):
+            self.customAnalysisHost.resetSeries()
+        elif self.settings['analysisChoice'] not in BUILTIN_ANALYSES:
+            self.createCustomAnalysis()
+
+    def stop(self):
+        """ Shut down any worker threads or processes (at the end of a session) """
+        if self.analyzers is not None:
+            for analyzer, executor in zip(self.analyzers, self.executors):
+                analyzer.stop()
+                executor.shutdown(wait=False)
+        elif self.settings.get('customAnalysisProcess', False):
+            self.customAnalysisHost.stop()
+
+    def runAnalysis(self, vol, volIdx, maskedVol=None):
         """ Analyze the supplied volume
 
         This is a generic function that Pyneal can call in order to execute the
@@ -86,6 +231,12 @@ class Analyzer:
         anything (e.g. averageFromMask),but is included anyway so that any
         custom analysis scripts that need it have access to it
 
+        If the voxels within the mask have already been gathered (see the
+        'maskedTimeseries' setting of the scan receiver), they can be passed in
+        as `maskedVol`. The built-in analyses then use them instead of indexing
+        the full volume, as will a custom `compute` method that has a
+        `maskedVol` argument.
+
         Parameters
         ----------
         vol : numpy-array
@@ -93,6 +244,9 @@ class Analyzer:
         volIdx : int
             0-based index indicating where, in time (4th dimension), the volume
             belongs
+        maskedVol : numpy-array, optional
+            1D array of the voxels within the mask (in the same order as
+            vol[mask]) for the current volume
 
         Returns
         -------
@@ -104,14 +258,144 @@ class Analyzer:
         self.logger.debug('started volIdx {}'.format(volIdx))
         
         # submit vol and volIdx to the specified analysis function
-        output = self.analysisFunc(vol, volIdx)
+        startTime = time.time()
+        if maskedVol is not None and self.takesMaskedVol:
+            output = self.analysisFunc(vol, volIdx, maskedVol=maskedVol)
+        else:
+            output = self.analysisFunc(vol, volIdx)
+        if self.analyzers is None:
+            self.analysisTimes.append([volIdx, time.time() - startTime])
         self.logger.info('analyzed volIdx {}'.format(volIdx))
         
         return output
 
-    def averageFromMask(self, vol, volIdx):
+    def analyzeConcurrently(self, vol, volIdx, maskedVol=None):
+        """ Run every analysis on the volume concurrently, and merge the results
+
+        Parameters
+        ----------
+        vol : numpy-array
+            3D array of voxel data for the current volume
+        volIdx : int
+            0-based index indicating where, in time (4th dimension), the volume
+            belongs
+        maskedVol : numpy-array, optional
+            voxels within the main mask for the current volume. Only passed to
+            the analyses that use the main mask
+
+        Returns
+        -------
+        dict
+            results of every analysis that finished within its timeout, plus
+            'timedOut': [names] if any didn't, or were skipped because they
+            were still busy with an earlier volume
+
+        """
+        startTime = time.time()
+        futures = []
+        for i, (analyzer, executor) in enumerate(zip(self.analyzers, self.executors)):
+            # skip analyses that are still busy with a volume they timed out on
+            lateFuture = self.lateFutures[i]
+            if lateFuture is not None and not lateFuture.done():
+                futures.append(None)
+                continue
+            self.lateFutures[i] = None
+
+            analysisVol = vol
+            analysisMaskedVol = None
+            if analyzer.settings['maskFile'] == self.settings['maskFile']:
+                analysisMaskedVol = maskedVol
+            if analyzer.settings.get('analysisTimeout') is not None:
+                # an analysis that times out keeps running after this returns,
+                # by which time the buffers the vol is in may have been reused
+                analysisVol = vol.copy()
+                if analysisMaskedVol is not None:
+                    analysisMaskedVol = analysisMaskedVol.copy()
+            futures.append(executor.submit(timedAnalysis, analyzer, analysisVol, volIdx,
+                                           analysisMaskedVol))
+
+        output = {}
+        times = []
+        timedOut = []
+        for i, (name, prefix, analyzer, future) in enumerate(zip(
+                self.analysisNames, self.resultPrefixes, self.analyzers, futures)):
+            if future is None:
+                self.logger.warning('{} analysis is still busy; skipped volIdx {}'.format(name, volIdx))
+                timedOut.append(name)
+                times.append(np.nan)
+                continue
+
+            # each analysis's timeout counts from when the volume was submitted
+            timeout = analyzer.settings.get('analysisTimeout')
+            if timeout is not None:
+                timeout = max(timeout - (time.time() - startTime), 0)
+            try:
+                result, elapsed = future.result(timeout=timeout)
+            except TimeoutError:
+                self.logger.warning('{} analysis timed out on volIdx {}'.format(name, volIdx))
+                self.lateFutures[i] = future
+                timedOut.append(name)
+                times.append(np.nan)
+                continue
+
+            for key, value in result.items():
+                if prefix + key in output:
+                    self.logger.warning('{} analysis result {} replaces an earlier result'.format(
+                        name, prefix + key))
+                output[prefix + key] = value
+            times.append(elapsed)
+
+        if timedOut:
+            output['timedOut'] = timedOut
+        self.analysisTimes.append([volIdx] + times)
+        self.logger.debug('volIdx {} analysis times: {}'.format(volIdx, ', '.join(
+            '{} {:.4f}s'.format(name, t) for name, t in zip(self.analysisNames, times))))
+        return output
+
+    def get_analysisTimes(self, volIdx):
+        """ Return the time each analysis took on a volume
+
+        Parameters
+        ----------
+        volIdx : int
+            0-based index of the volume
+
+        Returns
+        -------
+        dict
+            seconds for each analysis, by analysis name (NaN if it timed out;
+            empty if the volume hasn't been analyzed)
+
+        """
+        for row in reversed(self.analysisTimes):
+            if row[0] == volIdx:
+                return dict(zip(self.analysisNames, row[1:]))
+        return {}
+
+    def saveResults(self):
+        """ Write the analysis timing to the series output directory
+
+        Saved as 'analysisTimes.tsv', with one row per volume, and summarized
+        in the log.
+
+        """
+        if not self.analysisTimes:
+            return
+        times = np.array(self.analysisTimes)
+        summary = ', '.join('{} {:.4f}s'.format(name, t) for name, t in
+                            zip(self.analysisNames, np.nanmedian(times[:, 1:], axis=0)))
+        self.logger.info('median analysis time per vol: {}'.format(summary))
+        if self.settings.get('seriesOutputDir'):
+            np.savetxt(join(self.settings['seriesOutputDir'], 'analysisTimes.tsv'),
+                       times, fmt=['%d'] + ['%.6f'] * len(self.analysisNames),
+                       delimiter='\t', comments='',
+                       header='\t'.join(['volIdx'] + self.analysisNames))
+        self.analysisTimes = []
+
+    def averageFromMask(self, vol, volIdx, maskedVol=None):
         """ Compute the average voxel activation within the mask.
-        Note: np.average has weights option, np.mean doesn't
+        Note: the mask plan weights are already normalized (and uniform, if
+        the mask isn't weighted), so the average is a dot product
 
         Parameters
         ----------
@@ -120,6 +404,8 @@ class Analyzer:
         volIdx : int
             0-based index indicating where, in time (4th dimension), the volume
             belongs
+        maskedVol : numpy-array, optional
+            voxels within the mask for the current volume, if already gathered
 
         Returns
         -------
@@ -127,14 +413,16 @@ class Analyzer:
             {'weightedAverage': ####} or {'average': ####}
 
         """
+        if maskedVol is None:
+            maskedVol = self.maskPlan.take(vol)
+        # accumulate in float64 (also keeps the result JSON serializable)
+        result = np.dot(self.maskPlan.weights, maskedVol.astype(np.float64, copy=False))
         if self.weightMask:
-            result = np.average(vol[self.mask], weights=self.weights[self.mask])
             return {'weightedAverage': np.round(result, decimals=2)}
         else:
-            result = np.mean(vol[self.mask])
             return {'average': np.round(result, decimals=2)}
 
-    def medianFromMask(self, vol, volIdx):
+    def medianFromMask(self, vol, volIdx, maskedVol=None):
         """ Compute the median voxel activation within the mask
 
         Parameters
@@ -144,6 +432,8 @@ class Analyzer:
         volIdx : int
             0-based index indicating where, in time (4th dimension), the volume
             belongs
+        maskedVol : numpy-array, optional
+            voxels within the mask for the current volume, if already gathered
 
         Returns
         -------
@@ -152,22 +442,646 @@ class Analyzer:
 
         See Also
         --------
-        Weighted median algorithm from: https://pypi.python.org/pypi/weightedstats/0.2
+        src/weightedStats.py, for the weighted median algorithm
 
         """
+        if maskedVol is None:
+            maskedVol = self.maskPlan.take(vol)
+        result = self.weightedStats.median(maskedVol)
         if self.weightMask:
-            data = vol[self.mask]
-            sorted_data, sorted_weights = map(np.array, zip(*sorted(zip(data, self.weights[self.mask]))))
-            midpoint = 0.5 * sum(sorted_weights)
-            if any(self.weights[self.mask] > midpoint):
-                return (data[self.weights == np.max(self.weights)])[0]
-            cumulative_weight = np.cumsum(sorted_weights)
-            below_midpoint_index = np.where(cumulative_weight <= midpoint)[0][-1]
-            if cumulative_weight[below_midpoint_index] == midpoint:
-                return np.mean(sorted_data[below_midpoint_index:below_midpoint_index + 2])
-            result = sorted_data[below_midpoint_index + 1]
             return {'weightedMedian': np.round(result, decimals=2)}
         else:
-            # take the median of the voxels in the mask
-            result = np.median(vol[self.mask])
             return {'median': np.round(result, decimals=2)}
+
+    def averageFromAtlas(self, vol, volIdx):
+        """ Compute the average voxel activation within every ROI of the atlas
+
+        Parameters
+        ----------
+        vol : numpy-array
+            3D array of voxel data for the current volume
+        volIdx : int
+            0-based index indicating where, in time (4th dimension), the volume
+            belongs
+
+        Returns
+        -------
+        dict
+            {'weightedRoiAverages': [####, ...]} or {'roiAverages': [####, ...]},
+            with one average per ROI, in order of increasing label
+
+        """
+        result = np.round(self.atlasPlan.roiAverages(vol), decimals=2).tolist()
+        if self.atlasPlan.weighted:
+            return {'weightedRoiAverages': result}
+        else:
+            return {'roiAverages': result}
+
+
+def analysisName(settings):
+    """ Return a short name for the analysis in the settings
+
+    The 'name' setting, if there is one. Otherwise the analysisChoice, or, for
+    a custom analysis, the name of the script.
+
+    """
+    if settings.get('name'):
+        return settings['name']
+    if settings['analysisChoice'] in BUILTIN_ANALYSES:
+        return settings['analysisChoice']
+    return os.path.splitext(os.path.basename(settings['analysisChoice']))[0]
+
+
+def timedAnalysis(analyzer, vol, volIdx, maskedVol=None):
+    """ Run an analysis, and return its results and how long it took """
+    startTime = time.time()
+    result = analyzer.runAnalysis(vol, volIdx, maskedVol=maskedVol)
+    return result, time.time() - startTime
+
+
+class CustomAnalysisHost():
+    """ Tool to run a custom analysis in a dedicated worker process
+
+    The worker process starts right away, and creates the CustomAnalysis
+    while Pyneal waits for the scan, just as it would in-process. Each
+    volume is then copied into a slot of a ring buffer in shared memory (slot
+    volIdx % nSlots), and the worker is sent the slot index. The worker
+    copies the volume out of the slot before computing, so the custom
+    analysis can keep it. The slots are sized for the mask dimensions, with
+    up to 8 bytes per voxel, so they fit any of the usual voxel datatypes.
+
+    If the result for a volume isn't back before the deadline, it's reported
+    as late, and the result is discarded when it does arrive. If the worker
+    falls so far behind that the volume's slot is still in use, the volume
+    is skipped (and reported as late).
+
+    """
+    def __init__(self, analysisFile, maskFile, weightMask, numTimepts,
+                 deadline=None, nSlots=4, logger=None):
+        """ Initialize the class
+
+        Parameters
+        ----------
+        analysisFile : string
+            full path to the custom analysis script
+        maskFile, weightMask, numTimepts
+            passed on to the CustomAnalysis class
+        deadline : float, optional
+            seconds to wait for the result of each volume. If None, wait for
+            every result
+        nSlots : int, optional
+            number of volumes in the shared memory ring buffer
+        logger : logger object, optional
+            reference to the logger object where you want to write log messages
+
+        """
+        self.deadline = deadline
+        self.nSlots = nSlots
+        self.logger = logger or logging.getLogger('PynealLog')
+        self.busySlots = {}     # volIdx computing in each slot, by slotIdx
+        self.seriesIdx = 0      # results from earlier series are discarded
+
+        # volumes have the same dims as the mask
+        self.volShape = tuple(nib.load(maskFile).shape[:3])
+        self.slotBytes = int(np.prod(self.volShape)) * 8
+
+        # spawn rather than fork, since this process is running other threads
+        ctx = multiprocessing.get_context('spawn')
+        self.volBuffer = ctx.RawArray('b', self.nSlots * self.slotBytes)
+        self.taskQ = ctx.Queue()
+        self.resultQ = ctx.Queue()
+        self.worker = ctx.Process(target=customAnalysisWorker,
+                                  args=(self.taskQ, self.resultQ, self.volBuffer,
+                                        self.volShape, self.slotBytes, analysisFile,
+                                        (maskFile, weightMask, numTimepts)),
+                                  daemon=True)
+        self.worker.start()
+
+    def compute(self, vol, volIdx):
+        """ Compute the custom analysis on a volume in the worker process
+
+        Parameters
+        ----------
+        vol : numpy-array
+            3D array of voxel data for the current volume
+        volIdx : int
+            0-based index of the current volume
+
+        Returns
+        -------
+        dict
+            results from the custom analysis, or {'late': True} if they
+            weren't back before the deadline
+
+        """
+        if vol.shape != self.volShape or vol.itemsize > 8:
+            raise ValueError('cannot pass a {} volume of dims {} to the custom analysis'.format(
+                vol.dtype, vol.shape))
+        if not self.worker.is_alive():
+            return self.workerExited()
+
+        # free the slots of any late results that have come back since
+        self.collectResults(block=False)
+        slotIdx = volIdx % self.nSlots
+        if slotIdx in self.busySlots:
+            self.logger.warning('custom analysis worker is still on volIdx {}; skipping volIdx {}'.format(
+                self.busySlots[slotIdx], volIdx))
+            return {'late': True}
+        volSlot = slotView(self.volBuffer, slotIdx, self.slotBytes, self.volShape, vol.dtype)
+        volSlot[...] = vol
+        self.busySlots[slotIdx] = volIdx
+        self.taskQ.put((self.seriesIdx, volIdx, slotIdx, vol.dtype.str))
+
+        result = self.collectResults(volIdx=volIdx)
+        if result is None:
+            self.logger.warning('custom analysis missed the {}s deadline for volIdx {}'.format(
+                self.deadline, volIdx))
+            return {'late': True}
+        return result
+
+    def collectResults(self, volIdx=None, block=True):
+        """ Handle results from the worker, up to the result for `volIdx`
+
+        Results for any other volume arrived late, and are discarded. While
+        waiting, the worker is checked every WORKER_POLL_INTERVAL seconds, so
+        that Pyneal doesn't hang if it has died.
+
+        Parameters
+        ----------
+        volIdx : int, optional
+            volume to wait for the result of (until the deadline)
+        block : bool, optional
+            if False, only handle results that have already arrived
+
+        Returns
+        -------
+        dict or None
+            result for `volIdx`, or None if it didn't arrive in time
+
+        """
+        deadline = None
+        if self.deadline is not None:
+            deadline = time.time() + self.deadline
+        while True:
+            timeout = WORKER_POLL_INTERVAL
+            if deadline is not None:
+                timeout = min(max(deadline - time.time(), 0), timeout)
+            try:
+                resultSeriesIdx, resultVolIdx, slotIdx, result, error = self.resultQ.get(
+                    block=block, timeout=timeout)
+            except queue.Empty:
+                if not block or (deadline is not None and time.time() >= deadline):
+                    return None
+                if not self.worker.is_alive():
+                    return self.workerExited()
+                continue
+            if resultSeriesIdx != self.seriesIdx:
+                self.logger.debug('discarding custom analysis result for volIdx {} of an earlier series'.format(
+                    resultVolIdx))
+                continue
+            del self.busySlots[slotIdx]
+
+            if error is not None:
+                self.logger.error('custom analysis failed on volIdx {}: {}'.format(
+                    resultVolIdx, error))
+                result = {'error': error}
+            if resultVolIdx == volIdx:
+                return result
+            self.logger.info('discarding late custom analysis result for volIdx {}'.format(
+                resultVolIdx))
+
+    def workerExited(self):
+        """ Log that the worker process has died, and return the error """
+        error = 'custom analysis worker exited with code {}'.format(self.worker.exitcode)
+        self.logger.error(error)
+        return {'error': error}
+
+    def resetSeries(self):
+        """ Create a new CustomAnalysis in the worker, for the next series
+
+        Late results from the current series are discarded, and their slots
+        freed, so they don't hold up the next series.
+
+        """
+        self.collectResults(block=False)
+        self.busySlots = {}
+        self.seriesIdx += 1
+        self.taskQ.put('reset')
+
+    def stop(self, timeout=5):
+        """ Stop the worker, once it finishes its current volume """
+        if self.worker is None:
+            return
+        self.taskQ.put(None)
+        self.worker.join(timeout)
+        if self.worker.is_alive():
+            self.worker.terminate()
+        self.worker = None
+
+
+def slotView(volBuffer, slotIdx, slotBytes, volShape, dtype):
+    """ Return a volume array onto a slot of the shared memory ring buffer """
+    return np.frombuffer(volBuffer, dtype=dtype, count=int(np.prod(volShape)),
+                         offset=slotIdx * slotBytes).reshape(volShape)
+
+
+def customAnalysisWorker(taskQ, resultQ, volBuffer, volShape, slotBytes,
+                         analysisFile, analysisArgs):
+    """ Compute the custom analysis on each queued volume (runs in the worker
+    process)
+
+    Parameters
+    ----------
+    taskQ : multiprocessing Queue
+        (seriesIdx, volIdx, slotIdx, dtype) for each volume to analyze,
+        'reset' to start a new series, and None when there are no more volumes
+    resultQ : multiprocessing Queue
+        (seriesIdx, volIdx, slotIdx, result, error) is put here for each volume
+    volBuffer : multiprocessing RawArray
+        shared memory holding the ring buffer of volume slots
+    volShape : tuple
+        dimensions (x, y, z) of each volume
+    slotBytes : int
+        size of each slot
+    analysisFile : string
+        full path to the custom analysis script
+    analysisArgs : tuple
+        arguments to create the CustomAnalysis with
+
+    """
+    # if the analysis can't be created, report the error for every volume
+    try:
+        customAnalysisDir, customAnalysisName = os.path.split(analysisFile)
+        sys.path.append(customAnalysisDir)
+        customAnalysisModule = importlib.import_module(customAnalysisName.split('.')[0])
+        importError = None
+    except Exception as e:
+        customAnalysisModule, importError = None, repr(e)
+
+    def createCustomAnalysis():
+        if customAnalysisModule is None:
+            return None, importError
+        try:
+            return customAnalysisModule.CustomAnalysis(*analysisArgs), None
+        except Exception as e:
+            return None, repr(e)
+
+    customAnalysis, setupError = createCustomAnalysis()
+    while True:
+        task = taskQ.get()
+        if task is None:
+            break
+        if task == 'reset':
+            customAnalysis, setupError = createCustomAnalysis()
+            continue
+        seriesIdx, volIdx, slotIdx, dtype = task
+
+        if customAnalysis is None:
+            resultQ.put((seriesIdx, volIdx, slotIdx, None, setupError))
+            continue
+        vol = slotView(volBuffer, slotIdx, slotBytes, volShape, dtype).copy()
+        try:
+            result = customAnalysis.compute(vol, volIdx)
+            resultQ.put((seriesIdx, volIdx, slotIdx, result, None))
+        except Exception as e:
+            resultQ.put((seriesIdx, volIdx, slotIdx, None, repr(e)))
+
+
+class MaskPlan():
+    """ Mask compiled for gathering the voxels within it from each volume
+
+    Attributes
+    ----------
+    shape : tuple
+        dimensions of the mask (and of every volume)
+    flatIdx : numpy array
+        int32 indices of the voxels within the mask, into the flattened
+        (C-order) volume. Same order as vol[mask]
+    weights : numpy array
+        float32 weight of each voxel within the mask, normalized to sum to
+        one (all equal, if the mask isn't weighted)
+    nVoxels : int
+        number of voxels within the mask
+
+    """
+    def __init__(self, shape, flatIdx, weights):
+        """ Initialize the class
+
+        Parameters
+        ----------
+        shape : tuple
+            dimensions of the mask
+        flatIdx : numpy array
+            indices of the voxels within the mask, into the flattened volume
+        weights : numpy array
+            weight of each voxel within the mask (normalized here)
+
+        """
+        self.shape = tuple(int(dim) for dim in shape)
+        self.flatIdx = np.asarray(flatIdx, dtype=np.int32)
+        weights = np.asarray(weights, dtype=np.float64)
+        self.weights = (weights / weights.sum()).astype(np.float32)
+        self.nVoxels = len(self.flatIdx)
+
+        # element offsets of the mask voxels, for each layout of volume
+        # (strides) seen so far
+        self.offsets = {}
+
+    def planArrays(self):
+        """ Return the arrays needed to recreate the plan (for caching) """
+        return {'shape': np.array(self.shape), 'flatIdx': self.flatIdx,
+                'weights': self.weights}
+
+    @property
+    def mask(self):
+        """ 3D boolean array of the mask """
+        mask = np.zeros(self.shape, dtype=bool)
+        mask.flat[self.flatIdx] = True
+        return mask
+
+    def take(self, vol):
+        """ Gather the voxels within the mask from a volume
+
+        Volumes that aren't contiguous (e.g. a volume in the scan receiver's
+        4D image matrix) are read through a flat view using their strides, so
+        they aren't copied.
+
+        Parameters
+        ----------
+        vol : numpy-array
+            3D array of voxel data, with the same dimensions as the mask
+
+        Returns
+        -------
+        numpy-array
+            1D array of the voxels within the mask (same order as vol[mask])
+
+        """
+        if vol.shape != self.shape:
+            raise ValueError('volume dims {} do not match mask dims {}'.format(
+                vol.shape, self.shape))
+        if vol.flags['C_CONTIGUOUS']:
+            return np.take(vol.reshape(-1), self.flatIdx)
+        if min(vol.strides) < 0 or any(stride % vol.itemsize for stride in vol.strides):
+            return np.take(vol, self.flatIdx)
+
+        if vol.strides not in self.offsets:
+            elementStrides = np.array(vol.strides) // vol.itemsize
+            coords = np.unravel_index(self.flatIdx, self.shape)
+            offsets = sum(c.astype(np.intp) * step for c, step in zip(coords, elementStrides))
+            span = int(elementStrides.dot(np.array(self.shape) - 1)) + 1
+            self.offsets[vol.strides] = (offsets, span)
+        offsets, span = self.offsets[vol.strides]
+        flatVol = np.lib.stride_tricks.as_strided(vol, shape=(span,),
+                                                  strides=(vol.itemsize,),
+                                                  writeable=False)
+        return np.take(flatVol, offsets)
+
+
+class AtlasPlan(MaskPlan):
+    """ Atlas compiled for averaging every ROI of each volume in one pass
+
+    The labelled voxels are gathered as with a MaskPlan. The weights are
+    normalized to sum to one within each ROI, so the ROI averages are the
+    per-ROI sums (np.bincount) of the weighted voxel values.
+
+    Attributes
+    ----------
+    labelIdx : numpy array
+        int32 index of the ROI (into `labels`) of each labelled voxel
+    labels : numpy array
+        label value of each ROI, in increasing order
+    nRois : int
+        number of ROIs
+    weighted : bool
+        True if the voxels are weighted
+
+    """
+    def __init__(self, shape, flatIdx, weights, labelIdx, labels, weighted):
+        """ Initialize the class
+
+        Parameters
+        ----------
+        shape : tuple
+            dimensions of the atlas
+        flatIdx : numpy array
+            indices of the labelled voxels, into the flattened volume
+        weights : numpy array
+            weight of each labelled voxel (normalized within each ROI here)
+        labelIdx : numpy array
+            index of the ROI of each labelled voxel
+        labels : numpy array
+            label value of each ROI
+        weighted : bool
+            True if the voxels are weighted
+
+        """
+        super().__init__(shape, flatIdx, weights)
+        self.labelIdx = np.asarray(labelIdx, dtype=np.int32)
+        self.labels = np.asarray(labels)
+        self.nRois = len(self.labels)
+        self.weighted = bool(weighted)
+
+        weights = np.asarray(weights, dtype=np.float64)
+        roiTotals = np.bincount(self.labelIdx, weights=weights, minlength=self.nRois)
+        self.weights = (weights / roiTotals[self.labelIdx]).astype(np.float32)
+
+    def planArrays(self):
+        """ Return the arrays needed to recreate the plan (for caching) """
+        arrays = super().planArrays()
+        arrays.update({'labelIdx': self.labelIdx, 'labels': self.labels,
+                       'weighted': np.array(self.weighted)})
+        return arrays
+
+    def roiAverages(self, vol):
+        """ Compute the (weighted) average of every ROI in a volume
+
+        Parameters
+        ----------
+        vol : numpy-array
+            3D array of voxel data, with the same dimensions as the atlas
+
+        Returns
+        -------
+        numpy-array
+            1D array with the average of each ROI, in the order of `labels`
+
+        """
+        weightedVals = np.multiply(self.take(vol), self.weights, dtype=np.float64)
+        return np.bincount(self.labelIdx, weights=weightedVals, minlength=self.nRois)
+
+
+def compileAtlasPlan(labelData, weightData=None):
+    """ Compile a label image (and optional voxel weights) into an AtlasPlan
+
+    Parameters
+    ----------
+    labelData : numpy-array
+        3D array of integer labels. Voxels labelled 0 are not in any ROI
+    weightData : numpy-array, optional
+        3D array of voxel weights. Voxels with a weight of 0 are left out
+
+    Returns
+    -------
+    AtlasPlan
+
+    """
+    labelData = np.rint(labelData).astype(np.int64)
+    inRoi = labelData > 0
+    if weightData is not None:
+        if weightData.shape != labelData.shape:
+            raise ValueError('atlas weight dims {} do not match atlas dims {}'.format(
+                weightData.shape, labelData.shape))
+        inRoi &= weightData > 0
+    flatIdx = np.flatnonzero(inRoi)
+    labels, labelIdx = np.unique(labelData.reshape(-1)[flatIdx], return_inverse=True)
+    if weightData is not None:
+        weights = weightData.reshape(-1)[flatIdx]
+    else:
+        weights = np.ones(len(flatIdx))
+    return AtlasPlan(labelData.shape, flatIdx, weights, labelIdx, labels,
+                     weighted=weightData is not None)
+
+
+def compileMaskPlan(maskData, weighted):
+    """ Compile a mask array into a MaskPlan
+
+    Parameters
+    ----------
+    maskData : numpy-array
+        3D mask. Voxels > 0 are within the mask
+    weighted : bool
+        if True, the mask values are the voxel weights
+
+    Returns
+    -------
+    MaskPlan
+
+    """
+    flatIdx = np.flatnonzero(maskData > 0)
+    if weighted:
+        weights = maskData.reshape(-1)[flatIdx]
+    else:
+        weights = np.ones(len(flatIdx))
+    return MaskPlan(maskData.shape, flatIdx, weights)
+
+
+def maskPlanFile(maskFile, suffix='_maskPlan.npz'):
+    """ Return the path of the cached plan for a mask (or atlas) file """
+    maskDir, maskName = os.path.split(maskFile)
+    for ext in ['.nii.gz', '.nii']:
+        if maskName.endswith(ext):
+            maskName = maskName[:-len(ext)]
+            break
+    return join(maskDir, maskName + suffix)
+
+
+def fileVersion(fname):
+    """ Return the size and modification time of a file, to detect changes """
+    fileStat = os.stat(fname)
+    return [fileStat.st_size, fileStat.st_mtime_ns]
+
+
+def loadCachedPlan(planFile, planVersion, createPlan, planClass, useCache, logger=None):
+    """ Load a cached plan, or create it (and update the cache)
+
+    Parameters
+    ----------
+    planFile : string
+        path to the cached plan
+    planVersion : list
+        integers identifying the files and settings the plan is made from.
+        The cached plan is only used if they match
+    createPlan : function
+        returns a new plan
+    planClass : class
+        class of the plan, created from the arrays in the cache
+    useCache : bool
+        read/write the cached plan
+    logger : logging.Logger, optional
+
+    Returns
+    -------
+    MaskPlan or AtlasPlan
+
+    """
+    planVersion = np.array(planVersion, dtype=np.int64)
+    if useCache and os.path.exists(planFile):
+        with np.load(planFile) as cached:
+            if np.array_equal(cached['planVersion'], planVersion):
+                if logger:
+                    logger.debug('Loaded plan from {}'.format(planFile))
+                return planClass(**{key: cached[key] for key in cached.files
+                                    if key != 'planVersion'})
+
+    plan = createPlan()
+    if useCache:
+        try:
+            np.savez(planFile, planVersion=planVersion, **plan.planArrays())
+        except OSError as e:
+            if logger:
+                logger.warning('Could not cache plan at {}: {}'.format(planFile, e))
+    return plan
+
+
+def loadMaskPlan(maskFile, weighted, useCache=False, logger=None):
+    """ Load the mask plan for a mask file
+
+    With `useCache`, the plan is read from the cache file next to the mask
+    (see maskPlanFile) if it was made from the same version of the mask file
+    (same size and modification time), and with the same `weighted` setting.
+    Otherwise, the mask is loaded and compiled, and the cache is updated.
+
+    Parameters
+    ----------
+    maskFile : string
+        path to the mask (NIfTI)
+    weighted : bool
+        if True, the mask values are the voxel weights
+    useCache : bool, optional
+        read/write the cached plan
+    logger : logging.Logger, optional
+
+    Returns
+    -------
+    MaskPlan
+
+    """
+    return loadCachedPlan(maskPlanFile(maskFile), fileVersion(maskFile) + [weighted],
+                          lambda: compileMaskPlan(np.asanyarray(nib.load(maskFile).dataobj), weighted),
+                          MaskPlan, useCache, logger)
+
+
+def loadAtlasPlan(atlasFile, weightsFile=None, useCache=False, logger=None):
+    """ Load the atlas plan for a label image
+
+    Cached next to the atlas file (as <atlas>_atlasPlan.npz), like the mask
+    plan (see loadMaskPlan).
+
+    Parameters
+    ----------
+    atlasFile : string
+        path to the label image (NIfTI)
+    weightsFile : string, optional
+        path to an image of voxel weights (NIfTI), with the same dimensions
+    useCache : bool, optional
+        read/write the cached plan
+    logger : logging.Logger, optional
+
+    Returns
+    -------
+    AtlasPlan
+
+    """
+    def createPlan():
+        labelData = np.asanyarray(nib.load(atlasFile).dataobj)
+        weightData = None
+        if weightsFile:
+            weightData = np.asanyarray(nib.load(weightsFile).dataobj)
+        return compileAtlasPlan(labelData, weightData)
+
+    planVersion = fileVersion(atlasFile)
+    if weightsFile:
+        planVersion += fileVersion(weightsFile)
+    return loadCachedPlan(maskPlanFile(atlasFile, '_atlasPlan.npz'), planVersion,
+                          createPlan, AtlasPlan, useCache, logger)
@@ -65,3 +65,27 @@ def createLogger(log_fName):
 
     # return a reference to this formatted logger
     return logger
+
+
+def switchLogFile(log_fName):
+    """ Send log messages to a new log file
+
+    Replaces the file handler that was set up by `createLogger`, keeping the
+    same formatting. Used in session mode to give each series its own log.
+
+    Parameters
+    ----------
+    log_fName : string
+        full path to the filename you want to set as the new log output file
+
+    """
+    logger = logging.getLogger('PynealLog')
+    for handler in list(logger.handlers):
+        if isinstance(handler, logging.FileHandler):
+            logger.removeHandler(handler)
+            handler.close()
+
+            newFileLogger = logging.FileHandler(log_fName, mode='w')
+            newFileLogger.setLevel(handler.level)
+            newFileLogger.setFormatter(handler.formatter)
+            logger.addHandler(newFileLogger)
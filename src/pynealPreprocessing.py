@@ -3,16 +3,60 @@
 Set of utilities for apply specified preprocessing steps to data during a
 real-time run.
 
+The steps are run as a pipeline of stages, in the order given by the
+'preprocessingStages' setting (see PREPROCESSING_STAGES for the available
+stages). Stages that change the voxel data write to a pair of work buffers
+that the preprocessor allocates once, rather than to new arrays. The time
+each stage takes is logged for every volume, plotted in the dashboard's
+timing plot (one line per stage) along with the total processing time, and
+written to 'preprocessingTimes.tsv' in the series output directory.
+
+The 'runningStats' stage normalizes the voxels within the mask against their
+running mean and variance (z-score, or percent signal change), which are
+updated in constant time per volume rather than recomputed from the history.
+Likewise, the 'nuisanceRegression' stage refits a GLM of drift, low-frequency
+cosines and motion to the mask signal with every volume, from running sums.
+
+Motion estimation is the slowest step, but its results only go to the
+dashboard. With the optional 'asyncMotion' setting, it runs in a separate
+worker process instead, so that analysis doesn't have to wait for it. Each
+volume is handed to the worker through shared memory, and the motion estimates
+are sent to the dashboard, and written to 'motionLog.tsv' in the series output
+directory, as they come back.
+
+The 'motionBackend' setting picks the registration engine used for motion
+estimation: 'nipy' (default) for nipy's HistogramRegistration, or 'numpy' for
+the least-squares rigid-body registration in src/rigidRegistration.py, which
+is faster and doesn't print to stdOut.
+
+With the optional 'motionCorrection' setting, the estimated motion is also
+corrected for, but only at the voxels within the mask ('maskFile'), since
+those are the only voxels the analysis uses. The mask voxels are resampled
+from the current volume with trilinear interpolation, so the cost per volume
+depends on the size of the mask rather than the volume. Voxels outside of the
+mask are left uncorrected.
+
 """
+from os.path import join
 import sys
 import logging
 import io
 import contextlib
+import multiprocessing
+import queue
+import time
+from threading import Thread
 
 import zmq
 import numpy as np
 import nibabel as nib
+from scipy.ndimage import gaussian_filter
 from nipy.algorithms.registration import HistogramRegistration, Rigid
+from nipy.algorithms.registration.histogram_registration import (clamp,
+                                                                 ideal_spacing)
+from nipy.core.image.image_spaces import as_xyz_image, xyz_affine
+
+from src.rigidRegistration import RigidRegistration, trilinear, rigidParams
 
 
 class Preprocessor:
@@ -22,6 +66,11 @@ class Preprocessor:
     will handle executing specific preprocessing routines on incoming volumes
     throughout the scan.
 
+    The routines are run as a pipeline of stages. The stages to run, and their
+    order, come from the 'preprocessingStages' setting: a list of names from
+    PREPROCESSING_STAGES. If it isn't set, the pipeline is built from the
+    'estimateMotion' and 'motionCorrection' settings.
+
     """
     def __init__(self, settings):
         """ Initialize the class
@@ -39,9 +88,10 @@ class Preprocessor:
 
         self.settings = settings
         self.affine = None
-
-        # start the motion thread
-        self.motionProcessor = MotionProcessor(logger=self.logger, refVolIdx=4)
+        self.maskedVol = None
+        self.maskedVolIdx = None
+        self.workBuffers = []
+        self.stageTimes = []
 
         # create the socket to send data to dashboard (if dashboard there be)
         if self.settings['launchDashboard']:
@@ -50,6 +100,64 @@ class Preprocessor:
             self.dashboardSocket = context.socket(zmq.REQ)
             self.dashboardSocket.connect('tcp://127.0.0.1:{}'.format(self.settings['dashboardPort']))
 
+        # build the pipeline
+        self.stages = self.createStages()
+        self.logger.debug('Preprocessing stages: {}'.format(
+            [stage.name for stage in self.stages]))
+
+    def createStages(self):
+        """ Create the preprocessing stages, in the order they will run
+
+        Stages that require an earlier stage which isn't in the pipeline are
+        skipped, with a warning.
+
+        Returns
+        -------
+        list
+            PreprocessingStage instances
+
+        """
+        stageNames = self.settings.get('preprocessingStages')
+        if stageNames is None:
+            stageNames = []
+            if self.settings['estimateMotion']:
+                stageNames.append('estimateMotion')
+            if self.settings.get('motionCorrection', False):
+                stageNames.append('motionCorrection')
+        for name in stageNames:
+            if name not in PREPROCESSING_STAGES:
+                raise ValueError('Unrecognized preprocessing stage: {}'.format(name))
+
+        # stages can look up the stages before them as they're created
+        self.stages = []
+        for name in stageNames:
+            stageClass = PREPROCESSING_STAGES[name]
+            missing = [req for req in stageClass.requires
+                       if self.get_stage(req) is None]
+            if missing:
+                self.logger.warning('{} requires {}; skipping {}'.format(
+                    name, ', '.join(missing), name))
+                continue
+            self.stages.append(stageClass(self, stageNames))
+        return self.stages
+
+    def get_stage(self, name):
+        """ Return the stage in the pipeline with the given name, or None """
+        for stage in self.stages:
+            if stage.name == name:
+                return stage
+        return None
+
+    @property
+    def altersVoxels(self):
+        """ True if any stage changes the voxel data """
+        return any(stage.altersVoxels for stage in self.stages)
+
+    @property
+    def needsFullVolume(self):
+        """ True if any stage needs every slice of the volume """
+        return any(stage.needsFullVolume for stage in self.stages)
+
     def set_affine(self, affine):
         """ Set a local reference to the RAS+ affine transformation for the
         current series
@@ -62,6 +170,45 @@ class Preprocessor:
         """
         self.affine = affine
 
+    def resetSeries(self):
+        """ Get ready to preprocess the next series (session mode)
+
+        Clears the affine, and the reference volume used for motion
+        estimation. `saveResults` should already have been called for the
+        current series.
+
+        """
+        self.affine = None
+        for stage in self.stages:
+            stage.resetSeries()
+        self.maskedVol = None
+        self.maskedVolIdx = None
+
+    def saveResults(self):
+        """ Finish up preprocessing for the current series
+
+        Each stage finishes up (e.g. with 'asyncMotion', waiting for the worker
+        process to estimate motion for any volumes it still has queued). The
+        per-stage timing is written to 'preprocessingTimes.tsv' in the series
+        output directory, and summarized in the log.
+
+        """
+        for stage in self.stages:
+            stage.saveResults()
+        if not self.stageTimes:
+            return
+
+        times = np.array(self.stageTimes)
+        names = [stage.name for stage in self.stages]
+        summary = ', '.join('{} {:.4f}s'.format(name, t)
+                            for name, t in zip(names, np.median(times[:, 1:], axis=0)))
+        self.logger.info('median preprocessing time per vol: {}'.format(summary))
+        if self.settings.get('seriesOutputDir'):
+            np.savetxt(join(self.settings['seriesOutputDir'], 'preprocessingTimes.tsv'),
+                       times, fmt=['%d'] + ['%.6f'] * len(names), delimiter='\t',
+                       comments='', header='\t'.join(['volIdx'] + names))
+        self.stageTimes = []
+
     def runPreprocessing(self, vol, volIdx):
         """ Run preprocessing on the supplied volume
 
@@ -79,34 +226,122 @@ class Preprocessor:
         Returns
         -------
         vol : numpy-array
-            preprocessed 3D array of voxel data for the current volume
+            preprocessed 3D array of voxel data for the current volume. If a
+            stage changed the voxel data, this is one of the preprocessor's
+            work buffers, and is overwritten by the next volume
 
         """
-        ### calculate the motion parameters on this volume. motionParams are
-        # returned as dictionary with keys for 'rms_abs', and 'rms_rel';
-        # NOTE: estimateMotion needs the input vol to be a nibabel nifti obj
-        # the nostdout bit suppresses verbose estimation output to stdOut
         self.logger.debug('started volIdx {}'.format(volIdx))
-        
-        if self.settings['estimateMotion']:
-            with nostdout():
-                motionParams = self.motionProcessor.estimateMotion(
-                    nib.Nifti1Image(vol, self.affine),
-                    volIdx)
 
-            ### send to dashboard (if specified)
-            if self.settings['launchDashboard']:
-                if motionParams is not None:
+        times = []
+        for stage in self.stages:
+            startTime = time.time()
+            self.maskedVolUpdated = False
+            vol = stage.run(vol, volIdx)
+            times.append(time.time() - startTime)
 
-                    # send to the dashboard
-                    self.sendToDashboard(topic='motion',
-                                        content={'volIdx': volIdx,
-                                                'rms_abs': motionParams['rms_abs'],
-                                                'rms_rel': motionParams['rms_rel']})
+            # a masked vol is only kept if no later stage changes the voxels
+            # without updating it
+            if stage.altersVoxels and not self.maskedVolUpdated:
+                self.maskedVolIdx = None
+        if self.stages:
+            self.stageTimes.append([volIdx] + times)
+            self.logger.debug('volIdx {} stage times: {}'.format(volIdx, ', '.join(
+                '{} {:.4f}s'.format(stage.name, t) for stage, t in zip(self.stages, times))))
 
         self.logger.info('preprocessed volIdx {}'.format(volIdx))
         return vol
 
+    def get_stageTimes(self, volIdx):
+        """ Return the time each stage took on a volume
+
+        Parameters
+        ----------
+        volIdx : int
+            0-based index of the volume
+
+        Returns
+        -------
+        dict
+            seconds for each stage, by stage name (empty if the volume hasn't
+            been preprocessed)
+
+        """
+        for row in reversed(self.stageTimes):
+            if row[0] == volIdx:
+                return {stage.name: t for stage, t in zip(self.stages, row[1:])}
+        return {}
+
+    def get_workBuffer(self, vol):
+        """ Return a buffer for a stage to write its output volume to
+
+        The preprocessor keeps a pair of float buffers, allocated once for the
+        volume dimensions, and stages alternate between them, so a stage's
+        input is never its output.
+
+        Parameters
+        ----------
+        vol : numpy-array
+            3D input volume of the stage
+
+        Returns
+        -------
+        numpy-array
+            3D float array, with the same dimensions as `vol`
+
+        """
+        if not self.workBuffers or self.workBuffers[0].shape != vol.shape:
+            self.workBuffers = [np.empty(vol.shape), np.empty(vol.shape)]
+        if vol is self.workBuffers[0]:
+            return self.workBuffers[1]
+        return self.workBuffers[0]
+
+    def set_maskedVol(self, maskedVol, volIdx):
+        """ Store the preprocessed voxels within the mask for a volume """
+        self.maskedVol = maskedVol
+        self.maskedVolIdx = volIdx
+        self.maskedVolUpdated = True
+
+    def get_maskedVol(self, volIdx):
+        """ Return the preprocessed voxels within the mask
+
+        Parameters
+        ----------
+        volIdx : int
+            0-based index of the volume
+
+        Returns
+        -------
+        numpy-array
+            1D array of the preprocessed voxels within the mask (in the same
+            order as vol[mask]), or None if no stage produced them for this vol
+
+        """
+        if self.maskedVolIdx != volIdx:
+            return None
+        return self.maskedVol
+
+    def reportMotion(self, volIdx, motionParams):
+        """ Send the motion params for a volume to the dashboard (if specified)
+
+        Parameters
+        ----------
+        volIdx : int
+            0-based index of the volume
+        motionParams : dict or None
+            dictionary with 'rms_abs' and 'rms_rel' entries, or None if no
+            motion estimate was made for this volume
+
+        """
+        if self.settings['launchDashboard']:
+            if motionParams is not None:
+
+                # send to the dashboard
+                self.sendToDashboard(topic='motion',
+                                     content={'volIdx': volIdx,
+                                              'rms_abs': motionParams['rms_abs'],
+                                              'rms_rel': motionParams['rms_rel']})
+
     def sendToDashboard(self, topic=None, content=None):
         """ Send a msg to the Pyneal dashboard.
 
@@ -131,6 +366,513 @@ class Preprocessor:
             response = self.dashboardSocket.recv_string()
 
 
+class PreprocessingStage():
+    """ Base class for a stage in the preprocessing pipeline
+
+    Subclasses set `name` (the key in PREPROCESSING_STAGES), and override
+    `run`. A stage that changes the voxel data should write its output to a
+    buffer from `preprocessor.get_workBuffer` rather than allocating a new
+    volume.
+
+    Attributes
+    ----------
+    name : string
+        name of the stage, as used in the 'preprocessingStages' setting
+    requires : tuple
+        names of stages that have to run before this one
+    altersVoxels : bool
+        True if the stage changes the voxel data
+    needsFullVolume : bool
+        True if the stage needs every slice of the volume, rather than just
+        the slices within the mask
+    usesMotionEstimates : bool
+        True if the stage needs each volume's motion estimate as it runs
+
+    """
+    name = None
+    requires = ()
+    altersVoxels = False
+    needsFullVolume = False
+    usesMotionEstimates = False
+
+    def __init__(self, preprocessor, stageNames):
+        """ Initialize the stage
+
+        Parameters
+        ----------
+        preprocessor : Preprocessor
+            the preprocessor running this stage. Gives access to the settings,
+            the affine, and the other stages
+        stageNames : list
+            names of every stage in the pipeline, in order
+
+        """
+        self.preprocessor = preprocessor
+        self.settings = preprocessor.settings
+        self.logger = preprocessor.logger
+
+    def run(self, vol, volIdx):
+        """ Run the stage on a volume, and return the (new) volume """
+        return vol
+
+    def resetSeries(self):
+        """ Get ready for the next series """
+        pass
+
+    def saveResults(self):
+        """ Finish up at the end of a series """
+        pass
+
+
+class MotionEstimationStage(PreprocessingStage):
+    """ Estimate head motion, and send it to the dashboard
+
+    With 'asyncMotion', estimation runs in a worker process, unless a later
+    stage needs each volume's estimate before it can run.
+
+    """
+    name = 'estimateMotion'
+    needsFullVolume = True
+
+    def __init__(self, preprocessor, stageNames):
+        super().__init__(preprocessor, stageNames)
+        self.asyncMotion = self.settings.get('asyncMotion', False)
+        self.motionBackend = self.settings.get('motionBackend', 'nipy')
+
+        dependents = [name for name in stageNames
+                      if PREPROCESSING_STAGES[name].usesMotionEstimates]
+        if self.asyncMotion and dependents:
+            self.logger.warning('asyncMotion is ignored when using {}'.format(
+                ', '.join(dependents)))
+            self.asyncMotion = False
+
+        self.motionProcessor = self.createMotionProcessor()
+
+    def createMotionProcessor(self):
+        """ Create the motion processor for the current series
+
+        Returns
+        -------
+        MotionProcessor or AsyncMotionProcessor
+            the asynchronous version if 'asyncMotion' is set
+
+        """
+        if self.asyncMotion:
+            motionLogFile = None
+            if self.settings.get('seriesOutputDir'):
+                motionLogFile = join(self.settings['seriesOutputDir'], 'motionLog.tsv')
+            return AsyncMotionProcessor(logger=self.logger, refVolIdx=4,
+                                        backend=self.motionBackend,
+                                        motionLogFile=motionLogFile,
+                                        motionCallback=self.preprocessor.reportMotion)
+        return MotionProcessor(logger=self.logger, refVolIdx=4,
+                               backend=self.motionBackend)
+
+    def run(self, vol, volIdx):
+        ### calculate the motion parameters on this volume. motionParams are
+        # returned as dictionary with keys for 'rms_abs', and 'rms_rel';
+        # NOTE: estimateMotion needs the input vol to be a nibabel nifti obj
+        # the nostdout bit suppresses verbose estimation output to stdOut
+        if self.asyncMotion:
+            # the worker process reports the motion params once it's done
+            self.motionProcessor.submitVolume(vol, self.preprocessor.affine, volIdx)
+        else:
+            with nostdout():
+                motionParams = self.motionProcessor.estimateMotion(
+                    nib.Nifti1Image(vol, self.preprocessor.affine),
+                    volIdx)
+            self.preprocessor.reportMotion(volIdx, motionParams)
+        return vol
+
+    def resetSeries(self):
+        self.motionProcessor = self.createMotionProcessor()
+
+    def saveResults(self):
+        if isinstance(self.motionProcessor, AsyncMotionProcessor):
+            self.motionProcessor.stop()
+
+
+class MotionCorrectionStage(PreprocessingStage):
+    """ Correct the voxels within the mask for the estimated motion """
+    name = 'motionCorrection'
+    requires = ('estimateMotion',)
+    altersVoxels = True
+    needsFullVolume = True
+    usesMotionEstimates = True
+
+    def __init__(self, preprocessor, stageNames):
+        super().__init__(preprocessor, stageNames)
+        mask = nib.load(self.settings['maskFile']).get_data() > 0
+        self.motionCorrector = MotionCorrector(mask)
+
+    def run(self, vol, volIdx):
+        """ Returns a copy of the volume (as floats), with the voxels within
+        the mask resampled to where they were in the reference volume
+        """
+        motionProcessor = self.preprocessor.get_stage('estimateMotion').motionProcessor
+        T = motionProcessor.get_transform()
+        maskedVol = self.motionCorrector.correct(vol, self.preprocessor.affine, T)
+        self.preprocessor.set_maskedVol(maskedVol, volIdx)
+
+        correctedVol = self.preprocessor.get_workBuffer(vol)
+        correctedVol[...] = vol
+        correctedVol[self.motionCorrector.maskIdx] = maskedVol
+        return correctedVol
+
+
+class SmoothingStage(PreprocessingStage):
+    """ Spatially smooth each volume with a Gaussian kernel
+
+    The kernel size is set by 'smoothingFWHM' (in mm; default 6).
+
+    """
+    name = 'smoothing'
+    altersVoxels = True
+    needsFullVolume = True
+
+    def __init__(self, preprocessor, stageNames):
+        super().__init__(preprocessor, stageNames)
+        self.fwhm = self.settings.get('smoothingFWHM', 6)
+
+    def run(self, vol, volIdx):
+        # the kernel width in voxels depends on the voxel size of the series
+        voxSize = np.linalg.norm(np.asarray(self.preprocessor.affine)[:3, :3], axis=0)
+        sigma = self.fwhm / np.sqrt(8 * np.log(2)) / voxSize
+
+        smoothedVol = self.preprocessor.get_workBuffer(vol)
+        gaussian_filter(vol, sigma, output=smoothedVol, mode='nearest')
+        return smoothedVol
+
+
+class RunningStatsStage(PreprocessingStage):
+    """ Normalize the voxels within the mask against their running statistics
+
+    The running mean and variance of each voxel within the mask
+    ('maskFile') are updated with every volume (see RunningStats), so the
+    cost per volume doesn't grow through the scan. Each volume is normalized
+    against the statistics of the volumes before it, as a z-score, or as
+    percent signal change ('runningStatsOutput': 'zscore' (default) or
+    'psc'). The normalized voxels are passed on to the analysis, and voxels
+    outside of the mask are set to 0.
+
+    Settings
+    --------
+    runningStatsBaseline : 'cumulative' (default), 'exponential', or 'window'
+        which volumes the statistics are computed over (see RunningStats)
+    runningStatsAlpha : float
+        weight of the newest volume, for 'exponential' (default 0.05)
+    runningStatsWindow : int
+        number of volumes, for 'window' (default 30)
+    runningStatsBaselineVols : int
+        if set, stop updating the statistics after this many volumes, so
+        later volumes are normalized against a fixed baseline
+
+    """
+    name = 'runningStats'
+    altersVoxels = True
+
+    def __init__(self, preprocessor, stageNames):
+        super().__init__(preprocessor, stageNames)
+        self.output = self.settings.get('runningStatsOutput', 'zscore')
+        if self.output not in ['zscore', 'psc']:
+            raise ValueError('Unrecognized runningStatsOutput: {}'.format(self.output))
+        self.baselineVols = self.settings.get('runningStatsBaselineVols')
+
+        mask = nib.load(self.settings['maskFile']).get_data() > 0
+        self.maskIdx = np.nonzero(mask)
+        self.nVoxels = len(self.maskIdx[0])
+        self.resetSeries()
+
+    def resetSeries(self):
+        self.stats = RunningStats(self.nVoxels,
+                                  baseline=self.settings.get('runningStatsBaseline', 'cumulative'),
+                                  alpha=self.settings.get('runningStatsAlpha', .05),
+                                  window=self.settings.get('runningStatsWindow', 30))
+
+    def run(self, vol, volIdx):
+        """ Returns the normalized volume, with the voxels outside of the mask
+        set to 0
+        """
+        maskedVol = self.preprocessor.get_maskedVol(volIdx)
+        if maskedVol is None:
+            maskedVol = vol[self.maskIdx]
+
+        # normalize against the previous volumes, then add this one
+        normalized = self.normalize(maskedVol)
+        if self.baselineVols is None or self.stats.count < self.baselineVols:
+            self.stats.update(maskedVol)
+        self.preprocessor.set_maskedVol(normalized, volIdx)
+
+        normalizedVol = self.preprocessor.get_workBuffer(vol)
+        normalizedVol[...] = 0
+        normalizedVol[self.maskIdx] = normalized
+        return normalizedVol
+
+    def normalize(self, maskedVol):
+        """ Normalize masked voxels against the current running statistics
+
+        Voxels without enough history to normalize against (e.g. on the first
+        volume, or with no variance) are set to 0.
+
+        """
+        mean = self.stats.mean
+        if self.output == 'zscore':
+            scale = np.sqrt(self.stats.var)
+        else:
+            scale = mean / 100
+        normalized = np.zeros(self.nVoxels)
+        np.divide(maskedVol - mean, scale, out=normalized, where=scale != 0)
+        return normalized
+
+
+class RunningStats():
+    """ Running mean and variance of a set of voxels, updated in place
+
+    Uses Welford's algorithm, so each update is O(1) per voxel however many
+    volumes have been added. The statistics can be computed over:
+
+    'cumulative': every volume so far
+    'exponential': every volume so far, with weights decaying by (1 - alpha)
+        per volume
+    'window': the last `window` volumes. The oldest volume is removed as each
+        new one is added, so the last `window` volumes are kept in a ring
+        buffer
+
+    """
+    def __init__(self, nVoxels, baseline='cumulative', alpha=.05, window=30):
+        """ Initialize the class
+
+        Parameters
+        ----------
+        nVoxels : int
+            number of voxels
+        baseline : string, optional
+            'cumulative', 'exponential', or 'window'
+        alpha : float, optional
+            weight of the newest volume, for 'exponential'
+        window : int, optional
+            number of volumes, for 'window'
+
+        """
+        if baseline not in ['cumulative', 'exponential', 'window']:
+            raise ValueError('Unrecognized running stats baseline: {}'.format(baseline))
+        self.baseline = baseline
+        self.alpha = alpha
+        self.window = window
+
+        self.count = 0
+        self.mean = np.zeros(nVoxels)
+        self.M2 = np.zeros(nVoxels)       # sum of squared differences from the mean
+        self.expVar = np.zeros(nVoxels)   # variance, for 'exponential'
+        if baseline == 'window':
+            self.history = np.zeros((window, nVoxels))
+
+    @property
+    def var(self):
+        """ Sample variance of each voxel (0 until there are 2 volumes) """
+        if self.baseline == 'exponential':
+            return self.expVar
+        n = min(self.count, self.window) if self.baseline == 'window' else self.count
+        if n < 2:
+            return np.zeros_like(self.M2)
+        return np.maximum(self.M2, 0) / (n - 1)
+
+    def update(self, x):
+        """ Add the voxel values from a new volume
+
+        Parameters
+        ----------
+        x : numpy array
+            1D array of voxel values
+
+        """
+        if self.baseline == 'exponential':
+            if self.count == 0:
+                self.mean[:] = x
+            else:
+                delta = x - self.mean
+                self.mean += self.alpha * delta
+                self.expVar[:] = (1 - self.alpha) * (self.expVar + self.alpha * delta**2)
+
+        elif self.baseline == 'window' and self.count >= self.window:
+            # swap the oldest volume in the window for the new one
+            slot = self.count % self.window
+            oldest = self.history[slot].copy()
+            oldMean = self.mean.copy()
+            self.mean += (x - oldest) / self.window
+            self.M2 += (x - oldest) * (x - self.mean + oldest - oldMean)
+            self.history[slot] = x
+
+        else:
+            n = self.count + 1
+            delta = x - self.mean
+            self.mean += delta / n
+            self.M2 += delta * (x - self.mean)
+            if self.baseline == 'window':
+                self.history[self.count] = x
+        self.count += 1
+
+
+class NuisanceRegressionStage(PreprocessingStage):
+    """ Regress nuisance signals out of the voxels within the mask
+
+    A GLM with nuisance regressors is fit to the signal within the mask
+    ('maskFile'), and refit with every volume. The fit is kept as sufficient
+    statistics (see OnlineGLM), so each refit takes the same time however
+    far into the scan it is. The fitted nuisance signal is subtracted from
+    each volume, with the mean (intercept) kept, so the cleaned signal stays
+    in the original units.
+
+    The regressors are an intercept, a linear drift, 'nuisanceCosines'
+    low-frequency cosines (default 3; the first terms of a discrete cosine
+    basis over 'numTimepts' volumes), and, if motion is estimated in an
+    earlier stage, the 6 rigid-body motion parameters (mm and degrees).
+
+    With 'nuisanceLevel' set to 'roi' (default), the fit is to the mean signal
+    within the mask (weighted, if 'maskIsWeighted'), and the same nuisance
+    signal is subtracted from every voxel, so the mean over the mask is the
+    cleaned ROI signal. With 'voxel', each voxel is fit separately.
+
+    """
+    name = 'nuisanceRegression'
+    altersVoxels = True
+    usesMotionEstimates = True
+
+    def __init__(self, preprocessor, stageNames):
+        super().__init__(preprocessor, stageNames)
+        self.level = self.settings.get('nuisanceLevel', 'roi')
+        if self.level not in ['roi', 'voxel']:
+            raise ValueError('Unrecognized nuisanceLevel: {}'.format(self.level))
+
+        maskData = nib.load(self.settings['maskFile']).get_data()
+        self.maskIdx = np.nonzero(maskData > 0)
+        if self.settings.get('maskIsWeighted', False):
+            weights = maskData[self.maskIdx].astype(np.float64)
+        else:
+            weights = np.ones(len(self.maskIdx[0]))
+        self.weights = weights / weights.sum()
+
+        # low-frequency cosines need the length of the series
+        self.nCosines = self.settings.get('nuisanceCosines', 3)
+        if self.nCosines and not self.settings.get('numTimepts'):
+            self.logger.warning('numTimepts is not set; not including cosine regressors')
+            self.nCosines = 0
+
+        # motion regressors need motion estimated in an earlier stage
+        self.motionStage = preprocessor.get_stage('estimateMotion')
+        if self.motionStage is None:
+            self.logger.warning('motion is not estimated before {}; not including motion regressors'.format(
+                self.name))
+
+        self.resetSeries()
+
+    def resetSeries(self):
+        nRegressors = 2 + self.nCosines + (6 if self.motionStage else 0)
+        nSignals = 1 if self.level == 'roi' else len(self.maskIdx[0])
+        self.glm = OnlineGLM(nRegressors, nSignals)
+
+    def regressors(self, volIdx):
+        """ Return the nuisance regressors for a volume
+
+        Parameters
+        ----------
+        volIdx : int
+            0-based index of the volume
+
+        Returns
+        -------
+        numpy array
+            1D array of regressor values, starting with the intercept
+
+        """
+        x = [1.0, volIdx]
+        if self.nCosines:
+            n = self.settings['numTimepts']
+            k = np.arange(1, self.nCosines + 1)
+            x.extend(np.cos(np.pi * k * (volIdx + .5) / n))
+        if self.motionStage:
+            T = self.motionStage.motionProcessor.get_transform()
+            params = rigidParams(T)
+            x.extend(params[:3])
+            x.extend(np.rad2deg(params[3:]))
+        return np.array(x)
+
+    def run(self, vol, volIdx):
+        """ Returns a copy of the volume (as floats), with the voxels within
+        the mask cleaned
+        """
+        maskedVol = self.preprocessor.get_maskedVol(volIdx)
+        if maskedVol is None:
+            maskedVol = vol[self.maskIdx]
+
+        x = self.regressors(volIdx)
+        if self.level == 'roi':
+            signal = np.atleast_1d(self.weights.dot(maskedVol))
+        else:
+            signal = maskedVol
+        self.glm.update(x, signal)
+
+        # subtract the fit, apart from the intercept
+        nuisance = x[1:].dot(self.glm.beta[1:])
+        cleaned = maskedVol - nuisance
+        self.preprocessor.set_maskedVol(cleaned, volIdx)
+
+        cleanedVol = self.preprocessor.get_workBuffer(vol)
+        cleanedVol[...] = vol
+        cleanedVol[self.maskIdx] = cleaned
+        return cleanedVol
+
+
+class OnlineGLM():
+    """ GLM fit that is updated one observation at a time
+
+    Keeps the sufficient statistics of the fit, X'X and X'Y, so adding an
+    observation, and refitting, doesn't depend on how many observations came
+    before. Every signal is fit with the same regressors, so X'X is shared.
+
+    """
+    def __init__(self, nRegressors, nSignals):
+        """ Initialize the class
+
+        Parameters
+        ----------
+        nRegressors : int
+            number of regressors (columns of the design matrix)
+        nSignals : int
+            number of signals to fit
+
+        """
+        self.XtX = np.zeros((nRegressors, nRegressors))
+        self.XtY = np.zeros((nRegressors, nSignals))
+        self.beta = np.zeros((nRegressors, nSignals))
+
+    def update(self, x, y):
+        """ Add an observation and refit
+
+        Until there are as many (independent) observations as regressors, the
+        least-squares fit isn't unique, and the minimum norm fit is used.
+
+        Parameters
+        ----------
+        x : numpy array
+            1D array of regressor values
+        y : numpy array
+            1D array with the value of each signal
+
+        """
+        self.XtX += np.outer(x, x)
+        self.XtY += np.outer(x, y)
+        self.beta = np.linalg.pinv(self.XtX, hermitian=True).dot(self.XtY)
+
+
+# Preprocessing stages, by the name used in the 'preprocessingStages' setting
+PREPROCESSING_STAGES = {stage.name: stage for stage in [MotionEstimationStage,
+                                                        MotionCorrectionStage,
+                                                        SmoothingStage,
+                                                        RunningStatsStage,
+                                                        NuisanceRegressionStage]}
+
+
 class MotionProcessor():
     """ Tool to estimate motion during a real-time run.
 
@@ -146,7 +888,7 @@ class MotionProcessor():
     https://www.sciencedirect.com/science/article/pii/S1053811917306729#bib32
 
     """
-    def __init__(self, logger=None, refVolIdx=4):
+    def __init__(self, logger=None, refVolIdx=4, backend='nipy'):
         """ Initialize the class
 
         Parameters
@@ -156,15 +898,26 @@ class MotionProcessor():
         refVolIdx : int, optional
             The index of the volume to make absolute motion estimates relative
             to. 0-based index (default: 4)
+        backend : {'nipy', 'numpy'}, optional
+            registration engine: nipy's HistogramRegistration, or the NumPy
+            least-squares RigidRegistration (default: 'nipy')
 
         """
+        if backend not in ('nipy', 'numpy'):
+            raise ValueError('Unrecognized motion backend: {}'.format(backend))
         self.logger = logger
         self.refVolIdx = refVolIdx
+        self.backend = backend
         self.refVol = None
+        self.refReg = None      # registration to the reference vol
 
-        # initialize
-        self.refVol_T = Rigid(np.eye(4))
-        self.prevVol_T = Rigid(np.eye(4))
+        # initialize. The numpy backend works with plain 4x4 affines
+        if self.backend == 'numpy':
+            self.refVol_T = np.eye(4)
+            self.prevVol_T = np.eye(4)
+        else:
+            self.refVol_T = Rigid(np.eye(4))
+            self.prevVol_T = Rigid(np.eye(4))
 
     def estimateMotion(self, niiVol, volIdx):
         """ Estimate the motion parameters for the current volume.
@@ -199,14 +952,22 @@ class MotionProcessor():
 
         elif volIdx == self.refVolIdx:
             self.refVol = niiVol            # set the reference volume
+
+            # everything derived from the reference vol is only computed once
+            if self.backend == 'numpy':
+                self.refReg = RigidRegistration(self.refVol)
+            else:
+                self.refReg = ReferenceRegistration(self.refVol, interp='tri')
             return None
 
         elif volIdx > self.refVolIdx:
-            # create a regisitration object
-            reg = HistogramRegistration(niiVol, self.refVol, interp='tri')
-
-            # estimate optimal transformation
-            T = reg.optimize(self.prevVol_T.copy(), ftol=0.1, maxfun=30)
+            # estimate optimal transformation to the reference vol, starting
+            # from the estimate for the previous vol
+            if self.backend == 'numpy':
+                T = self.refReg.register(niiVol, self.prevVol_T)
+            else:
+                self.refReg.set_from_img(niiVol)
+                T = self.refReg.optimize(self.prevVol_T.copy(), ftol=0.1, maxfun=30)
 
             # compute RMS relative to reference vol (rms abs)
             rms_abs = self.computeRMS(self.refVol_T, T)
@@ -225,12 +986,27 @@ class MotionProcessor():
                             'rms_rel': rms_rel}
             return motionParams
 
+    def get_transform(self):
+        """ Return the transformation estimated for the latest volume
+
+        Returns
+        -------
+        (4,4) numpy array
+            rigid-body transformation from the latest volume to the reference
+            volume, in world coordinates (identity until the reference volume
+            has arrived)
+
+        """
+        if hasattr(self.prevVol_T, 'as_affine'):
+            return self.prevVol_T.as_affine()
+        return self.prevVol_T
+
     def computeRMS(self, T1, T2, R=50):
         """ Compute the RMS displacement between transformation matrices.
 
         Parameters
         ----------
-        T1,T2 : nipy Rigid object
+        T1,T2 : nipy Rigid object or (4,4) numpy array
             Transformation matrices
         R : int, optional
             radius (in mm) from center of head to cerebral cortex. Defaults to
@@ -255,7 +1031,9 @@ class MotionProcessor():
         https://www.fmrib.ox.ac.uk/datasets/techrep/tr99mj1/tr99mj1.pdf
 
         """
-        diffMatrix = T1.as_affine().dot(np.linalg.inv(T2.as_affine())) - np.eye(4)
+        if hasattr(T1, 'as_affine'):
+            T1, T2 = T1.as_affine(), T2.as_affine()
+        diffMatrix = T1.dot(np.linalg.inv(T2)) - np.eye(4)
 
         # decompose into A and t components
         A = diffMatrix[:3, :3]
@@ -271,10 +1049,326 @@ class MotionProcessor():
         return rms
 
 
+class MotionCorrector():
+    """ Tool to correct the voxels within a mask for head motion
+
+    The voxel coordinates of the mask are computed once. For each volume, they
+    are mapped through the estimated motion, and the volume is sampled there
+    with trilinear interpolation, so only the mask voxels are resampled.
+
+    """
+    def __init__(self, mask):
+        """ Initialize the class
+
+        Parameters
+        ----------
+        mask : numpy-array
+            3D boolean array, True for the voxels to correct
+
+        """
+        self.maskIdx = np.nonzero(mask)
+        self.maskCoords = np.array(self.maskIdx, dtype=np.float64)
+
+    def correct(self, vol, affine, T):
+        """ Resample the mask voxels of a volume to undo the estimated motion
+
+        Parameters
+        ----------
+        vol : numpy-array
+            3D array of voxel data for the current volume
+        affine : (4,4) numpy array-like
+            affine matrix mapping the volume to RAS+ space
+        T : (4,4) numpy array
+            rigid-body transformation from the current volume to the reference
+            volume, in world coordinates
+
+        Returns
+        -------
+        numpy-array
+            1D array of the corrected voxels within the mask (in the same order
+            as vol[mask])
+
+        """
+        # the reference location of each mask voxel came from T^-1 of it
+        affine = np.asarray(affine)
+        voxToVox = np.linalg.inv(affine).dot(np.linalg.inv(T)).dot(affine)
+        voxCoords = voxToVox[:3, :3].dot(self.maskCoords) + voxToVox[:3, [3]]
+        samples, valid = trilinear(vol[..., np.newaxis], voxCoords)
+        return samples[:, 0]
+
+
+class AsyncMotionProcessor():
+    """ Tool to estimate motion in a separate worker process
+
+    Volumes are copied into a set of slots in shared memory, and estimated in
+    order by a `MotionProcessor` in the worker process. A thread in this
+    process collects the results, writes them to the motion log, and passes
+    them on to `motionCallback`. If the worker falls behind and every slot
+    is in use, volumes are skipped (except for the reference volume) rather
+    than holding up the caller.
+
+    """
+    def __init__(self, logger=None, refVolIdx=4, backend='nipy',
+                 motionLogFile=None, motionCallback=None, nSlots=4):
+        """ Initialize the class
+
+        Parameters
+        ----------
+        logger : logger object, optional
+            reference to the logger object where you want to write log messages
+        refVolIdx : int, optional
+            The index of the volume to make absolute motion estimates relative
+            to. 0-based index (default: 4)
+        backend : {'nipy', 'numpy'}, optional
+            registration engine used by the worker (default: 'nipy')
+        motionLogFile : string, optional
+            full path to the tab-separated file to write the motion estimates to
+        motionCallback : function, optional
+            called as motionCallback(volIdx, motionParams) as each estimate
+            comes back from the worker process
+        nSlots : int, optional
+            number of volumes that can be waiting on the worker process
+
+        """
+        self.logger = logger
+        self.refVolIdx = refVolIdx
+        self.backend = backend
+        self.motionLogFile = motionLogFile
+        self.motionCallback = motionCallback
+        self.nSlots = nSlots
+
+        # the worker process starts with the first volume, once the volume
+        # dims are known
+        self.worker = None
+        self.collector = None
+        self.volSlots = None
+        self.freeSlots = queue.Queue()
+
+    def startWorker(self, volShape, dtype):
+        """ Allocate the shared memory slots, and start the worker process
+
+        Parameters
+        ----------
+        volShape : tuple
+            dimensions (x, y, z) of each volume
+        dtype : numpy dtype
+            datatype of the voxel array
+
+        """
+        # spawn rather than fork, since this process is running other threads
+        ctx = multiprocessing.get_context('spawn')
+        volBytes = int(np.prod(volShape)) * np.dtype(dtype).itemsize
+        volBuffer = ctx.RawArray('b', self.nSlots * volBytes)
+        self.volSlots = np.frombuffer(volBuffer, dtype=dtype).reshape(
+            (self.nSlots,) + tuple(volShape))
+        for slotIdx in range(self.nSlots):
+            self.freeSlots.put(slotIdx)
+
+        self.taskQ = ctx.Queue()
+        self.resultQ = ctx.Queue()
+        self.worker = ctx.Process(target=estimateMotionWorker,
+                                  args=(self.taskQ, self.resultQ, volBuffer,
+                                        tuple(volShape), np.dtype(dtype).str,
+                                        self.refVolIdx, self.backend),
+                                  daemon=True)
+        self.worker.start()
+
+        self.collector = Thread(target=self.collectResults, daemon=True)
+        self.collector.start()
+
+    def submitVolume(self, vol, affine, volIdx):
+        """ Queue a volume for motion estimation, without waiting on the result
+
+        Parameters
+        ----------
+        vol : numpy-array
+            3D array of voxel data for the current volume
+        affine : (4,4) numpy array-like
+            affine matrix mapping the current series to RAS+ space
+        volIdx : int
+            the 0-based index of the current volume along the 4th dim
+
+        """
+        if volIdx < self.refVolIdx:
+            return
+        if self.worker is None:
+            self.startWorker(vol.shape, vol.dtype)
+
+        try:
+            # every later estimate needs the reference vol, so wait for it
+            slotIdx = self.freeSlots.get(block=(volIdx == self.refVolIdx))
+        except queue.Empty:
+            if self.logger:
+                self.logger.debug('motion worker busy, skipping volIdx {}'.format(volIdx))
+            return
+        self.volSlots[slotIdx] = vol
+        self.taskQ.put((volIdx, slotIdx, np.asarray(affine)))
+
+    def collectResults(self):
+        """ Handle motion estimates from the worker (runs in its own thread) """
+        motionLog = None
+        if self.motionLogFile is not None:
+            motionLog = open(self.motionLogFile, 'w')
+            motionLog.write('volIdx\trms_abs\trms_rel\n')
+        try:
+            while True:
+                result = self.resultQ.get()
+                if result is None:
+                    break
+                volIdx, slotIdx, motionParams, error = result
+                self.freeSlots.put(slotIdx)
+
+                if error is not None:
+                    if self.logger:
+                        self.logger.error('motion estimation failed for volIdx {}: {}'.format(
+                            volIdx, error))
+                    continue
+                if motionParams is None:
+                    continue
+                if motionLog is not None:
+                    motionLog.write('{}\t{:.6f}\t{:.6f}\n'.format(
+                        volIdx, motionParams['rms_abs'], motionParams['rms_rel']))
+                    motionLog.flush()
+                if self.logger:
+                    self.logger.debug('volIdx {} motion: rms_abs {:.4f}, rms_rel {:.4f}'.format(
+                        volIdx, motionParams['rms_abs'], motionParams['rms_rel']))
+                if self.motionCallback is not None:
+                    self.motionCallback(volIdx, motionParams)
+        finally:
+            if motionLog is not None:
+                motionLog.close()
+
+    def stop(self, timeout=10):
+        """ Wait for any queued volumes to be estimated, then stop the worker
+
+        If the worker hasn't finished within `timeout` seconds (e.g. it
+        crashed, or is stuck in a registration), it is terminated, and only
+        the estimates collected so far are kept.
+
+        """
+        if self.worker is None:
+            return
+        self.taskQ.put(None)
+        self.worker.join(timeout)
+        if self.worker.is_alive():
+            if self.logger:
+                self.logger.warning('motion worker did not finish within {}s; terminating it'.format(
+                    timeout))
+            self.worker.terminate()
+            self.worker.join()
+
+        # a worker that didn't finish never told the collector it was done
+        self.resultQ.put(None)
+        self.collector.join()
+        self.worker = None
+
+
+def estimateMotionWorker(taskQ, resultQ, volBuffer, volShape, dtype, refVolIdx,
+                         backend='nipy'):
+    """ Estimate motion for each queued volume (runs in the worker process)
+
+    Parameters
+    ----------
+    taskQ : multiprocessing Queue
+        (volIdx, slotIdx, affine) for each volume to estimate, followed by
+        None when there are no more volumes
+    resultQ : multiprocessing Queue
+        (volIdx, slotIdx, motionParams, error) is put here for each volume,
+        and then None once the worker is done
+    volBuffer : multiprocessing RawArray
+        shared memory holding the volume slots
+    volShape : tuple
+        dimensions (x, y, z) of each volume
+    dtype : string
+        datatype of the voxel array
+    refVolIdx : int
+        the index of the reference volume
+    backend : {'nipy', 'numpy'}, optional
+        registration engine to use
+
+    """
+    volSlots = np.frombuffer(volBuffer, dtype=dtype).reshape((-1,) + volShape)
+    motionProcessor = MotionProcessor(refVolIdx=refVolIdx, backend=backend)
+    while True:
+        task = taskQ.get()
+        if task is None:
+            break
+        volIdx, slotIdx, affine = task
+
+        # the reference vol is kept, so don't hold on to the slot
+        niiVol = nib.Nifti1Image(volSlots[slotIdx].copy(), affine)
+        try:
+            with nostdout():
+                motionParams = motionProcessor.estimateMotion(niiVol, volIdx)
+            resultQ.put((volIdx, slotIdx, motionParams, None))
+        except Exception as e:
+            resultQ.put((volIdx, slotIdx, None, repr(e)))
+    resultQ.put(None)
+
+
+class ReferenceRegistration(HistogramRegistration):
+    """ Histogram registration of a series of volumes to a fixed reference
+
+    nipy's HistogramRegistration prepares both images every time it is
+    created: the `to` image is clamped and padded, and the `from` image is
+    clamped and subsampled, with the subsampling grid and voxel coordinates
+    worked out from scratch. Here, the reference volume is the `to` image, and
+    is only prepared once. For each new volume, `set_from_img` clamps the
+    volume and picks out the subsampled voxels using the grid from the
+    reference volume, which gives the same result as a new
+    HistogramRegistration of that volume to the reference.
+
+    """
+    def __init__(self, refVol, **kwargs):
+        """ Initialize the class
+
+        Parameters
+        ----------
+        refVol : nibabel-like image
+            3D reference volume, that every later volume will be registered to
+        **kwargs
+            any other arguments to HistogramRegistration (e.g. `interp`)
+
+        """
+        self.fovSlicer = None
+        super().__init__(refVol, refVol, **kwargs)
+        self.refAffine = xyz_affine(self._from_img)
+
+    def subsample(self, spacing=None, npoints=None):
+        """ Subsample the `from` image, keeping track of the grid used """
+        if spacing is None:
+            if npoints is None:
+                spacing = [1, 1, 1]
+            else:
+                spacing = ideal_spacing(self._from_img.get_fdata(), npoints=npoints)
+        self.set_fov(spacing=spacing)
+        self.fovSlicer = self._slicer((0, 0, 0), self._from_img.shape, spacing)
+
+    def set_from_img(self, niiVol):
+        """ Set the volume to be registered to the reference volume
+
+        Parameters
+        ----------
+        niiVol : nibabel-like image
+            3D volume with the same dimensions and affine as the reference
+
+        """
+        fromImg = as_xyz_image(niiVol)
+        data, _ = clamp(fromImg.get_fdata(), self._joint_hist.shape[0])
+        if (data.shape != self._from_img.shape
+                or not np.allclose(xyz_affine(fromImg), self.refAffine)):
+            raise ValueError('volume does not match the reference volume')
+
+        # `from` data is the subsampled clamped volume
+        self._from_data = data[self.fovSlicer]
+
+
 # suppress stdOut from verbose functions
 @contextlib.contextmanager
 def nostdout():
     save_stdout = sys.stdout
     sys.stdout = io.StringIO()
-    yield
-    sys.stdout = save_stdout
+    try:
+        yield
+    finally:
+        sys.stdout = save_stdout
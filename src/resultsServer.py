@@ -150,6 +150,18 @@ class ResultsServer(Thread):
         self.results[str(volIdx)] = volResults
         self.logger.debug('volIdx {} added to resultsServer : {}'.format(volIdx, volResults))
 
+    def resetSeries(self, seriesOutputDir):
+        """ Get ready to serve results for the next series (session mode)
+
+        Parameters
+        ----------
+        seriesOutputDir : string
+            full path to the output directory for the next series
+
+        """
+        self.results = {}
+        self.seriesOutputDir = seriesOutputDir
+
     def requestLookup(self, volIdx):
         """ Lookup results for the requested volume
 
@@ -0,0 +1,294 @@
+""" Rigid-body registration of volumes to a fixed reference volume
+
+A NumPy-only alternative to nipy's HistogramRegistration for estimating head
+motion during a real-time run. Each volume is registered to the reference
+volume by minimizing the sum of squared intensity differences with
+Gauss-Newton, on a coarse-to-fine image pyramid. Everything derived from the
+reference volume (the pyramid, and its intensity gradients) is computed once.
+
+The transformation follows the same convention as nipy: a 4x4 affine mapping
+world (mm) coordinates in the volume being registered to world coordinates in
+the reference volume.
+
+"""
+import numpy as np
+
+
+class RigidRegistration():
+    """ Register volumes to a reference volume with a rigid-body transform
+
+    """
+    def __init__(self, refVol, nLevels=2, maxIter=10, tol=1e-3, npoints=32**3):
+        """ Initialize the class
+
+        Parameters
+        ----------
+        refVol : nibabel-like image
+            3D reference volume, that every later volume will be registered to
+        nLevels : int, optional
+            number of levels in the image pyramid. Each level is half the
+            resolution of the one below it
+        maxIter : int, optional
+            maximum number of Gauss-Newton iterations at each level
+        tol : float, optional
+            stop iterating once the update is smaller than this (in mm, for
+            the translations, and radians, for the rotations)
+        npoints : int, optional
+            maximum number of voxels to sample from each volume, per level
+
+        """
+        self.nLevels = nLevels
+        self.maxIter = maxIter
+        self.tol = tol
+        self.npoints = npoints
+
+        # reference pyramid, coarsest level first. Each level holds the
+        # reference data, stacked with its gradients in world coordinates
+        self.refLevels = []
+        for data, affine in buildPyramid(np.asarray(refVol.get_fdata()),
+                                         refVol.affine, nLevels):
+            voxGrads = np.gradient(data) if min(data.shape) > 1 else [np.zeros_like(data)] * 3
+            toWorld = np.linalg.inv(affine[:3, :3]).T
+            worldGrads = np.tensordot(toWorld, np.stack(voxGrads), axes=1)
+            samples = np.stack([data] + list(worldGrads), axis=-1)
+            self.refLevels.append({'samples': samples,
+                                   'invAffine': np.linalg.inv(affine)})
+
+        # rotations are about the center of the reference volume
+        center = (np.array(refVol.shape[:3]) - 1) / 2
+        self.center = refVol.affine[:3, :3].dot(center) + refVol.affine[:3, 3]
+
+    def register(self, niiVol, T=None):
+        """ Estimate the transformation from a volume to the reference volume
+
+        Parameters
+        ----------
+        niiVol : nibabel-like image
+            3D volume to register
+        T : (4,4) numpy array, optional
+            initial estimate of the transformation (e.g. from the previous
+            volume). Defaults to the identity
+
+        Returns
+        -------
+        T : (4,4) numpy array
+            rigid-body transformation from world coordinates in `niiVol` to
+            world coordinates in the reference volume
+
+        """
+        T = np.eye(4) if T is None else np.array(T, dtype=float)
+        movLevels = buildPyramid(np.asarray(niiVol.get_fdata()), niiVol.affine,
+                                 self.nLevels)
+
+        for (movData, movAffine), refLevel in zip(movLevels, self.refLevels):
+            # world coordinates and intensities of the sampled moving voxels
+            spacing = samplingSpacing(movData.shape, self.npoints)
+            sampled = movData[::spacing[0], ::spacing[1], ::spacing[2]]
+            voxCoords = np.indices(sampled.shape).reshape(3, -1) * spacing[:, np.newaxis]
+            movCoords = movAffine[:3, :3].dot(voxCoords) + movAffine[:3, [3]]
+            movValues = sampled.ravel()
+
+            for i in range(self.maxIter):
+                delta = self.gaussNewtonStep(T, movCoords, movValues, refLevel)
+                if delta is None:
+                    break
+                T = rigidMatrix(delta, self.center).dot(T)
+                if np.abs(delta).max() < self.tol:
+                    break
+        return T
+
+    def gaussNewtonStep(self, T, movCoords, movValues, refLevel):
+        """ Compute the update to the transformation for one iteration
+
+        The update is a small rigid-body motion (in the reference world
+        coordinates, about `center`), applied after the current `T`.
+
+        Parameters
+        ----------
+        T : (4,4) numpy array
+            current estimate of the transformation
+        movCoords : (3, N) numpy array
+            world coordinates of the sampled voxels in the moving volume
+        movValues : (N,) numpy array
+            intensities of the sampled voxels in the moving volume
+        refLevel : dict
+            reference pyramid level, with 'samples' and 'invAffine' entries
+
+        Returns
+        -------
+        delta : (6,) numpy array or None
+            update (translation x,y,z; rotation x,y,z), or None if too few
+            voxels overlap with the reference volume
+
+        """
+        refCoords = T[:3, :3].dot(movCoords) + T[:3, [3]]
+        refVox = refLevel['invAffine'][:3, :3].dot(refCoords) + refLevel['invAffine'][:3, [3]]
+        samples, valid = trilinear(refLevel['samples'], refVox)
+        if valid.sum() < 6:
+            return None
+
+        residuals = samples[valid, 0] - movValues[valid]
+        grads = samples[valid, 1:].T
+        offsets = refCoords[:, valid] - self.center[:, np.newaxis]
+
+        # d(residual)/d(translation) is the gradient; for a small rotation w,
+        # the displacement is w x offset, so d(residual)/dw = offset x grad
+        J = np.concatenate([grads, np.cross(offsets, grads, axis=0)]).T
+        JtJ = J.T.dot(J)
+        JtJ[np.diag_indices(6)] *= 1 + 1e-6
+        try:
+            return -np.linalg.solve(JtJ, J.T.dot(residuals))
+        except np.linalg.LinAlgError:
+            return None
+
+
+def buildPyramid(data, affine, nLevels):
+    """ Build an image pyramid by repeated 2x2x2 block averaging
+
+    Parameters
+    ----------
+    data : numpy array
+        3D voxel data
+    affine : (4,4) numpy array
+        affine mapping voxel coordinates to world coordinates
+    nLevels : int
+        number of levels
+
+    Returns
+    -------
+    list
+        (data, affine) for each level, coarsest first
+
+    """
+    levels = [(data.astype(np.float64), affine)]
+    for level in range(1, nLevels):
+        data, affine = levels[-1]
+        factors = [2 if dim >= 4 else 1 for dim in data.shape]
+        shape = [dim // f for dim, f in zip(data.shape, factors)]
+        data = data[:shape[0] * factors[0], :shape[1] * factors[1], :shape[2] * factors[2]]
+        data = data.reshape(shape[0], factors[0], shape[1], factors[1],
+                            shape[2], factors[2]).mean(axis=(1, 3, 5))
+
+        # coarse voxel i is centered between fine voxels f*i, ..., f*i + f-1
+        scaling = np.diag(factors + [1]).astype(float)
+        scaling[:3, 3] = (np.array(factors) - 1) / 2
+        levels.append((data, affine.dot(scaling)))
+    return levels[::-1]
+
+
+def samplingSpacing(shape, npoints):
+    """ Return the voxel spacing for sampling at most `npoints` voxels """
+    spacing = np.ones(3, dtype=int)
+    while np.prod(-(-np.array(shape) // spacing)) > npoints:
+        spacing[np.argmax(np.array(shape) / spacing)] += 1
+    return spacing
+
+
+def trilinear(vols, voxCoords):
+    """ Sample volumes at (non-integer) voxel coordinates
+
+    Parameters
+    ----------
+    vols : (X, Y, Z, k) numpy array
+        stack of k volumes to sample, all with the same dimensions, with the
+        volumes along the last axis so each voxel's values are adjacent
+    voxCoords : (3, N) numpy array
+        voxel coordinates to sample at
+
+    Returns
+    -------
+    samples : (N, k) numpy array
+        interpolated values (coordinates outside of the volumes are clipped to
+        the edge)
+    valid : (N,) numpy array
+        boolean array, True for coordinates within the volumes
+
+    """
+    shape = np.array(vols.shape[:3])
+    maxCoords = (shape - 1)[:, np.newaxis]
+    valid = np.all((voxCoords >= 0) & (voxCoords <= maxCoords), axis=0)
+    coords = np.clip(voxCoords, 0, maxCoords)
+
+    # lower corner of the surrounding cell, kept one voxel from the far edge
+    # so that the upper corner is always in the volume
+    lower = np.minimum(coords.astype(np.intp), np.maximum(shape - 2, 0)[:, np.newaxis])
+    frac = coords - lower
+
+    # flat view onto the voxels. Volumes that aren't contiguous (e.g. a
+    # volume in a 4D image matrix) are viewed using their strides, so they
+    # can be sampled without copying them
+    if vols.flags['C_CONTIGUOUS']:
+        flatVols = vols.reshape(-1, vols.shape[3])
+        voxStrides = np.array([shape[1] * shape[2], shape[2], 1])
+    else:
+        if min(vols.strides[:3]) <= 0:
+            vols = np.ascontiguousarray(vols)
+        voxStrides = np.array(vols.strides[:3]) // vols.itemsize
+        flatVols = np.lib.stride_tricks.as_strided(
+            vols, shape=(int(voxStrides.dot(shape - 1)) + 1, vols.shape[3]),
+            strides=(vols.itemsize, vols.strides[3]), writeable=False)
+    steps = voxStrides * (shape > 1)
+    base = steps.dot(lower)
+
+    samples = np.zeros((voxCoords.shape[1], vols.shape[3]))
+    for corner in range(8):
+        bits = [(corner >> axis) & 1 for axis in range(3)]
+        weight = ((frac[0] if bits[0] else 1 - frac[0])
+                  * (frac[1] if bits[1] else 1 - frac[1])
+                  * (frac[2] if bits[2] else 1 - frac[2]))
+        cornerVals = np.take(flatVols, base + steps.dot(bits), axis=0)
+        samples += cornerVals * weight[:, np.newaxis]
+    return samples, valid
+
+
+def rigidMatrix(params, center=np.zeros(3)):
+    """ Build the 4x4 affine for a rigid-body motion
+
+    Parameters
+    ----------
+    params : (6,) numpy array
+        translation x,y,z (mm), and rotation vector x,y,z (radians)
+    center : (3,) numpy array, optional
+        point (in world coordinates) to rotate about
+
+    Returns
+    -------
+    (4,4) numpy array
+
+    """
+    rotVec = np.asarray(params[3:], dtype=float)
+    angle = np.linalg.norm(rotVec)
+    R = np.eye(3)
+    if angle > 0:
+        axis = rotVec / angle
+        K = np.array([[0, -axis[2], axis[1]],
+                      [axis[2], 0, -axis[0]],
+                      [-axis[1], axis[0], 0]])
+        R = R + np.sin(angle) * K + (1 - np.cos(angle)) * K.dot(K)
+    M = np.eye(4)
+    M[:3, :3] = R
+    M[:3, 3] = np.asarray(params[:3]) + center - R.dot(center)
+    return M
+
+
+def rigidParams(M):
+    """ Recover the parameters of a rigid-body motion (inverse of rigidMatrix)
+
+    Parameters
+    ----------
+    M : (4,4) numpy array
+        rigid-body affine
+
+    Returns
+    -------
+    params : (6,) numpy array
+        translation x,y,z (mm), and rotation vector x,y,z (radians), with the
+        rotation about the origin
+
+    """
+    R = np.asarray(M)[:3, :3]
+    skew = np.array([R[2, 1] - R[1, 2], R[0, 2] - R[2, 0], R[1, 0] - R[0, 1]]) / 2
+    sinAngle = np.linalg.norm(skew)
+    angle = np.arctan2(sinAngle, (np.trace(R) - 1) / 2)
+    rotVec = skew if sinAngle < 1e-12 else skew * angle / sinAngle
+    return np.r_[np.asarray(M)[:3, 3], rotVec]
@@ -8,7 +8,9 @@ This tool is designed to be run in a separate thread, where it will:
     4D matrix for the entire san
 
 In additiona, it also includes various methods for accessing the progress of an
-on-going scan, and returning data that has successfully arrived, etc.
+on-going scan, and returning data that has successfully arrived, etc. Rather
+than polling for new data, other threads can block on the `scan_started` event,
+or on `wait_for_vol`, and will be woken as soon as the data has arrived.
 
 Notes for setting up:
 ** Socket Connection:
@@ -35,6 +37,43 @@ There should be two parts to each volume transmission:
 Once both of those peices of data have arrived, this tool will send back a
 confirmation string message.
 
+The format above is version 1 of the transfer protocol. Since the series
+metadata never changes within a series, version 2 sends it only once:
+    1. Before the first volume, a JSON series header containing the dict keys
+        'protocolVersion', 'TR', 'dtype', 'shape', and 'affine' (formatted as
+        above). This tool replies with 'received seriesHeader'
+    2. Then, for each volume, a fixed-size binary header packed with the struct
+        format VOL_HEADER_FORMAT (magic, volIdx, flags, timestamp), followed by
+        the voxel array.
+This tool accepts either version, and tells them apart by the first byte of
+the header ('{' for JSON). A message that can't be handled (e.g. a header it
+doesn't recognize, or a volume before the series header) is discarded, and
+gets a reply of 'error: <reason>' instead of a confirmation.
+
+** Slice Streaming:
+With version 2, pyneal_scanner can also stream individual slices as soon as
+they are available (see the 'pynealSliceStreaming' scanner setting). The series
+header then has an additional 'sliceAxis' key, giving the axis of the RAS+
+volume that the slices are stacked along. Each slice is preceded by a binary
+slice header packed with SLICE_HEADER_FORMAT (magic, volIdx, flags, timestamp,
+sliceIdx), and followed by the 2D voxel array of the slice. Completion is
+tracked per slice, and a volume counts as complete once all of its slices have
+arrived. Other threads can use `wait_for_slices` (e.g. with the slices returned
+by `get_maskSlices`) to start working on a volume before the rest of it has
+arrived.
+
+** Compression:
+With version 2, pyneal_scanner can propose a lossless codec for the voxel data
+by adding a 'compression' key to the series header. If the codec is one of
+COMPRESSION_CODECS, this tool accepts it by replying with
+'received seriesHeader compression=<codec>' ('zlib-delta' is declined if
+the ring buffer holds fewer than 2 volumes). Compressed payloads are flagged
+with VOL_FLAG_ZLIB in their binary header, and delta encoded payloads (the
+difference from the same voxels in the previous volume, computed on the raw bit
+patterns) are also flagged with VOL_FLAG_DELTA. Payloads are decoded straight
+into their place in the image matrix. See `get_compressionStats` for the
+achieved compression ratio and decoding time.
+
 ** Volume Orientation:
 Pyneal works on the assumption that incoming volumes will have the 3D
 voxel array ordered like RAS+, and that the accompanying affine will provide
@@ -47,17 +86,119 @@ space.
 Along those same lines, the affine that gets transmitted in the header for each
 volume should be the same for all volumes in the series.
 
+** Memory-mapped Image Matrix:
+By default, the 4D image matrix for the series is held entirely in RAM, and
+written to disk as a compressed Nifti file at the end of the scan. For long,
+high-resolution series, you can set the optional 'memmapImageMatrix' setting
+to True. The image matrix will then be backed by an uncompressed Nifti file
+('receivedFunc.nii') in the series output directory, and each volume is written
+straight into that file as it arrives. Saving at the end of the scan only needs
+to update the header and flush the file to disk.
+
+** Image Matrix Layout:
+The image matrix is indexed as [x, y, z, t]. By default it is also laid out in
+memory that way, which means each volume is scattered across memory with a
+stride of numTimepts. Setting the optional 'volumeMajorImageMatrix' setting to
+True allocates the storage time-first instead, so that every volume occupies
+one contiguous block. The image matrix is then a transposed [x, y, z, t] view
+onto that storage, so indexing is unchanged, but writing a new volume is a
+single block copy and `get_vol` returns a contiguous view. (A memory-mapped
+image matrix is always stored volume by volume, following the Nifti layout)
+
+** Ring Buffer:
+For long or open-ended series, set the optional 'ringBufferSize' setting to K.
+The image matrix then only holds the K most recent volumes, with volIdx stored
+in slot volIdx % K, and 'numTimepts' becomes optional (more volumes than
+expected are accepted). Every volume is written to 'receivedFunc.nii' by the
+background writer (see below) as soon as it is complete, so a slot can be
+reused without waiting on the disk. `get_vol` and `get_slice` work for any
+volume that is still in the ring; the views they return are only valid until
+the slot is reused, K volumes later. (Takes precedence over
+'memmapImageMatrix')
+
+** Background Nifti Writer:
+Set the optional 'niftiWriter' setting to 'nii' or 'nii.gz' to have each volume
+written to the output file ('receivedFunc.nii' or 'receivedFunc.nii.gz') by a
+background thread as soon as it is complete, instead of writing the whole
+series at the end of the scan. Whatever has arrived is then on disk even if
+Pyneal stops mid-scan, and saving at the end of the scan only needs to update
+the header. For 'nii.gz', each volume is compressed as a separate gzip member
+(gzip files can be concatenated), and the header is stored uncompressed in the
+first member so it can be rewritten in place.
+
+** Session Mode:
+By default, the scan receiver handles a single series. With the optional
+'sessionMode' setting, it stays up for a whole session of back-to-back series.
+Once a series has been processed and saved, call `resetSeries` with the output
+directory for the next one. A new series starts when pyneal_scanner reconnects
+(a new handshake message) or sends a new series header. If that happens before
+`resetSeries` has been called, the scan receiver holds off replying until it has,
+which keeps pyneal_scanner waiting. The image matrix from the previous series is
+reused if the next series has the same dimensions.
+
+** Masked Time-series:
+With the optional 'maskedTimeseries' setting, the scan receiver also keeps the
+voxels within the mask ('maskFile') in a contiguous (numMaskVoxels, numSlots)
+matrix, filled as each volume (or slice) arrives. The mask voxels are gathered
+from the image matrix using flat offsets that are computed once, when the image
+matrix is created. `get_maskedVol` returns the mask voxels for a volume (in the
+same order as vol[mask]), and `get_maskedTimeseries` returns a window of
+volumes, so analyses don't have to index the full volume each time.
+
+** Receive Telemetry:
+For every volume, the scan receiver records when its header and its voxel
+data arrived, how many bytes were received, how long it took to copy (or
+decode) the data into the image matrix, the scanner timestamp (if sent), and
+the interval since the previous volume arrived, along with how far that
+interval is from the TR. Use `get_telemetry` to query this while the scan is
+running. The table is saved as 'receiveTelemetry.tsv' in the series output
+directory along with the data. Comparing scannerTime, headerTime, and
+payloadTime shows whether late volumes are held up on the scanner side, on the
+network, or in Pyneal.
+
 """
+import os
 from os.path import join
-from threading import Thread
+from threading import Thread, Condition, Event
+from queue import Queue
 import logging
 import json
+import struct
+import zlib
+import gzip
+import time
 import atexit
 
 import numpy as np
 import nibabel as nib
 import zmq
 
+# binary volume header for version 2 of the transfer protocol (see
+# pyneal_scanner/utils/general_utils.py): (magic, volIdx, flags, timestamp)
+VOL_HEADER_FORMAT = '<4sIId'
+VOL_HEADER_MAGIC = b'PNV2'
+VOL_FLAG_TIMESTAMP = 1
+
+# binary slice header for slice streaming:
+# (magic, volIdx, flags, timestamp, sliceIdx)
+SLICE_HEADER_FORMAT = '<4sIIdI'
+SLICE_HEADER_MAGIC = b'PNS2'
+
+# optional compression of the voxel data
+COMPRESSION_CODECS = ('zlib', 'zlib-delta')
+VOL_FLAG_ZLIB = 2
+VOL_FLAG_DELTA = 4
+
+# per-volume receive telemetry. Times are in seconds since the epoch; times and
+# intervals are NaN until they are known
+TELEMETRY_DTYPE = np.dtype([('scannerTime', 'f8'),   # timestamp in vol header
+                            ('headerTime', 'f8'),    # first header arrived
+                            ('payloadTime', 'f8'),   # last voxel data arrived
+                            ('nBytes', 'i8'),        # payload bytes received
+                            ('copyTime', 'f8'),      # copy/decode into matrix
+                            ('interval', 'f8'),      # since previous vol arrived
+                            ('trDelta', 'f8')])      # interval - TR
+
 
 class ScanReceiver(Thread):
     """ Class to listen in for incoming scan data.
@@ -70,6 +211,19 @@ class ScanReceiver(Thread):
         pynealHost: ip address for the computer running Pyneal
         pynealScannerPort: port # for scanner socket [e.g. 5555]
 
+    Optional keys:
+        memmapImageMatrix: store the image matrix in a memory-mapped Nifti
+        file in the seriesOutputDir instead of RAM [False]
+        volumeMajorImageMatrix: store each volume as a contiguous block of
+        memory [False]
+        ringBufferSize: only keep this many of the most recent volumes in
+        memory, and write every volume to disk in the background [None]
+        maskedTimeseries: keep a (numMaskVoxels, numTimepts) matrix of the
+        voxels within the mask [False]
+        niftiWriter: write each volume to disk as it arrives, as 'nii' or
+        'nii.gz' [None]
+        sessionMode: receive multiple series, one after another [False]
+
     """
     def __init__(self, settings):
         """ Initialize the class
@@ -83,6 +237,20 @@ class ScanReceiver(Thread):
                 numTimepts: number of expected timepoints in series
                 pynealHost: ip address for the computer running Pyneal
                 pynealScannerPort: port # for scanner socket [e.g. 5555]
+            Optionally, it can also contain:
+                memmapImageMatrix: if True, back the image matrix with a
+                memory-mapped Nifti file in the seriesOutputDir
+                volumeMajorImageMatrix: if True, allocate the image matrix
+                time-first so each volume is contiguous in memory
+                ringBufferSize: if set, the number of most recent volumes to
+                keep in memory. numTimepts is then optional (None or 0 if
+                unknown)
+                niftiWriter: if 'nii' or 'nii.gz', write each volume to the
+                output file in the background as it arrives
+                maskedTimeseries: if True, also store the voxels within
+                the mask at 'maskFile' as each volume arrives
+                sessionMode: if True, receive multiple series, calling
+                `resetSeries` between them
 
         """
         # start the thread upon creation
@@ -92,10 +260,38 @@ class ScanReceiver(Thread):
         self.logger = logging.getLogger('PynealLog')
 
         # get vars from settings dict
-        self.numTimepts = settings['numTimepts']
+        self.ringBufferSize = settings.get('ringBufferSize', None)
+        if self.ringBufferSize:
+            self.numTimepts = settings.get('numTimepts', None)
+            self.numSlots = int(self.ringBufferSize)
+        else:
+            self.numTimepts = settings['numTimepts']
+            self.numSlots = self.numTimepts
         self.host = settings['pynealHost']
         self.scannerPort = settings['pynealScannerPort']
         self.seriesOutputDir = settings['seriesOutputDir']
+        self.memmapImageMatrix = settings.get('memmapImageMatrix', False)
+        self.volumeMajorImageMatrix = settings.get('volumeMajorImageMatrix', False)
+        if self.ringBufferSize and self.memmapImageMatrix:
+            self.logger.warning('memmapImageMatrix is ignored in ring buffer mode')
+            self.memmapImageMatrix = False
+        self.niftiWriter = settings.get('niftiWriter', None)
+        if self.niftiWriter not in (None, 'nii', 'nii.gz'):
+            raise ValueError('Unrecognized niftiWriter: {}'.format(self.niftiWriter))
+        if self.memmapImageMatrix and self.niftiWriter:
+            self.logger.warning('niftiWriter is ignored for a memory-mapped image matrix')
+            self.niftiWriter = None
+        if self.ringBufferSize and self.niftiWriter != 'nii':
+            # the ring can only reuse a slot once its vol is on disk, so vols
+            # must be written as soon as they're complete, in any order
+            if self.niftiWriter == 'nii.gz':
+                self.logger.warning('ring buffer mode writes uncompressed Nifti files')
+            self.niftiWriter = 'nii'
+        self.sessionMode = settings.get('sessionMode', False)
+        if settings.get('maskedTimeseries', False):
+            self.mask = nib.load(settings['maskFile']).get_data() > 0
+        else:
+            self.mask = None
 
         # class config vars
         self.scanStarted = False
@@ -103,12 +299,57 @@ class ScanReceiver(Thread):
         self.imageMatrix = None         # matrix that will hold the incoming data
         self.affine = None
         self.tr = None
-
-        # array to keep track of completedVols
-        self.completedVols = np.zeros(self.numTimepts, dtype=bool)
-
-        # set up socket server to listen for msgs from pyneal-scanner
-        self.context = zmq.Context.instance()
+        self.imageMatrixFile = None     # path to memmap file (if used)
+        self.seriesHeader = None        # series metadata (protocol version 2)
+        self.sliceAxis = 2              # axis that slices are stacked along
+        self.compression = None         # codec accepted for this series
+        self.compressionStats = {'nMessages': 0, 'rawBytes': 0,
+                                 'receivedBytes': 0, 'decodeTime': 0.0}
+
+        # array to keep track of completedVols, and completedSlices for each
+        # slot in the image matrix (built once the volume dims are known)
+        self.completedVols = np.zeros(self.numTimepts or self.numSlots, dtype=bool)
+        self.completedSlices = None
+
+        # masked time-series: offsets of the mask voxels within a volume slot
+        # (overall, and for each slice), and the store of mask voxels
+        self.maskOffsets = None
+        self.maskSpan = 0
+        self.maskSliceRows = {}
+        self.maskSliceIdxs = None
+        self.maskedData = None
+
+        # receive telemetry for each vol (grows along with completedVols)
+        self.telemetry = self.emptyTelemetry(len(self.completedVols))
+
+        # ring buffer mode: which volIdx is in each slot
+        self.slotVolIdx = None
+        self.maxVolIdx = -1
+
+        # background writer: which vols have been queued, and written to disk
+        self.writeQ = None
+        self.writerThread = None
+        self.writerFile = None
+        self.nextWriteIdx = 0
+        self.queuedVols = set()
+        self.writtenVols = set()
+        self.writerFailed = False
+
+        # signal other threads when the scan starts and as each vol arrives
+        self.scan_started = Event()
+        self.volArrived = Condition()
+
+        # session mode: set while the scan receiver is ready to start a new
+        # series, and the slots of a reused image matrix that still hold data
+        # from the previous series
+        self.seriesReady = Event()
+        self.seriesReady.set()
+        self.staleSlots = None
+
+        # set up socket server to listen for msgs from pyneal-scanner. The scan
+        # receiver gets its own context so that it can be shut down without
+        # affecting any other sockets in this process
+        self.context = zmq.Context()
         self.scannerSocket = self.context.socket(zmq.PAIR)
         self.scannerSocket.bind('tcp://{}:{}'.format(self.host, self.scannerPort))
         self.logger.debug('bound to {}:{}'.format(self.host, self.scannerPort))
@@ -120,71 +361,440 @@ class ScanReceiver(Thread):
         # set up socket to communicate with dashboard (if specified)
         if settings['launchDashboard']:
             self.dashboard = True
-            self.context = zmq.Context.instance()
             self.dashboardSocket = self.context.socket(zmq.REQ)
             self.dashboardSocket.connect('tcp://127.0.0.1:{}'.format(settings['dashboardPort']))
         else:
             self.dashboard = False
 
     def run(self):
-        # Once this thread is up and running, confirm that the scanner socket
-        # is alive and working before proceeding.
-        while True:
-            print('Waiting for connection from pyneal_scanner')
-            msg = self.scannerSocket.recv_string()
-            print('Received message: ', msg)
-            self.scannerSocket.send_string(msg)
-            break
-        self.logger.debug('scanner socket connected to Pyneal-Scanner')
-
-        # Start the main loop to listen for new data
-        while self.alive:
-            # wait for json header to appear. The header is assumed to
-            # have key:value pairs for:
-            # volIdx - volume index (0-based)
-            # dtype - dtype of volume voxel array
-            # shape - dims of volume voxel array
-            # affine - affine to transform vol to RAS+ mm space
-            # TR - repetition time of scan
-            volHeader = self.scannerSocket.recv_json(flags=0)
-            volIdx = volHeader['volIdx']
-            self.logger.debug('received volHeader volIdx {}'.format(volIdx));
-
-            # if this is the first vol, initialize the matrix and store the affine
-            if not self.scanStarted:
-                self.createImageMatrix(volHeader)
-                self.affine = np.array(json.loads(volHeader['affine']))
-                self.tr = json.loads(volHeader['TR'])
-
-                self.scanStarted = True     # toggle the scanStarted flag
-
-            # now listen for the image data as a string buffer
+        try:
+            # Once this thread is up and running, confirm that the scanner socket
+            # is alive and working before proceeding.
+            while True:
+                print('Waiting for connection from pyneal_scanner')
+                msg = self.scannerSocket.recv_string()
+                print('Received message: ', msg)
+                self.scannerSocket.send_string(msg)
+                break
+            self.logger.debug('scanner socket connected to Pyneal-Scanner')
+
+            # Start the main loop to listen for new data
+            while self.alive:
+                # wait for the header to appear. This is either a JSON
+                # header (protocol version 1) with key:value pairs for:
+                # volIdx - volume index (0-based)
+                # dtype - dtype of volume voxel array
+                # shape - dims of volume voxel array
+                # affine - affine to transform vol to RAS+ mm space
+                # TR - repetition time of scan
+                # or, a JSON series header with those same keys (minus volIdx)
+                # followed by binary volume headers (protocol version 2)
+                msgHeader = self.scannerSocket.recv(flags=0)
+                headerTime = time.time()
+                try:
+                    if self.sessionMode and self.isHandshake(msgHeader):
+                        # pyneal_scanner reconnected for the next series
+                        if not self.waitForSeriesReady():
+                            break
+                        self.scannerSocket.send(msgHeader)
+                        self.logger.debug('scanner socket reconnected to Pyneal-Scanner')
+                        continue
+                    if msgHeader[:1] == b'{':
+                        volHeader = json.loads(msgHeader.decode())
+                        if 'protocolVersion' in volHeader:
+                            if self.sessionMode and self.scanStarted:
+                                # series header for the next series
+                                if not self.waitForSeriesReady():
+                                    break
+                            self.seriesHeader = volHeader
+                            self.logger.debug('received seriesHeader, protocol version {}'.format(
+                                volHeader['protocolVersion']))
+                            self.scannerSocket.send_string(self.negotiateCompression(volHeader))
+                            continue
+                        seriesHeader = volHeader
+                    else:
+                        volHeader = self.unpackVolHeader(msgHeader)
+                        seriesHeader = self.seriesHeader
+                    volIdx = volHeader['volIdx']
+                    sliceIdx = volHeader.get('sliceIdx')
+                    self.logger.debug('received volHeader volIdx {}'.format(volIdx))
+
+                    # if this is the first vol, store the affine and initialize the matrix
+                    if not self.scanStarted:
+                        self.affine = np.array(json.loads(seriesHeader['affine']))
+                        self.tr = json.loads(seriesHeader['TR'])
+                        self.sliceAxis = seriesHeader.get('sliceAxis', 2)
+                        self.createImageMatrix(seriesHeader)
+
+                        self.scanStarted = True     # toggle the scanStarted flag
+                        self.seriesReady.clear()
+                        self.scan_started.set()
+
+                    if sliceIdx is None:
+                        response = 'received volIdx {}'.format(volIdx)
+                    else:
+                        response = 'received volIdx {} sliceIdx {}'.format(volIdx, sliceIdx)
+
+                    # reserve the location for this volume (or slice) in the image
+                    # matrix, and receive the voxel array straight into it
+                    slotIdx = self.claimSlot(volIdx)
+                    if slotIdx is None:
+                        # too old for the ring buffer, nowhere to put it
+                        self.logger.warning('volIdx {} arrived after its slot was reused; discarded'.format(volIdx))
+                        self.scannerSocket.recv(flags=0)
+                        self.scannerSocket.send_string(response)
+                        continue
+                    volSlot = self.imageMatrix[:, :, :, slotIdx]
+                    if sliceIdx is None:
+                        nBytes, payloadTime = self.receiveVolume(volSlot, volHeader)
+                    else:
+                        sliceSlot = volSlot[self.sliceIndex(sliceIdx)]
+                        nBytes, payloadTime = self.receiveVolume(sliceSlot, volHeader)
+                    copyTime = time.time() - payloadTime
+                    if self.maskedData is not None:
+                        self.storeMaskedVoxels(slotIdx, sliceIdx)
+
+                    # update the completed slices and volumes tables, wake any
+                    # waiting threads
+                    with self.volArrived:
+                        if sliceIdx is None:
+                            self.completedSlices[slotIdx, :] = True
+                        else:
+                            self.completedSlices[slotIdx, sliceIdx] = True
+                        volComplete = self.completedSlices[slotIdx].all()
+                        self.growCompletedVols(volIdx)
+                        self.completedVols[volIdx] = volComplete
+                        self.recordTelemetry(volIdx, volHeader.get('timestamp'),
+                                             headerTime, payloadTime, nBytes,
+                                             copyTime, volComplete)
+                        self.volArrived.notify_all()
+
+                    # hand completed vols to the background writer
+                    if volComplete and self.niftiWriter:
+                        self.queueWrite(volIdx)
+
+                    # send response back to Pyneal-Scanner
+                    self.scannerSocket.send_string(response)
+                    if sliceIdx is None:
+                        self.logger.info(response)
+                    else:
+                        self.logger.debug(response)
+
+                    # update log and dashboard once the full volume is here
+                    if volComplete:
+                        self.sendToDashboard('received volIdx {}'.format(volIdx))
+                except (ValueError, KeyError, struct.error, zlib.error) as e:
+                    # a bad message shouldn't take down the receiver thread
+                    self.rejectMessage(e)
+        except zmq.ContextTerminated:
+            # killServer was called while waiting on a socket
+            self.logger.debug('scan receiver context terminated')
+        finally:
+            # sockets must be closed by the thread that uses them
+            self.scannerSocket.close(linger=0)
+            if self.dashboard:
+                self.dashboardSocket.close(linger=0)
+
+    def isHandshake(self, msg):
+        """ Return True if the message is a handshake from pyneal_scanner,
+        rather than a volume header
+        """
+        return (msg[:1] != b'{'
+                and msg[:4] not in (VOL_HEADER_MAGIC, SLICE_HEADER_MAGIC))
+
+    def rejectMessage(self, error):
+        """ Discard the rest of a message that couldn't be handled, and reply
+        to Pyneal-Scanner with the error
+
+        Parameters
+        ----------
+        error : Exception
+            the error raised while handling the message
+
+        """
+        while self.scannerSocket.getsockopt(zmq.RCVMORE):
+            self.scannerSocket.recv(flags=0)
+        response = 'error: {}'.format(error)
+        self.logger.error(response)
+        self.scannerSocket.send_string(response)
+
+    def waitForSeriesReady(self):
+        """ Block until `resetSeries` has been called for the next series
+
+        Returns
+        -------
+        bool
+            True once the scan receiver is ready, False if it was shut down
+            while waiting
+
+        """
+        if not self.seriesReady.is_set():
+            self.logger.info('next series is waiting for the current one to finish')
+        while not self.seriesReady.wait(timeout=.1):
+            if not self.alive:
+                return False
+        return True
+
+    def resetSeries(self, seriesOutputDir, numTimepts=None):
+        """ Get ready to receive the next series (session mode)
+
+        Should be called once the current series has been processed and
+        saved. Clears all of the state for the current series, but keeps the
+        sockets, and the image matrix if the next series turns out to have the
+        same dimensions.
+
+        Parameters
+        ----------
+        seriesOutputDir : string
+            full path to the output directory for the next series
+        numTimepts : int, optional
+            number of expected timepoints in the next series, if different
+            from the current series
+
+        """
+        with self.volArrived:
+            self.seriesOutputDir = seriesOutputDir
+            if numTimepts is not None and numTimepts != self.numTimepts:
+                self.numTimepts = numTimepts
+                if not self.ringBufferSize:
+                    self.numSlots = numTimepts
+            self.scanStarted = False
+            self.scan_started.clear()
+            self.affine = None
+            self.tr = None
+            self.seriesHeader = None
+            self.sliceAxis = 2
+            self.compression = None
+            self.compressionStats = {'nMessages': 0, 'rawBytes': 0,
+                                     'receivedBytes': 0, 'decodeTime': 0.0}
+            self.completedVols = np.zeros(self.numTimepts or self.numSlots, dtype=bool)
+            self.telemetry = self.emptyTelemetry(len(self.completedVols))
+            self.queuedVols = set()
+            self.writtenVols = set()
+            self.maxVolIdx = -1
+            self.writerThread = None
+            self.writerFailed = False
+
+            # memory-mapped files belong to one series, so can't be reused
+            if self.memmapImageMatrix:
+                self.imageMatrix = None
+                self.imageMatrixFile = None
+        self.seriesReady.set()
+        self.logger.debug('ready for next series, output dir: {}'.format(seriesOutputDir))
+
+    def unpackVolHeader(self, msgHeader):
+        """ Unpack a binary volume or slice header (protocol version 2)
+
+        The binary header only carries the values that change from volume to
+        volume. The dtype and shape of the voxel array are filled in from the
+        series header. For slice headers, the shape is that of a single slice,
+        i.e. the volume shape without the slice axis.
+
+        Parameters
+        ----------
+        msgHeader : bytes
+            binary volume header, packed with VOL_HEADER_FORMAT, or binary
+            slice header, packed with SLICE_HEADER_FORMAT
+
+        Returns
+        -------
+        volHeader : dict
+            dictionary with 'volIdx', 'sliceIdx' (None for full volumes),
+            'flags', 'timestamp', 'dtype', and 'shape' entries for this volume
+
+        """
+        if msgHeader[:4] == SLICE_HEADER_MAGIC:
+            magic, volIdx, flags, timestamp, sliceIdx = struct.unpack(
+                SLICE_HEADER_FORMAT, msgHeader)
+        else:
+            magic, volIdx, flags, timestamp = struct.unpack(VOL_HEADER_FORMAT, msgHeader)
+            sliceIdx = None
+            if magic != VOL_HEADER_MAGIC:
+                raise ValueError('Unrecognized volume header: {}'.format(msgHeader))
+        if self.seriesHeader is None:
+            raise ValueError('volIdx {} arrived before the series header'.format(volIdx))
+
+        shape = list(self.seriesHeader['shape'])
+        if sliceIdx is not None:
+            del shape[self.seriesHeader.get('sliceAxis', 2)]
+
+        return {'volIdx': volIdx,
+                'sliceIdx': sliceIdx,
+                'flags': flags,
+                'timestamp': timestamp if flags & VOL_FLAG_TIMESTAMP else None,
+                'dtype': self.seriesHeader['dtype'],
+                'shape': shape}
+
+    def negotiateCompression(self, seriesHeader):
+        """ Accept or decline the compression codec proposed in a series header
+
+        Parameters
+        ----------
+        seriesHeader : dict
+            series header, with an optional 'compression' entry
+
+        Returns
+        -------
+        string
+            response to send back to Pyneal-Scanner. Names the codec if
+            it was accepted
+
+        """
+        codec = seriesHeader.get('compression')
+        if codec is None:
+            self.compression = None
+            return 'received seriesHeader'
+        if codec not in COMPRESSION_CODECS:
+            self.logger.warning('declined unsupported compression codec: {}'.format(codec))
+            self.compression = None
+            return 'received seriesHeader'
+        if codec == 'zlib-delta' and self.ringBufferSize and self.numSlots < 2:
+            # each volume would overwrite the previous one before it's decoded
+            self.logger.warning('declined zlib-delta compression, which needs a ring buffer of at least 2 volumes')
+            self.compression = None
+            return 'received seriesHeader'
+
+        self.compression = codec
+        self.logger.info('accepted {} compression'.format(codec))
+        return 'received seriesHeader compression={}'.format(codec)
+
+    def sliceIndex(self, sliceIdx):
+        """ Return the index for a slice of a 3D volume along the slice axis
+
+        Parameters
+        ----------
+        sliceIdx : int
+            index location (0-based) of the slice along `sliceAxis`
+
+        Returns
+        -------
+        tuple
+            index that selects the slice from a 3D volume array
+
+        """
+        idx = [slice(None)] * 3
+        idx[self.sliceAxis] = sliceIdx
+        return tuple(idx)
+
+    def receiveVolume(self, volSlot, volHeader):
+        """ Receive the voxel array for a volume into its place in the matrix
+
+        If the destination is one contiguous block of memory (e.g. when using
+        `volumeMajorImageMatrix`) and the installed pyzmq supports it, the
+        message payload is received directly into the image matrix. Otherwise,
+        the payload is received as a zmq frame, and copied into place without
+        any intermediate arrays.
+
+        Parameters
+        ----------
+        volSlot : numpy-array
+            3D view onto the image matrix where this volume belongs (or 2D
+            view, for a single slice)
+        volHeader : dict
+            dictionary containing header information from the volume, including
+            'dtype' and 'shape'
+
+        Returns
+        -------
+        nBytes : int
+            number of payload bytes received
+        payloadTime : float
+            time the payload finished arriving, before it was copied (or
+            decoded) into the image matrix
+
+        """
+        if volHeader.get('flags', 0) & VOL_FLAG_ZLIB:
+            return self.receiveCompressed(volSlot, volHeader)
+        elif (hasattr(self.scannerSocket, 'recv_into')
+                and volSlot.flags['C_CONTIGUOUS']
+                and volSlot.dtype == np.dtype(volHeader['dtype'])):
+            nBytes = self.scannerSocket.recv_into(volSlot)
+            payloadTime = time.time()
+            if nBytes != volSlot.nbytes:
+                # the payload was truncated, or only partly filled the slot
+                raise ValueError('volIdx {}: expected {} bytes of voxel data, received {}'.format(
+                    volHeader['volIdx'], volSlot.nbytes, nBytes))
+        else:
+            # listen for the image data as a string buffer
             voxelArray = self.scannerSocket.recv(flags=0, copy=False, track=False)
+            payloadTime = time.time()
+            nBytes = len(voxelArray.buffer)
 
             # format the voxel array according to params from the vol header
             voxelArray = np.frombuffer(voxelArray, dtype=volHeader['dtype'])
             voxelArray = voxelArray.reshape(volHeader['shape'])
 
-            # add the volume to the appropriate location in the image matrix
-            self.imageMatrix[:, :, :, volIdx] = voxelArray
+            # copy to the appropriate location in the image matrix
+            volSlot[:] = voxelArray
+        return nBytes, payloadTime
 
-            # update the completed volumes table
-            self.completedVols[volIdx] = True
+    def receiveCompressed(self, volSlot, volHeader):
+        """ Receive a compressed voxel array, and decode it into the matrix
 
-            # send response back to Pyneal-Scanner
-            response = 'received volIdx {}'.format(volIdx)
-            self.scannerSocket.send_string(response)
-            self.logger.info(response)
+        Delta encoded payloads are added to the same voxels of the previous
+        volume, which must already have arrived. Decoding works on the raw bit
+        patterns of the voxel data (as unsigned ints), so it is exact for any
+        dtype.
 
-            # update log and dashboard
-            self.sendToDashboard(response)
+        Parameters
+        ----------
+        volSlot : numpy-array
+            view onto the image matrix where this volume (or slice) belongs
+        volHeader : dict
+            dictionary containing header information from the volume, including
+            'volIdx', 'sliceIdx', 'flags', and 'shape'
+
+        Returns
+        -------
+        nBytes : int
+            number of compressed payload bytes received
+        payloadTime : float
+            time the payload finished arriving, before it was decoded
+
+        """
+        payload = self.scannerSocket.recv(flags=0, copy=False, track=False)
+        startTime = time.time()
+
+        rawDtype = 'u{}'.format(volSlot.dtype.itemsize)
+        rawArray = np.frombuffer(zlib.decompress(payload.buffer), dtype=rawDtype)
+        rawArray = rawArray.reshape(volHeader['shape'])
+
+        volIdx = volHeader['volIdx']
+        rawSlot = volSlot.view(rawDtype)
+        if volHeader['flags'] & VOL_FLAG_DELTA:
+            sliceIdx = volHeader.get('sliceIdx')
+            prevSlotIdx = self.slotIndex(volIdx - 1)
+            prevRetained = volIdx > 0 and self.isRetained(volIdx - 1)
+            if sliceIdx is None:
+                prevArrived = prevRetained and self.isCompleted(volIdx - 1)
+                prevSlot = self.imageMatrix[:, :, :, prevSlotIdx]
+            else:
+                prevArrived = prevRetained and self.completedSlices[prevSlotIdx, sliceIdx]
+                prevSlot = self.imageMatrix[:, :, :, prevSlotIdx][self.sliceIndex(sliceIdx)]
+            if not prevArrived:
+                raise ValueError('volIdx {} is delta encoded, but the previous volume has not arrived'.format(volIdx))
+            np.add(prevSlot.view(rawDtype), rawArray, out=rawSlot)
+        else:
+            rawSlot[...] = rawArray
+
+        decodeTime = time.time() - startTime
+        self.compressionStats['nMessages'] += 1
+        self.compressionStats['rawBytes'] += volSlot.nbytes
+        self.compressionStats['receivedBytes'] += len(payload.buffer)
+        self.compressionStats['decodeTime'] += decodeTime
+        self.logger.debug('vol {} decompressed {} -> {} bytes in {:.4f}s'.format(
+            volIdx, len(payload.buffer), volSlot.nbytes, decodeTime))
+        return len(payload.buffer), startTime
 
     def createImageMatrix(self, volHeader):
         """ Create empty 4D image matrix
 
         Once the first volume appears, this function should be called to build
         the empty matrix to store incoming vol data, using info contained in
-        the vol header.
+        the vol header. If `memmapImageMatrix` is set, the matrix will be a
+        memory-mapped Nifti file on disk, which requires the affine and TR to
+        already be set. If `volumeMajorImageMatrix` is set, the matrix will be
+        a [x, y, z, t] view onto time-first storage.
 
         Parameters
         ----------
@@ -193,39 +803,755 @@ class ScanReceiver(Thread):
             'volIdx', 'dtype', 'shape', and 'affine'
 
         """
-        # create the empty imageMatrix
-        self.imageMatrix = np.zeros(shape=(
-            volHeader['shape'][0],
-            volHeader['shape'][1],
-            volHeader['shape'][2],
-            self.numTimepts), dtype=volHeader['dtype'])
+        shape = (volHeader['shape'][0],
+                 volHeader['shape'][1],
+                 volHeader['shape'][2],
+                 self.numSlots)
+
+        reuse = (self.imageMatrix is not None
+                 and self.imageMatrix.shape == shape
+                 and self.imageMatrix.dtype == np.dtype(volHeader['dtype']))
+        if reuse:
+            # reuse the image matrix from the previous series (session mode).
+            # Each slot is zeroed when it is first claimed in this series
+            self.logger.debug('reusing Image Matrix from previous series')
+        elif self.memmapImageMatrix:
+            self.imageMatrix = self.createMemmapImageMatrix(shape,
+                                                            volHeader['dtype'])
+        elif self.volumeMajorImageMatrix:
+            # allocate as [t, x, y, z], then view as [x, y, z, t]. Each
+            # imageMatrix[:, :, :, volIdx] is then a C-contiguous block
+            volumeStore = np.zeros(shape=(shape[3],) + shape[:3],
+                                   dtype=volHeader['dtype'])
+            self.imageMatrix = volumeStore.transpose(1, 2, 3, 0)
+        else:
+            # create the empty imageMatrix
+            self.imageMatrix = np.zeros(shape=shape, dtype=volHeader['dtype'])
+        self.staleSlots = np.full(self.numSlots, reuse, dtype=bool)
+
+        self.completedSlices = np.zeros((self.numSlots, shape[self.sliceAxis]),
+                                        dtype=bool)
+
+        if self.ringBufferSize:
+            self.slotVolIdx = np.full(self.numSlots, -1, dtype=int)
+        if self.niftiWriter:
+            self.startWriterThread(shape[:3], volHeader['dtype'])
+        if self.mask is not None:
+            self.createMaskedStore()
 
         self.logger.debug('Image Matrix dims: {}'.format(self.imageMatrix.shape))
 
+    def createMaskedStore(self):
+        """ Set up the matrix that stores the voxels within the mask
+
+        The offset of each mask voxel (from the first voxel of a volume, in
+        elements) is computed from the strides of the image matrix, so the
+        mask voxels can be gathered straight from the memory of any volume
+        slot, whatever the layout of the image matrix. The store is reused
+        from the previous series if it is the right size.
+
+        """
+        volSlot = self.imageMatrix[:, :, :, 0]
+        if self.mask.shape != volSlot.shape:
+            self.logger.error('mask dims {} do not match volume dims {}; not storing masked time-series'.format(
+                self.mask.shape, volSlot.shape))
+            self.maskedData = None
+            return
+
+        maskCoords = np.nonzero(self.mask)
+        elemStrides = [stride // volSlot.itemsize for stride in volSlot.strides]
+        self.maskOffsets = np.zeros(len(maskCoords[0]), dtype=np.intp)
+        for coords, elemStride in zip(maskCoords, elemStrides):
+            self.maskOffsets += coords * elemStride
+        self.maskSpan = int(self.maskOffsets.max()) + 1 if len(self.maskOffsets) else 0
+
+        # rows of the store that fall in each slice, for slice streaming
+        sliceCoords = maskCoords[self.sliceAxis]
+        self.maskSliceIdxs = np.unique(sliceCoords)
+        self.maskSliceRows = {sliceIdx: np.flatnonzero(sliceCoords == sliceIdx)
+                              for sliceIdx in self.maskSliceIdxs}
+
+        shape = (len(self.maskOffsets), self.numSlots)
+        if (self.maskedData is None or self.maskedData.shape != shape
+                or self.maskedData.dtype != self.imageMatrix.dtype):
+            self.maskedData = np.zeros(shape, dtype=self.imageMatrix.dtype)
+        self.logger.debug('Masked time-series dims: {}'.format(shape))
+
+    def storeMaskedVoxels(self, slotIdx, sliceIdx=None):
+        """ Copy the mask voxels of a volume (or slice) into the masked store
+
+        Parameters
+        ----------
+        slotIdx : int
+            slot in the image matrix that the volume was received into
+        sliceIdx : int, optional
+            if set, only copy the mask voxels from this slice
+
+        """
+        if len(self.maskOffsets) == 0:
+            return
+
+        # flat view over the memory of this volume slot
+        volSlot = self.imageMatrix[:, :, :, slotIdx]
+        volBuffer = np.lib.stride_tricks.as_strided(
+            volSlot, shape=(self.maskSpan,),
+            strides=(volSlot.itemsize,), writeable=False)
+
+        if sliceIdx is None:
+            self.maskedData[:, slotIdx] = volBuffer[self.maskOffsets]
+        elif sliceIdx in self.maskSliceRows:
+            rows = self.maskSliceRows[sliceIdx]
+            self.maskedData[rows, slotIdx] = volBuffer[self.maskOffsets[rows]]
+
+    def createMemmapImageMatrix(self, shape, dtype):
+        """ Create a 4D image matrix backed by an uncompressed Nifti file
+
+        The Nifti header is written to 'receivedFunc.nii' in the series output
+        directory, and the rest of the file is sized to hold the full series.
+        The voxel data portion of the file is then memory-mapped, so each volume
+        that gets added to the matrix is written directly to disk, and the OS
+        is free to page data in and out as needed.
+
+        Parameters
+        ----------
+        shape : tuple
+            dimensions (x, y, z, t) of the 4D image matrix
+        dtype : string
+            datatype of the voxel array (e.g. int16)
+
+        Returns
+        -------
+        numpy memmap
+            4D array mapped onto the voxel data of the Nifti file
+
+        """
+        self.imageMatrixFile = join(self.seriesOutputDir, 'receivedFunc.nii')
+
+        # write the header, and extend the file to the full size of the series
+        hdr = self.buildNiftiHeader(shape, dtype)
+        dataOffset = int(hdr.get_data_offset())
+        nBytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        with open(self.imageMatrixFile, 'wb') as niiFile:
+            hdr.write_to(niiFile)
+            niiFile.truncate(dataOffset + nBytes)
+
+        # Nifti voxel data is stored in Fortran order
+        imageMatrix = np.memmap(self.imageMatrixFile,
+                                dtype=dtype,
+                                mode='r+',
+                                offset=dataOffset,
+                                shape=shape,
+                                order='F')
+        self.logger.debug('Image Matrix memmapped to: {}'.format(self.imageMatrixFile))
+        return imageMatrix
+
+    def buildNiftiHeader(self, shape, dtype):
+        """ Build a single-file Nifti header for the 4D image matrix
+
+        Parameters
+        ----------
+        shape : tuple
+            dimensions (x, y, z, t) of the 4D image matrix
+        dtype : string
+            datatype of the voxel array (e.g. int16)
+
+        Returns
+        -------
+        hdr : nibabel Nifti1Header
+            header with the affine and TR for the current series
+
+        """
+        hdr = nib.Nifti1Header()
+        hdr.set_data_dtype(dtype)
+        hdr.set_data_shape(shape)
+        hdr.set_qform(self.affine, code='scanner')
+        hdr.set_sform(self.affine, code='scanner')
+
+        # set the TR appropriately in the header
+        pixDims = np.array(hdr.get_zooms())
+        pixDims[3] = self.tr
+        hdr.set_zooms(pixDims)
+
+        # voxel data starts after the header (348 bytes) + extension flag
+        hdr.set_data_offset(352)
+        return hdr
+
+    def slotIndex(self, volIdx):
+        """ Return the index of the slot in the image matrix for a volume
+
+        Parameters
+        ----------
+        volIdx : int
+            index location (0-based) of the volume
+
+        Returns
+        -------
+        int
+            index along the last axis of the image matrix
+
+        """
+        if self.ringBufferSize:
+            return volIdx % self.numSlots
+        return volIdx
+
+    def isRetained(self, volIdx):
+        """ Return True if the volume's slot in the image matrix belongs to it
+
+        Always True (for valid indices) unless in ring buffer mode, where a
+        volume's slot is reused by the volume K places later
+
+        """
+        if volIdx < 0:
+            return False
+        if self.ringBufferSize:
+            return (self.slotVolIdx is not None
+                    and self.slotVolIdx[self.slotIndex(volIdx)] == volIdx)
+        return volIdx < self.numSlots
+
+    def isCompleted(self, volIdx):
+        """ Return True if every slice of the volume has arrived """
+        return volIdx < len(self.completedVols) and bool(self.completedVols[volIdx])
+
+    def growCompletedVols(self, volIdx):
+        """ Make sure the completedVols table has room for `volIdx`
+
+        The table doubles in size as needed, so that more volumes than
+        expected can arrive in ring buffer mode. Call with the `volArrived`
+        lock held.
+
+        """
+        self.maxVolIdx = max(self.maxVolIdx, volIdx)
+        if volIdx >= len(self.completedVols):
+            completedVols = np.zeros(max(volIdx + 1, 2 * len(self.completedVols)),
+                                     dtype=bool)
+            completedVols[:len(self.completedVols)] = self.completedVols
+            self.completedVols = completedVols
+
+            telemetry = self.emptyTelemetry(len(completedVols))
+            telemetry[:len(self.telemetry)] = self.telemetry
+            self.telemetry = telemetry
+
+    def emptyTelemetry(self, nVols):
+        """ Return a telemetry table for `nVols` volumes, with nothing recorded """
+        telemetry = np.zeros(nVols, dtype=TELEMETRY_DTYPE)
+        for field in TELEMETRY_DTYPE.names:
+            if field != 'nBytes':
+                telemetry[field] = np.nan
+        return telemetry
+
+    def recordTelemetry(self, volIdx, scannerTime, headerTime, payloadTime,
+                        nBytes, copyTime, volComplete):
+        """ Add a received message to the telemetry table for its volume
+
+        With slice streaming, a volume arrives over several messages: the
+        header time is that of the first slice, the payload time that of the
+        last, and the bytes and copy times are summed. The interval is
+        measured from the time the previous volume was completed to the time
+        this one was. Call with the `volArrived` lock held.
+
+        Parameters
+        ----------
+        volIdx : int
+            index of the volume
+        scannerTime : float or None
+            timestamp from the volume header, if the scanner sent one
+        headerTime : float
+            time the message header arrived
+        payloadTime : float
+            time the voxel data finished arriving
+        nBytes : int
+            number of payload bytes received
+        copyTime : float
+            time spent copying (or decoding) the payload into the image matrix
+        volComplete : bool
+            True if this message completed the volume
+
+        """
+        record = self.telemetry[volIdx]
+        if np.isnan(record['headerTime']):
+            record['headerTime'] = headerTime
+            if scannerTime is not None:
+                record['scannerTime'] = scannerTime
+        record['payloadTime'] = payloadTime
+        record['nBytes'] += nBytes
+        record['copyTime'] = np.nan_to_num(record['copyTime']) + copyTime
+
+        if volComplete and volIdx > 0:
+            prevPayloadTime = self.telemetry[volIdx - 1]['payloadTime']
+            if self.isCompleted(volIdx - 1) and not np.isnan(prevPayloadTime):
+                record['interval'] = payloadTime - prevPayloadTime
+                if self.tr:
+                    record['trDelta'] = record['interval'] - self.tr
+
+    def claimSlot(self, volIdx):
+        """ Reserve the slot in the image matrix for a volume
+
+        In ring buffer mode, the slot may still hold an older volume. That
+        volume is written to disk first (if it hasn't been already), and the
+        slot is then cleared for the new volume. A slot that still holds data
+        from the previous series (session mode) is zeroed first, so that
+        slices that haven't arrived yet read as zeros.
+
+        Parameters
+        ----------
+        volIdx : int
+            index location (0-based) of the arriving volume
+
+        Returns
+        -------
+        int or None
+            index of the slot, or None if a newer volume has already taken
+            this slot
+
+        """
+        slotIdx = self.slotIndex(volIdx)
+        if not self.ringBufferSize:
+            if self.staleSlots[slotIdx]:
+                with self.volArrived:
+                    self.clearSlot(slotIdx)
+            return slotIdx
+
+        oldVolIdx = self.slotVolIdx[slotIdx]
+        if oldVolIdx == volIdx:
+            return slotIdx
+        if oldVolIdx > volIdx:
+            return None
+        if oldVolIdx >= 0:
+            # an incomplete vol won't have been queued yet; save what arrived
+            self.queueWrite(int(oldVolIdx))
+            with self.volArrived:
+                while oldVolIdx not in self.writtenVols:
+                    if self.writerFailed or not self.writerThread.is_alive():
+                        # don't hold up the scan for a vol that can't be saved
+                        self.logger.error('volIdx {} was not written to disk before its slot was reused'.format(
+                            oldVolIdx))
+                        break
+                    self.volArrived.wait(timeout=1)
+
+        with self.volArrived:
+            if self.staleSlots[slotIdx]:
+                self.clearSlot(slotIdx)
+            self.slotVolIdx[slotIdx] = volIdx
+            self.completedSlices[slotIdx, :] = False
+        return slotIdx
+
+    def clearSlot(self, slotIdx):
+        """ Zero a slot of the image matrix left over from the previous series
+
+        Parameters
+        ----------
+        slotIdx : int
+            index of the slot in the image matrix
+
+        """
+        self.imageMatrix[:, :, :, slotIdx] = 0
+        self.staleSlots[slotIdx] = False
+
+    def startWriterThread(self, volShape, dtype):
+        """ Open the output file, and start the thread that writes to it
+
+        The output file is a Nifti file in the series output directory,
+        either uncompressed ('receivedFunc.nii'), or chunked gzip
+        ('receivedFunc.nii.gz'). The header is rewritten with the final number
+        of volumes when the results are saved.
+
+        Parameters
+        ----------
+        volShape : tuple
+            dimensions (x, y, z) of each volume
+        dtype : string
+            datatype of the voxel array (e.g. int16)
+
+        """
+        nVols = max(self.numTimepts or 1, 1)
+        hdr = self.buildNiftiHeader(tuple(volShape) + (nVols,), dtype)
+        if self.niftiWriter == 'nii.gz':
+            self.imageMatrixFile = join(self.seriesOutputDir, 'receivedFunc.nii.gz')
+            self.writerFile = open(self.imageMatrixFile, 'w+b')
+            self.writerFile.write(self.gzipHeader(hdr))
+        else:
+            self.imageMatrixFile = join(self.seriesOutputDir, 'receivedFunc.nii')
+            self.writerFile = open(self.imageMatrixFile, 'w+b')
+            hdr.write_to(self.writerFile)
+        self.writerFile.flush()
+
+        self.nextWriteIdx = 0
+        self.writeQ = Queue()
+        self.writerThread = Thread(target=self.writeVolumes, daemon=True)
+        self.writerThread.start()
+        self.logger.debug('Writing volumes as they arrive to: {}'.format(
+            self.imageMatrixFile))
+
+    def gzipHeader(self, hdr):
+        """ Pack the Nifti header as the first member of a chunked gzip file
+
+        The header is stored without compression (level 0), so that it is
+        always the same size, and can be rewritten in place.
+
+        Parameters
+        ----------
+        hdr : nibabel Nifti1Header
+            header to pack
+
+        Returns
+        -------
+        bytes
+            gzip member holding the header and the (empty) extension flag
+
+        """
+        hdrBytes = hdr.binaryblock + b'\x00' * (int(hdr.get_data_offset()) - len(hdr.binaryblock))
+        return gzip.compress(hdrBytes, compresslevel=0, mtime=0)
+
+    def queueWrite(self, volIdx):
+        """ Queue a volume to be written to disk by the writer thread """
+        if volIdx not in self.queuedVols:
+            self.queuedVols.add(volIdx)
+            self.writeQ.put(volIdx)
+
+    def writeVolumes(self):
+        """ Write queued volumes to the output file (runs in its own thread)
+
+        For uncompressed output, each volume is written at its own place in
+        the file, so volumes can be written in any order. For chunked gzip
+        output, each volume is compressed as its own gzip member, and appended
+        in order, so volumes that arrive early are held until the ones before
+        them have been written. In ring buffer mode, a slot is not reused until
+        its volume has been written.
+
+        If a write fails (e.g. the disk is full), the error is logged, and
+        `writerFailed` is set. Nothing more is written, but the queue is still
+        drained, so the rest of the scan isn't held up.
+
+        """
+        dataOffset = 352
+        pendingVols = set()
+        while True:
+            volIdx = self.writeQ.get()
+            if volIdx is None:
+                break
+            if self.writerFailed:
+                continue
+
+            try:
+                if self.niftiWriter == 'nii.gz':
+                    pendingVols.add(volIdx)
+                    while self.nextWriteIdx in pendingVols:
+                        writeIdx = self.nextWriteIdx
+                        pendingVols.remove(writeIdx)
+                        vol = self.imageMatrix[:, :, :, self.slotIndex(writeIdx)]
+                        self.writerFile.write(gzip.compress(vol.tobytes(order='F'),
+                                                            compresslevel=1, mtime=0))
+                        self.nextWriteIdx += 1
+                        self.volWritten(writeIdx)
+                else:
+                    vol = self.imageMatrix[:, :, :, self.slotIndex(volIdx)]
+
+                    # Nifti voxel data is stored in Fortran order
+                    self.writerFile.seek(dataOffset + volIdx * vol.nbytes)
+                    self.writerFile.write(vol.tobytes(order='F'))
+                    self.volWritten(volIdx)
+
+                # make sure everything so far survives a crash of Pyneal
+                self.writerFile.flush()
+            except Exception as e:
+                self.logger.error('failed to write volIdx {} to {}; no more volumes will be saved: {}'.format(
+                    volIdx, self.imageMatrixFile, e))
+                with self.volArrived:
+                    self.writerFailed = True
+                    self.volArrived.notify_all()
+
+    def volWritten(self, volIdx):
+        """ Record that a volume has been written, waking any waiting threads """
+        with self.volArrived:
+            self.writtenVols.add(volIdx)
+            self.volArrived.notify_all()
+
+    def finishWriting(self):
+        """ Write any remaining vols, and finalize the output file header
+
+        Every volume that has arrived has already been written, so this only
+        takes as long as rewriting the header.
+
+        """
+        if self.ringBufferSize:
+            nVols = self.maxVolIdx + 1
+        else:
+            nVols = self.numSlots
+
+        # incomplete vols haven't been queued yet; save what arrived
+        for volIdx in range(nVols):
+            if self.isRetained(volIdx):
+                self.queueWrite(volIdx)
+        self.writeQ.put(None)
+        self.writerThread.join()
+        if self.writerFailed:
+            self.logger.error('{} is incomplete; not every volume could be written'.format(
+                self.imageMatrixFile))
+            try:
+                self.writerFile.close()
+            except OSError:
+                pass
+            self.writerThread = None
+            return
+
+        hdr = self.buildNiftiHeader(self.imageMatrix.shape[:3] + (nVols,),
+                                    self.imageMatrix.dtype)
+        if self.niftiWriter == 'nii.gz':
+            self.writerFile.seek(0)
+            self.writerFile.write(self.gzipHeader(hdr))
+        else:
+            volBytes = self.imageMatrix[:, :, :, 0].nbytes
+            self.writerFile.truncate(int(hdr.get_data_offset()) + nVols * volBytes)
+            self.writerFile.seek(0)
+            hdr.write_to(self.writerFile)
+        self.writerFile.flush()
+        os.fsync(self.writerFile.fileno())
+        self.writerFile.close()
+        self.writerThread = None
+
+    def wait_for_vol(self, volIdx, timeout=None):
+        """ Block until the requested vol has arrived
+
+        Parameters
+        ----------
+        volIdx : int
+            index location (0-based) of the volume you'd like to wait for
+        timeout : float, optional
+            maximum time, in seconds, to wait. Waits indefinitely if None
+
+        Returns
+        -------
+        bool
+            True if the volume has arrived, False if the wait timed out
+
+        """
+        with self.volArrived:
+            return self.volArrived.wait_for(lambda: self.isCompleted(volIdx),
+                                            timeout=timeout)
+
+    def wait_for_slices(self, volIdx, sliceIdxs, timeout=None):
+        """ Block until the requested slices of a vol have arrived
+
+        Parameters
+        ----------
+        volIdx : int
+            index location (0-based) of the volume you'd like to wait for
+        sliceIdxs : list of ints
+            index locations (0-based), along `sliceAxis`, of the slices you'd
+            like to wait for. See also: `get_maskSlices`
+        timeout : float, optional
+            maximum time, in seconds, to wait. Waits indefinitely if None
+
+        Returns
+        -------
+        bool
+            True if the slices have arrived, False if the wait timed out
+
+        """
+        def slicesArrived():
+            if self.isCompleted(volIdx):
+                return True
+            if self.completedSlices is None or not self.isRetained(volIdx):
+                return False
+            return self.completedSlices[self.slotIndex(volIdx), sliceIdxs].all()
+
+        with self.volArrived:
+            return self.volArrived.wait_for(slicesArrived, timeout=timeout)
+
+    def get_maskSlices(self, mask):
+        """ Return the slices that contain any voxels of the mask
+
+        Should be called once the scan has started, since the slice axis is
+        set by the incoming series.
+
+        Parameters
+        ----------
+        mask : numpy-array
+            3D boolean array, in the same space as the incoming volumes
+
+        Returns
+        -------
+        numpy-array
+            index locations (0-based), along `sliceAxis`, of every slice that
+            contains at least one mask voxel
+
+        """
+        otherAxes = tuple(ax for ax in range(3) if ax != self.sliceAxis)
+        return np.flatnonzero(np.asarray(mask).any(axis=otherAxes))
+
+    def get_compressionStats(self):
+        """ Return a summary of the compression achieved for this series
+
+        Returns
+        -------
+        dict
+            'codec', 'nMessages', 'rawBytes', 'receivedBytes', 'ratio'
+            (raw/received), and 'decodeTime' (total seconds spent decoding)
+
+        """
+        stats = dict(self.compressionStats, codec=self.compression)
+        if stats['receivedBytes'] > 0:
+            stats['ratio'] = stats['rawBytes'] / stats['receivedBytes']
+        else:
+            stats['ratio'] = None
+        return stats
+
+    def get_telemetry(self, volIdx=None):
+        """ Return the receive telemetry for one volume, or the whole series
+
+        Parameters
+        ----------
+        volIdx : int, optional
+            index (0-based) of the volume. If None, the telemetry for every
+            volume up to the latest one to arrive is returned
+
+        Returns
+        -------
+        dict or numpy structured array
+            for a single volume, a dictionary with an entry for each field in
+            TELEMETRY_DTYPE (None if nothing has arrived for the volume yet).
+            Otherwise, a copy of the telemetry table, one row per volume
+
+        """
+        with self.volArrived:
+            if volIdx is None:
+                return self.telemetry[:self.maxVolIdx + 1].copy()
+            if (volIdx < 0 or volIdx >= len(self.telemetry)
+                    or np.isnan(self.telemetry[volIdx]['headerTime'])):
+                return None
+            record = self.telemetry[volIdx]
+            return {field: record[field].item() for field in TELEMETRY_DTYPE.names}
+
+    def saveTelemetry(self):
+        """ Write the receive telemetry table to the series output directory
+
+        Saved as a tab-separated file, 'receiveTelemetry.tsv', with one row per
+        volume. A summary of the arrival intervals is written to the log.
+
+        """
+        telemetry = self.get_telemetry()
+        if len(telemetry) == 0:
+            return
+        fields = TELEMETRY_DTYPE.names
+        rows = np.column_stack([np.arange(len(telemetry))]
+                               + [telemetry[field] for field in fields])
+        fmt = ['%d'] + ['%d' if field == 'nBytes' else '%.6f' for field in fields]
+        np.savetxt(join(self.seriesOutputDir, 'receiveTelemetry.tsv'), rows,
+                   fmt=fmt, delimiter='\t', comments='',
+                   header='\t'.join(('volIdx',) + fields))
+
+        intervals = telemetry['interval'][~np.isnan(telemetry['interval'])]
+        if len(intervals) > 0:
+            self.logger.info('vol arrival interval: median {:.3f}s, max {:.3f}s (TR {}s); copy time: max {:.4f}s'.format(
+                np.median(intervals), intervals.max(), self.tr,
+                np.nanmax(telemetry['copyTime'])))
+
+    def maskedVolArrived(self, volIdx):
+        """ Return True if every slice within the mask has arrived for a
+        volume. Call with the `volArrived` lock held
+        """
+        if self.maskedData is None or not self.isRetained(volIdx):
+            return False
+        slotIdx = self.slotIndex(volIdx)
+        return bool(self.completedSlices[slotIdx, self.maskSliceIdxs].all())
+
+    def get_maskedVol(self, volIdx, copy=False):
+        """ Return the voxels within the mask for the requested vol
+
+        Only available with the 'maskedTimeseries' setting. The voxels are in
+        the same order as vol[mask]. With slice streaming, the masked vol is
+        available once the slices within the mask have arrived.
+
+        Parameters
+        ----------
+        volIdx : int
+            index (0-based) of the volume you want
+        copy : bool, optional
+            if True, return a copy that stays valid after the slot is reused
+
+        Returns
+        -------
+        numpy-array
+            1D view onto the masked store, one value per mask voxel (None if
+            the vol hasn't arrived yet). In ring buffer mode, only valid until
+            the slot is reused
+
+        """
+        with self.volArrived:
+            if not self.maskedVolArrived(volIdx):
+                return None
+            maskedVol = self.maskedData[:, self.slotIndex(volIdx)]
+            return maskedVol.copy() if copy else maskedVol
+
+    def get_maskedTimeseries(self, startVolIdx, endVolIdx):
+        """ Return the voxels within the mask for a window of vols
+
+        Only available with the 'maskedTimeseries' setting.
+
+        Parameters
+        ----------
+        startVolIdx : int
+            index (0-based) of the first volume in the window
+        endVolIdx : int
+            index of the volume after the last one in the window
+
+        Returns
+        -------
+        numpy-array
+            (numMaskVoxels, endVolIdx - startVolIdx) array of mask voxel
+            time-series (None if any vol in the window isn't available). A
+            view onto the masked store unless the window wraps around the
+            ring buffer
+
+        """
+        volIdxs = range(startVolIdx, endVolIdx)
+        with self.volArrived:
+            if (len(volIdxs) == 0
+                    or not all(self.maskedVolArrived(volIdx) for volIdx in volIdxs)):
+                return None
+            slotIdxs = [self.slotIndex(volIdx) for volIdx in volIdxs]
+            if slotIdxs == list(range(slotIdxs[0], slotIdxs[0] + len(slotIdxs))):
+                return self.maskedData[:, slotIdxs[0]:slotIdxs[-1] + 1]
+            return self.maskedData[:, slotIdxs]
+
     def get_affine(self):
         """ Return the affine for the current series
 
         """
         return self.affine
 
-    def get_vol(self, volIdx):
+    def get_vol(self, volIdx, allowPartial=False, copy=False):
         """ Return the requested vol, if it is here.
 
         Parameters
         ----------
         volIdx : int
             index location (0-based) of the volume you'd like to retrieve
+        allowPartial : bool, optional
+            if True, return the volume even if only some of its slices have
+            arrived (slice streaming). Missing slices will be zeros, or still
+            be filling in.
+        copy : bool, optional
+            if True, return a copy of the volume rather than a view onto the
+            image matrix. In ring buffer mode, the copy is made before the
+            slot can be reused, so it stays valid
 
         Returns
         -------
         numpy-array or None
-            3D array of voxel data for the requested volume
+            3D array of voxel data for the requested volume. In ring buffer
+            mode, None if the volume is no longer in the ring
 
         """
-        if self.completedVols[volIdx]:
-            return self.imageMatrix[:, :, :, volIdx]
-        else:
-            return None
+        # slots are only handed to a new volume with the lock held
+        with self.volArrived:
+            if not self.scanStarted or not self.isRetained(volIdx):
+                return None
+            if self.isCompleted(volIdx) or allowPartial:
+                vol = self.imageMatrix[:, :, :, self.slotIndex(volIdx)]
+                return vol.copy() if copy else vol
+            else:
+                return None
 
     def get_slice(self, volIdx, sliceIdx):
         """ Return the requested slice, if it is here.
@@ -243,8 +1569,13 @@ class ScanReceiver(Thread):
             2D array of voxel data for the requested slice
 
         """
-        if self.completedVols[volIdx]:
-            return self.imageMatrix[:, :, sliceIdx, volIdx]
+        if not self.scanStarted or not self.isRetained(volIdx):
+            return None
+        slotIdx = self.slotIndex(volIdx)
+        sliceArrived = (self.sliceAxis == 2
+                        and self.completedSlices[slotIdx, sliceIdx])
+        if self.isCompleted(volIdx) or sliceArrived:
+            return self.imageMatrix[:, :, sliceIdx, slotIdx]
         else:
             return None
 
@@ -274,9 +1605,43 @@ class ScanReceiver(Thread):
         """ Save the numpy 4D image matrix of data as a Nifti File
 
         Save the image matrix as a Nifti file in the output directory for this
-        series
+        series. If the image matrix is memory-mapped, the data is already in
+        'receivedFunc.nii', so only the header needs to be updated and the
+        file flushed to disk. With a background writer (and in ring buffer
+        mode), every volume has already been written to the output file as it
+        arrived, so only the header needs to be updated with the final number
+        of volumes. The receive telemetry is saved alongside the data.
 
         """
+        stats = self.get_compressionStats()
+        if stats['nMessages'] > 0:
+            self.logger.info('{} compression: {} messages, {} -> {} bytes (ratio {:.2f}), {:.3f}s decoding'.format(
+                stats['codec'], stats['nMessages'], stats['rawBytes'],
+                stats['receivedBytes'], stats['ratio'], stats['decodeTime']))
+        self.saveTelemetry()
+
+        # zero the slots of vols that never arrived in this series
+        if self.staleSlots is not None:
+            for slotIdx in np.flatnonzero(self.staleSlots):
+                self.clearSlot(slotIdx)
+
+        if self.niftiWriter:
+            if self.writerThread is not None:
+                self.finishWriting()
+            return
+
+        if self.imageMatrixFile is not None:
+            self.imageMatrix.flush()
+
+            # rewrite header in place (same size, so voxel data is untouched)
+            hdr = self.buildNiftiHeader(self.imageMatrix.shape,
+                                        self.imageMatrix.dtype)
+            with open(self.imageMatrixFile, 'r+b') as niiFile:
+                hdr.write_to(niiFile)
+                niiFile.flush()
+                os.fsync(niiFile.fileno())
+            return
+
         # build nifti image
         ds = nib.Nifti1Image(self.imageMatrix, self.affine)
 
@@ -290,8 +1655,13 @@ class ScanReceiver(Thread):
 
     def killServer(self):
         """ Close the thread by setting the alive flag to False """
-        self.context.destroy()
         self.alive = False
+        if self.is_alive():
+            # any blocking socket call in the thread will raise
+            # ContextTerminated, and the thread then closes its own sockets
+            self.context.term()
+        else:
+            self.context.destroy(linger=0)
 
 
 if __name__ == '__main__':
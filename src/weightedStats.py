@@ -0,0 +1,115 @@
+""" Weighted statistics of the voxels within a mask
+
+Vectorized quantiles (median, percentiles) and trimmed means, with or
+without weights. The weights of a mask don't change during a scan, so they
+are normalized to sum to one once, when the WeightedStats object is created,
+and each volume only needs a sort (weighted) or partition (unweighted) of its
+voxel values.
+
+Weighted quantiles follow the weighted median from:
+https://pypi.python.org/pypi/weightedstats/0.2, i.e. the value at which the
+cumulative weight of the sorted values passes the quantile, or the mean of
+the 2 values on either side if the cumulative weight lands exactly on it.
+
+"""
+import numpy as np
+
+
+class WeightedStats():
+    """ Quantiles and trimmed means of masked voxels, optionally weighted
+
+    """
+    def __init__(self, weights=None):
+        """ Initialize the class
+
+        Parameters
+        ----------
+        weights : numpy array, optional
+            1D array of non-negative weights, one per voxel (in the same order
+            as the data that will be passed in). If None, every voxel has the
+            same weight
+
+        """
+        if weights is None:
+            self.weights = None
+        else:
+            weights = np.asarray(weights, dtype=np.float64)
+            self.weights = weights / weights.sum()
+
+    def quantile(self, data, q):
+        """ Return the (weighted) quantile(s) of the data
+
+        Parameters
+        ----------
+        data : numpy array
+            1D array of voxel values
+        q : float or numpy array
+            quantile(s), between 0 and 1
+
+        Returns
+        -------
+        float or numpy array
+            quantile of the data for each `q`. Unweighted quantiles are
+            linearly interpolated, as with np.quantile
+
+        """
+        if self.weights is None:
+            return np.quantile(data, q)
+
+        order = np.argsort(data, kind='stable')
+        sortedData = data[order]
+        cumWeights = np.cumsum(self.weights[order])
+
+        # index of the first value whose cumulative weight passes q
+        q = np.asarray(q, dtype=np.float64)
+        above = np.minimum(np.searchsorted(cumWeights, q, side='right'), len(data) - 1)
+        below = np.maximum(above - 1, 0)
+        onBoundary = (above > 0) & np.isclose(cumWeights[below], q, rtol=1e-12, atol=0)
+        return np.where(onBoundary,
+                        (sortedData[below] + sortedData[above]) / 2,
+                        sortedData[above])
+
+    def median(self, data):
+        """ Return the (weighted) median of the data """
+        return self.quantile(data, .5)
+
+    def percentile(self, data, p):
+        """ Return the (weighted) percentile(s) of the data, `p` in 0-100 """
+        return self.quantile(data, np.asarray(p) / 100)
+
+    def trimmedMean(self, data, proportion):
+        """ Return the (weighted) mean after trimming both tails of the data
+
+        Parameters
+        ----------
+        data : numpy array
+            1D array of voxel values
+        proportion : float
+            proportion of the data (or total weight) to cut from each tail,
+            between 0 and 0.5
+
+        Returns
+        -------
+        float
+            Unweighted, the number of values cut from each tail is rounded
+            down, as with scipy.stats.trim_mean. Weighted, the values that
+            straddle a cut count with the part of their weight that is kept
+
+        """
+        if self.weights is None:
+            nCut = int(proportion * len(data))
+            if nCut == 0:
+                return np.mean(data)
+            trimmed = np.partition(data, (nCut, len(data) - nCut - 1))
+            return np.mean(trimmed[nCut:len(data) - nCut])
+
+        order = np.argsort(data, kind='stable')
+        sortedWeights = self.weights[order]
+        cumWeights = np.cumsum(sortedWeights)
+
+        # part of each value's weight within [proportion, 1 - proportion]
+        kept = np.clip(np.minimum(cumWeights, 1 - proportion)
+                       - np.maximum(cumWeights - sortedWeights, proportion), 0, None)
+        if kept.sum() == 0:
+            return self.median(data)
+        return kept.dot(data[order]) / kept.sum()
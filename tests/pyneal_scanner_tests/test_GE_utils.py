@@ -7,6 +7,7 @@ from queue import Queue
 import subprocess
 
 import zmq
+import numpy as np
 
 import pynealScanner_helper_tools as helper_tools
 
@@ -112,3 +113,48 @@ class Test_GE_utils():
         sliceProcessor.stop()
         recvSocket.stop()
         shutil.rmtree(newSeriesDir)
+
+    def test_GE_processSlice_streamSlices(self):
+        """ test GE_utils.GE_processSlice in slice streaming mode
+
+        Stream the slices of the GE test series to a ScanReceiver, and make
+        sure they reassemble into the same RAS+ series as GE_BuildNifti builds
+        """
+        from src.scanReceiver import ScanReceiver
+
+        host = '127.0.0.1'
+        port = 5575
+        GE_seriesDir = join(paths['GE_funcDir'], 'p1/e123/s1925')
+        expected = GE_utils.GE_BuildNifti(GE_seriesDir).get_niftiImage()
+
+        settings = {'pynealScannerPort': port,
+                    'pynealHost': host,
+                    'numTimepts': expected.shape[3],
+                    'launchDashboard': False,
+                    'seriesOutputDir': paths['testDataDir']}
+        scanReceiver = ScanReceiver(settings)
+        scanReceiver.daemon = True
+        scanReceiver.start()
+
+        pyneal_socket = general_utils.create_pynealSocket(host, port)
+        msg = 'hello from GE test'
+        pyneal_socket.send_string(msg)
+        pyneal_socket.recv_string()
+
+        # feed slices to the slice processor directly, in acquisition order
+        sliceProcessor = GE_utils.GE_processSlice(Queue(), pyneal_socket,
+                                                  streamSlices=True)
+        dicoms = sorted(os.listdir(GE_seriesDir), key=lambda f: int(f.split('.')[-1]))
+        for dcm in dicoms:
+            sliceProcessor.processDcmSlice(join(GE_seriesDir, dcm))
+
+        # the test series only holds the first few vols
+        nVols = len(dicoms) // sliceProcessor.nSlicesPerVol
+        assert scanReceiver.wait_for_vol(nVols - 1, timeout=5)
+        np.testing.assert_equal(scanReceiver.imageMatrix[..., :nVols],
+                                expected.get_data()[..., :nVols])
+        np.testing.assert_almost_equal(scanReceiver.get_affine(), expected.affine)
+        assert scanReceiver.completedSlices[:nVols].all()
+
+        pyneal_socket.close(linger=0)
+        scanReceiver.killServer()
@@ -1,6 +1,9 @@
 import os
 from os.path import join
 import sys
+import json
+
+import numpy as np
 
 import pynealScanner_helper_tools as helper_tools
 
@@ -85,3 +88,75 @@ class Test_general_utils:
             helper_tools.cleanConfigFile(configFile)
 
             print('Passed!')
+
+    def test_PynealSender(self):
+        """ test general_utils.PynealSender with a window of in-flight vols """
+        host = '127.0.0.1'
+        port = 5565
+        nVols = 5
+        window = 3
+
+        # start simulated pyneal-side socket to receive data
+        recvSocket = helper_tools.SimRecvSocket(host, port, nVols)
+        recvSocket.daemon = True
+        recvSocket.start()
+
+        # connect to simulated pyneal socket
+        pyneal_socket = general_utils.create_pynealSocket(host, port)
+        pyneal_socket.send_string('hello from PynealSender test')
+        pyneal_socket.recv_string()
+
+        sender = general_utils.PynealSender(pyneal_socket, window=window)
+        imageData = (np.random.rand(8, 8, 4, nVols) * 100).astype(np.uint16)
+        for volIdx in range(nVols):
+            thisVol = np.ascontiguousarray(imageData[:, :, :, volIdx])
+            volHeader = {'volIdx': volIdx,
+                         'TR': '1',
+                         'dtype': str(thisVol.dtype),
+                         'shape': thisVol.shape,
+                         'affine': json.dumps(np.eye(4).tolist())}
+            sender.sendVolume(volHeader, thisVol)
+
+            # never more than `window` unconfirmed volumes
+            assert sender.inFlight < window
+
+        # wait for every confirmation
+        assert sender.flush() == 'got it'
+        assert sender.inFlight == 0
+        recvSocket.join(timeout=5)
+        assert recvSocket.receivedVols == nVols
+        recvSocket.stop()
+
+    def test_PynealSender_compressionDeclined(self):
+        """ test general_utils.PynealSender falls back to raw data if Pyneal
+        does not accept the proposed compression codec
+        """
+        host = '127.0.0.1'
+        port = 5566
+        nVols = 2
+
+        # simulated pyneal-side socket doesn't know about compression
+        recvSocket = helper_tools.SimRecvSocket(host, port, nVols)
+        recvSocket.daemon = True
+        recvSocket.start()
+
+        pyneal_socket = general_utils.create_pynealSocket(host, port)
+        pyneal_socket.send_string('hello from PynealSender test')
+        pyneal_socket.recv_string()
+
+        sender = general_utils.PynealSender(pyneal_socket, compression='zlib-delta')
+        imageData = (np.random.rand(8, 8, 4, nVols) * 100).astype(np.uint16)
+        for volIdx in range(nVols):
+            thisVol = np.ascontiguousarray(imageData[:, :, :, volIdx])
+            volHeader = {'volIdx': volIdx,
+                         'TR': '1',
+                         'dtype': str(thisVol.dtype),
+                         'shape': thisVol.shape,
+                         'affine': json.dumps(np.eye(4).tolist())}
+            assert sender.sendVolume(volHeader, thisVol) == 'got it'
+
+        assert sender.compression is None
+        assert sender.get_compressionStats()['nMessages'] == 0
+        recvSocket.join(timeout=5)
+        assert recvSocket.receivedVols == nVols
+        recvSocket.stop()
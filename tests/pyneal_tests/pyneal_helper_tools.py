@@ -2,6 +2,8 @@ import os
 from os.path import join
 from os.path import dirname
 import shutil
+import json
+import struct
 import sys
 from threading import Thread
 import time
@@ -74,10 +76,20 @@ class SimRecvSocket(Thread):
             sock.send_string(msg)
             break
 
+        seriesInfo = None
         while self.alive:
 
-            # receive header info as json
-            volInfo = sock.recv_json(flags=0)
+            # receive header info (json, or binary for protocol version 2)
+            header = sock.recv(flags=0)
+            if header[:1] == b'{':
+                volInfo = json.loads(header.decode())
+                if 'protocolVersion' in volInfo:
+                    seriesInfo = volInfo
+                    sock.send_string('received seriesHeader')
+                    continue
+            else:
+                volInfo = dict(seriesInfo)
+                volInfo['volIdx'] = struct.unpack('<4sIId', header)[1]
 
             # retrieve relevant values about this slice
             volIdx = volInfo['volIdx']
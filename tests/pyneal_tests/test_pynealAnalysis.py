@@ -1,6 +1,7 @@
 import os
 from os.path import join
 import sys
+import time
 
 import numpy as np
 import nibabel as nib
@@ -13,6 +14,8 @@ if paths['pynealDir'] not in sys.path:
         sys.path.insert(0, paths['pynealDir'])
 
 from src.pynealAnalysis import Analyzer
+from src.pynealAnalysis import loadMaskPlan, maskPlanFile
+from src.weightedStats import WeightedStats
 
 maskFile = join(paths['testDataDir'], 'testSeries_mask.nii.gz')
 seriesFile = join(paths['testDataDir'], 'testSeries.nii.gz')
@@ -47,6 +50,21 @@ class Test_pynealAnalysis:
         # use np testing method to assert with customized precision
         np.testing.assert_almost_equal(results, expectedResults, decimal=2)
 
+    def test_averageFromMaskedVol(self):
+        """ test Analyzer computing average signal from pre-gathered mask voxels """
+        settings = {'maskFile': maskFile,
+                    'analysisChoice': 'Average',
+                    'maskIsWeighted': True}
+        analyzer = Analyzer(settings)
+
+        seriesData = nib.load(seriesFile)
+        for volIdx in range(seriesData.shape[3]):
+            thisVol = seriesData.get_data()[:, :, :, volIdx]
+            result = analyzer.runAnalysis(thisVol, volIdx,
+                                          maskedVol=thisVol[analyzer.mask])
+            assert result == analyzer.runAnalysis(thisVol, volIdx)
+            assert isinstance(result['weightedAverage'], float)
+
     def test_weightedAverage(self):
         """ test Analyzer computing weighted average signal within mask """
         # settings dictionary for this test
@@ -155,3 +173,216 @@ class Test_pynealAnalysis:
 
         # use np testing method to assert with customized precision
         np.testing.assert_almost_equal(results, expectedResults, decimal=2)
+
+    def test_weightedStats(self):
+        """ test weighted quantiles and trimmed means against direct computations """
+        rng = np.random.default_rng(0)
+        data = rng.normal(1000, 50, 201)
+        weights = rng.random(201)
+
+        # unweighted matches numpy/scipy
+        stats = WeightedStats()
+        assert stats.median(data) == np.median(data)
+        np.testing.assert_allclose(stats.percentile(data, [10, 90]),
+                                   np.percentile(data, [10, 90]))
+        sortedData = np.sort(data)
+        np.testing.assert_allclose(stats.trimmedMean(data, .1), sortedData[20:181].mean())
+
+        # weighted: the value where the cumulative weight passes the quantile
+        stats = WeightedStats(weights)
+        order = np.argsort(data)
+        cumWeights = np.cumsum(weights[order]) / weights.sum()
+        for q in [.1, .5, .9]:
+            expected = data[order][np.nonzero(cumWeights > q)[0][0]]
+            assert stats.quantile(data, q) == expected
+        assert stats.median(data) == stats.percentile(data, 50)
+
+        # equal weights land between the 2 middle values of an even number of values
+        stats = WeightedStats(np.ones(4))
+        assert stats.median(np.array([4., 1., 3., 2.])) == 2.5
+
+        # weighted trimmed mean counts the part of each weight that's kept
+        stats = WeightedStats(np.array([1., 1., 2.]))
+        assert stats.trimmedMean(np.array([10., 20., 30.]), .25) == (20 * .25 + 30 * .25) / .5
+        np.testing.assert_allclose(WeightedStats(np.ones(201)).trimmedMean(data, .1),
+                                   sortedData[20:181].mean(), rtol=1e-3)
+
+    def test_maskPlan(self):
+        """ test compiling the mask into a plan, and caching it """
+        maskData = nib.load(maskFile).get_data()
+        mask = maskData > 0
+        planFile = maskPlanFile(maskFile)
+        assert planFile == join(paths['testDataDir'], 'testSeries_mask_maskPlan.npz')
+
+        plan = loadMaskPlan(maskFile, True, useCache=True)
+        assert os.path.exists(planFile)
+        assert plan.flatIdx.dtype == np.int32
+        assert plan.weights.dtype == np.float32
+        assert plan.nVoxels == mask.sum()
+        np.testing.assert_allclose(plan.weights.sum(), 1, rtol=1e-6)
+        np.testing.assert_allclose(plan.weights, maskData[mask] / maskData[mask].sum(), rtol=1e-6)
+
+        # the cached plan is only used for the same weighting
+        cachedPlan = loadMaskPlan(maskFile, True, useCache=True)
+        np.testing.assert_array_equal(cachedPlan.flatIdx, plan.flatIdx)
+        np.testing.assert_array_equal(cachedPlan.weights, plan.weights)
+        unweightedPlan = loadMaskPlan(maskFile, False, useCache=True)
+        np.testing.assert_array_equal(unweightedPlan.weights, np.float32(1 / mask.sum()))
+        os.remove(planFile)
+
+        # gather the mask voxels from a volume within a 4D series (not contiguous)
+        seriesData = np.asanyarray(nib.load(seriesFile).dataobj)
+        for volIdx in range(seriesData.shape[3]):
+            thisVol = seriesData[:, :, :, volIdx]
+            np.testing.assert_array_equal(plan.take(thisVol), thisVol[mask])
+            np.testing.assert_array_equal(plan.take(thisVol.copy()), thisVol[mask])
+
+    def test_atlas(self):
+        """ test Analyzer computing the average of every ROI in an atlas """
+        # split the mask into 3 ROIs along x, with non-consecutive labels
+        maskImg = nib.load(maskFile)
+        weightData = maskImg.get_data()
+        mask = weightData > 0
+        labelData = np.zeros(mask.shape, dtype=np.int16)
+        x = np.indices(mask.shape)[0]
+        bounds = np.percentile(x[mask], [33, 66])
+        labelData[mask] = np.array([9, 2, 5])[np.searchsorted(bounds, x[mask])]
+        atlasFile = join(paths['testDataDir'], 'testSeries_atlas.nii.gz')
+        nib.save(nib.Nifti1Image(labelData, maskImg.affine), atlasFile)
+
+        seriesData = nib.load(seriesFile)
+        for weightsFile in [None, maskFile]:
+            settings = {'maskFile': maskFile,
+                        'analysisChoice': 'Atlas',
+                        'atlasFile': atlasFile,
+                        'atlasWeightsFile': weightsFile,
+                        'maskIsWeighted': False,
+                        'maskPlanCache': True}
+            for cached in [False, True]:
+                analyzer = Analyzer(settings)
+                np.testing.assert_array_equal(analyzer.atlasPlan.labels, [2, 5, 9])
+                for volIdx in range(seriesData.shape[3]):
+                    thisVol = seriesData.get_data()[:, :, :, volIdx]
+                    result = analyzer.runAnalysis(thisVol, volIdx)
+                    key = 'roiAverages' if weightsFile is None else 'weightedRoiAverages'
+                    expected = []
+                    for label in [2, 5, 9]:
+                        roi = labelData == label
+                        weights = None if weightsFile is None else weightData[roi]
+                        expected.append(np.average(thisVol[roi], weights=weights))
+                    np.testing.assert_almost_equal(result[key], expected, decimal=2)
+            os.remove(join(paths['testDataDir'], 'testSeries_atlas_atlasPlan.npz'))
+        os.remove(atlasFile)
+        os.remove(maskPlanFile(maskFile))
+
+    def test_concurrentAnalyses(self):
+        """ test Analyzer running a list of analyses concurrently """
+        # custom analysis that is too slow on the first volume
+        slowScript = join(paths['testDataDir'], 'test_slowAnalysisScript.py')
+        with open(slowScript, 'w') as f:
+            f.write('import time\n\n'
+                    'class CustomAnalysis:\n'
+                    '    def __init__(self, maskFile, weightMask, numTimepts):\n'
+                    '        pass\n\n'
+                    '    def compute(self, vol, volIdx):\n'
+                    '        time.sleep(1 if volIdx == 0 else 0)\n'
+                    '        return {\'slowResult\': volIdx}\n')
+
+        settings = {'maskFile': maskFile,
+                    'numTimepts': 3,
+                    'maskIsWeighted': False,
+                    'analysisChoice': ['Average',
+                                       {'name': 'weighted', 'analysisChoice': 'Median',
+                                        'maskIsWeighted': True},
+                                       {'analysisChoice': slowScript, 'analysisTimeout': .5}]}
+        analyzer = Analyzer(settings)
+        assert analyzer.analysisNames == ['Average', 'weighted', 'test_slowAnalysisScript']
+
+        seriesData = nib.load(seriesFile)
+        expectedAverages = [1029.15, 1032.78, 1034.14]
+        expectedMedians = [1000.00, 1014.00, 1012.00]
+        for volIdx in range(seriesData.shape[3]):
+            thisVol = seriesData.get_data()[:, :, :, volIdx]
+            result = analyzer.runAnalysis(thisVol, volIdx)
+
+            np.testing.assert_almost_equal(result['average'], expectedAverages[volIdx], decimal=2)
+            np.testing.assert_almost_equal(result['weighted_weightedMedian'],
+                                           expectedMedians[volIdx], decimal=2)
+            times = analyzer.get_analysisTimes(volIdx)
+            assert list(times) == analyzer.analysisNames
+            if volIdx < 2:
+                # the second volume arrives while the slow analysis is still
+                # busy with the first, and is skipped
+                assert result['timedOut'] == ['test_slowAnalysisScript']
+                assert 'slowResult' not in result
+                assert np.isnan(times['test_slowAnalysisScript'])
+                if volIdx == 1:
+                    time.sleep(1)
+            else:
+                assert result['slowResult'] == volIdx
+                assert 'timedOut' not in result
+
+        os.remove(slowScript)
+
+    def test_customAnalysisProcess(self):
+        """ test Analyzer computing customAnalysis in a worker process """
+        settings = {'maskFile': maskFile,
+                    'numTimepts': 3,
+                    'analysisChoice': join(paths['testDataDir'], 'test_customAnalysisScript.py'),
+                    'maskIsWeighted': False,
+                    'customAnalysisProcess': True}
+        analyzer = Analyzer(settings)
+
+        seriesData = nib.load(seriesFile)
+        results = []
+        for volIdx in range(seriesData.shape[3]):
+            thisVol = seriesData.get_data()[:, :, :, volIdx]
+            result = analyzer.runAnalysis(thisVol, volIdx)
+            results.append(result['customResult'])
+        analyzer.stop()
+
+        expectedResults = np.array([1029.15, 1032.78, 1034.14])
+        np.testing.assert_almost_equal(np.array(results), expectedResults, decimal=2)
+
+        # custom analysis that misses the deadline on the first volume it gets
+        slowScript = join(paths['testDataDir'], 'test_slowProcessScript.py')
+        with open(slowScript, 'w') as f:
+            f.write('import time\n\n'
+                    'firstCall = [True]\n\n'
+                    'class CustomAnalysis:\n'
+                    '    def __init__(self, maskFile, weightMask, numTimepts):\n'
+                    '        pass\n\n'
+                    '    def compute(self, vol, volIdx):\n'
+                    '        if firstCall:\n'
+                    '            firstCall.pop()\n'
+                    '            time.sleep(1.5)\n'
+                    '        return {\'slowResult\': volIdx}\n')
+        settings.update({'analysisChoice': slowScript, 'customAnalysisDeadline': .5})
+        analyzer = Analyzer(settings)
+        thisVol = seriesData.get_data()[:, :, :, 0]
+        assert analyzer.runAnalysis(thisVol, 0) == {'late': True}
+
+        # the late volume doesn't hold up the next series
+        analyzer.resetSeries()
+        time.sleep(2)
+        for volIdx in range(seriesData.shape[3]):
+            thisVol = seriesData.get_data()[:, :, :, volIdx]
+            assert analyzer.runAnalysis(thisVol, volIdx) == {'slowResult': volIdx}
+        analyzer.stop()
+
+        # a worker that dies doesn't hang Pyneal, even without a deadline
+        with open(slowScript, 'w') as f:
+            f.write('import os\n\n'
+                    'class CustomAnalysis:\n'
+                    '    def __init__(self, maskFile, weightMask, numTimepts):\n'
+                    '        pass\n\n'
+                    '    def compute(self, vol, volIdx):\n'
+                    '        os._exit(1)\n')
+        del settings['customAnalysisDeadline']
+        analyzer = Analyzer(settings)
+        for volIdx in range(2):
+            thisVol = seriesData.get_data()[:, :, :, volIdx]
+            assert 'error' in analyzer.runAnalysis(thisVol, volIdx)
+        analyzer.stop()
+
+        os.remove(slowScript)
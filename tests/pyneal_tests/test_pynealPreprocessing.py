@@ -4,6 +4,8 @@ import sys
 
 import numpy as np
 import nibabel as nib
+import pytest
+from scipy.ndimage import gaussian_filter
 
 import pyneal_helper_tools as helper_tools
 
@@ -14,9 +16,15 @@ if paths['pynealDir'] not in sys.path:
 
 from src.pynealPreprocessing import Preprocessor
 from src.pynealPreprocessing import MotionProcessor
+from src.pynealPreprocessing import ReferenceRegistration
+from src.pynealPreprocessing import AsyncMotionProcessor
+from src.pynealPreprocessing import RunningStats
+from src.rigidRegistration import rigidMatrix, rigidParams, trilinear
+from nipy.algorithms.registration import HistogramRegistration
 
 # inputs to preprocessor
 seriesFile = join(paths['testDataDir'], 'testSeries.nii.gz')
+maskFile = join(paths['testDataDir'], 'testSeries_mask.nii.gz')
 settings = {'launchDashboard': False, 'estimateMotion': True}
 
 class Test_pynealPreprocessing:
@@ -62,3 +70,246 @@ class Test_pynealPreprocessing:
         rms_rel_results = np.array(rms_rel_results)
         expected_rel_results = np.array([0.002865, 0.0024558])
         np.testing.assert_almost_equal(rms_rel_results, expected_rel_results, decimal=6)
+
+    def test_referenceRegistration(self):
+        # registration built once from the reference vol should match a new
+        # registration object for each vol
+        seriesData = nib.load(seriesFile)
+        refVol = nib.Nifti1Image(seriesData.get_data()[:, :, :, 0], np.eye(4))
+        refReg = ReferenceRegistration(refVol, interp='tri')
+        for volIdx in range(1, seriesData.shape[3]):
+            thisVol_nii = nib.Nifti1Image(seriesData.get_data()[:, :, :, volIdx], np.eye(4))
+            refReg.set_from_img(thisVol_nii)
+            reg = HistogramRegistration(thisVol_nii, refVol, interp='tri')
+            for attr in ['_from_data', '_from_affine', '_vox_coords', '_to_data',
+                         '_to_inv_affine']:
+                np.testing.assert_equal(getattr(refReg, attr), getattr(reg, attr))
+
+    def test_asyncMotionProcessor(self):
+        # motion estimated in the worker process should match estimating it
+        # in this process
+        motionProcessor = MotionProcessor(refVolIdx=0)
+        motionLogFile = join(paths['testDataDir'], 'motionLog.tsv')
+        asyncResults = []
+        asyncMotionProcessor = AsyncMotionProcessor(
+            refVolIdx=0, motionLogFile=motionLogFile,
+            motionCallback=lambda volIdx, params: asyncResults.append(params['rms_abs']))
+
+        seriesData = nib.load(seriesFile)
+        rms_abs_results = []
+        for volIdx in range(seriesData.shape[3]):
+            thisVol = seriesData.get_data()[:, :, :, volIdx]
+            asyncMotionProcessor.submitVolume(thisVol, np.eye(4), volIdx)
+
+            motionParams = motionProcessor.estimateMotion(
+                nib.Nifti1Image(thisVol, np.eye(4)), volIdx)
+            if motionParams is not None:
+                rms_abs_results.append(motionParams['rms_abs'])
+        asyncMotionProcessor.stop()
+
+        np.testing.assert_equal(asyncResults, rms_abs_results)
+        motionLog = np.genfromtxt(motionLogFile, names=True, delimiter='\t')
+        np.testing.assert_equal(motionLog['volIdx'], [1, 2])
+        np.testing.assert_almost_equal(motionLog['rms_abs'], rms_abs_results, decimal=6)
+        os.remove(motionLogFile)
+
+        # stopping doesn't hang if the worker has died
+        asyncMotionProcessor = AsyncMotionProcessor(refVolIdx=0)
+        asyncMotionProcessor.submitVolume(seriesData.get_data()[:, :, :, 0], np.eye(4), 0)
+        asyncMotionProcessor.worker.kill()
+        asyncMotionProcessor.stop(timeout=1)
+        assert asyncMotionProcessor.worker is None
+
+    def test_estimateMotion_numpyBackend(self):
+        # move the first vol of the test series by known amounts, and check
+        # that the motion estimates match
+        seriesData = nib.load(seriesFile)
+        refVol = seriesData.get_data()[:, :, :, 0].astype(np.float64)
+        affine = seriesData.affine
+        center = affine[:3, :3].dot((np.array(refVol.shape) - 1) / 2) + affine[:3, 3]
+        voxCoords = np.indices(refVol.shape).reshape(3, -1)
+        worldCoords = affine[:3, :3].dot(voxCoords) + affine[:3, [3]]
+        invAffine = np.linalg.inv(affine)
+
+        motionProcessor = MotionProcessor(refVolIdx=0, backend='numpy')
+        params = [np.zeros(6),
+                  np.array([.5, 0, -.3, 0, np.deg2rad(.5), 0]),
+                  np.array([.8, -.4, -.3, np.deg2rad(.3), np.deg2rad(.5), 0])]
+        transforms = [rigidMatrix(p, center) for p in params]
+        for volIdx, T in enumerate(transforms):
+            refCoords = T[:3, :3].dot(worldCoords) + T[:3, [3]]
+            refVox = invAffine[:3, :3].dot(refCoords) + invAffine[:3, [3]]
+            samples, valid = trilinear(refVol[..., np.newaxis], refVox)
+            movedVol = np.where(valid, samples[:, 0], 0).reshape(refVol.shape)
+
+            motionParams = motionProcessor.estimateMotion(
+                nib.Nifti1Image(movedVol, affine), volIdx)
+            if volIdx > 0:
+                trueAbs = motionProcessor.computeRMS(transforms[0], T)
+                trueRel = motionProcessor.computeRMS(transforms[volIdx - 1], T)
+                assert abs(motionParams['rms_abs'] - trueAbs) < .05
+                assert abs(motionParams['rms_rel'] - trueRel) < .05
+
+    def test_motionCorrection(self):
+        # hold the first vol of the test series still until the reference vol
+        # (volIdx 4), then move it, and check that the mask voxels are moved
+        # back to where they were
+        seriesData = nib.load(seriesFile)
+        refVol = seriesData.get_data()[:, :, :, 0].astype(np.float64)
+        affine = seriesData.affine
+        mask = nib.load(maskFile).get_data() > 0
+        center = affine[:3, :3].dot((np.array(refVol.shape) - 1) / 2) + affine[:3, 3]
+        voxCoords = np.indices(refVol.shape).reshape(3, -1)
+        worldCoords = affine[:3, :3].dot(voxCoords) + affine[:3, [3]]
+        invAffine = np.linalg.inv(affine)
+
+        T = rigidMatrix(np.array([3, -2, 1.5, 0, np.deg2rad(2), 0]), center)
+        refCoords = T[:3, :3].dot(worldCoords) + T[:3, [3]]
+        refVox = invAffine[:3, :3].dot(refCoords) + invAffine[:3, [3]]
+        samples, valid = trilinear(refVol[..., np.newaxis], refVox)
+        movedVol = np.where(valid, samples[:, 0], 0).reshape(refVol.shape)
+
+        preprocessor = Preprocessor({'launchDashboard': False,
+                                     'estimateMotion': True,
+                                     'motionCorrection': True,
+                                     'motionBackend': 'numpy',
+                                     'maskFile': maskFile})
+        preprocessor.set_affine(affine)
+        for volIdx in range(5):
+            preprocessor.runPreprocessing(refVol, volIdx)
+        correctedVol = preprocessor.runPreprocessing(movedVol, 5)
+        maskedVol = preprocessor.get_maskedVol(5)
+
+        assert preprocessor.get_maskedVol(4) is None
+        np.testing.assert_array_equal(correctedVol[mask], maskedVol)
+        np.testing.assert_array_equal(correctedVol[~mask], movedVol[~mask])
+        uncorrectedError = np.abs(movedVol[mask] - refVol[mask]).mean()
+        correctedError = np.abs(maskedVol - refVol[mask]).mean()
+        assert correctedError < uncorrectedError / 4
+
+    def test_preprocessingStages(self):
+        # run a pipeline of configured stages, and check the output and timing
+        seriesData = nib.load(seriesFile)
+        stageSettings = {'launchDashboard': False, 'estimateMotion': False,
+                         'motionBackend': 'numpy', 'smoothingFWHM': 6,
+                         'preprocessingStages': ['estimateMotion', 'smoothing'],
+                         'seriesOutputDir': paths['testDataDir']}
+        preprocessor = Preprocessor(stageSettings)
+        preprocessor.set_affine(seriesData.affine)
+        assert [stage.name for stage in preprocessor.stages] == ['estimateMotion', 'smoothing']
+        assert preprocessor.altersVoxels
+        assert preprocessor.needsFullVolume
+
+        voxSize = np.linalg.norm(seriesData.affine[:3, :3], axis=0)
+        for volIdx in range(6):
+            thisVol = seriesData.get_data()[:, :, :, volIdx % seriesData.shape[3]]
+            preprocVol = preprocessor.runPreprocessing(thisVol, volIdx)
+            expectedVol = gaussian_filter(thisVol.astype(np.float64),
+                                          6 / np.sqrt(8 * np.log(2)) / voxSize,
+                                          mode='nearest')
+            np.testing.assert_allclose(preprocVol, expectedVol)
+            assert list(preprocessor.get_stageTimes(volIdx)) == ['estimateMotion', 'smoothing']
+        assert preprocessor.get_maskedVol(5) is None
+
+        # timing is written out with the results
+        preprocessor.saveResults()
+        timesFile = join(paths['testDataDir'], 'preprocessingTimes.tsv')
+        times = np.loadtxt(timesFile, skiprows=1)
+        os.remove(timesFile)
+        assert times.shape == (6, 3)
+        np.testing.assert_array_equal(times[:, 0], np.arange(6))
+
+        # stages missing what they require are skipped, unknown stages aren't allowed
+        stageSettings['preprocessingStages'] = ['motionCorrection', 'smoothing']
+        preprocessor = Preprocessor(stageSettings)
+        assert [stage.name for stage in preprocessor.stages] == ['smoothing']
+        stageSettings['preprocessingStages'] = ['despiking']
+        with pytest.raises(ValueError):
+            Preprocessor(stageSettings)
+
+    def test_runningStats(self):
+        # compare the running stats with stats computed over the full history
+        rng = np.random.default_rng(0)
+        data = rng.normal(100, 10, size=(40, 50))
+        for baseline in ['cumulative', 'exponential', 'window']:
+            stats = RunningStats(50, baseline=baseline, alpha=.1, window=8)
+            for t in range(len(data)):
+                stats.update(data[t])
+                if baseline == 'cumulative':
+                    history = data[:t + 1]
+                elif baseline == 'window':
+                    history = data[max(0, t - 7):t + 1]
+                else:
+                    continue
+                np.testing.assert_allclose(stats.mean, history.mean(axis=0))
+                if len(history) > 1:
+                    np.testing.assert_allclose(stats.var, history.var(axis=0, ddof=1))
+
+            if baseline == 'exponential':
+                # weights decay by (1 - alpha) per volume
+                weights = .1 * .9 ** np.arange(len(data) - 1)[::-1]
+                weights = np.r_[.9 ** (len(data) - 1), weights]
+                expectedMean = weights.dot(data)
+                np.testing.assert_allclose(stats.mean, expectedMean)
+
+    def test_runningStatsStage(self):
+        # the stage z-scores the mask voxels against the previous volumes
+        mask = nib.load(maskFile).get_data() > 0
+        rng = np.random.default_rng(0)
+        series = rng.normal(100, 10, size=mask.shape + (6,))
+        preprocessor = Preprocessor({'launchDashboard': False,
+                                     'estimateMotion': False,
+                                     'preprocessingStages': ['runningStats'],
+                                     'runningStatsBaselineVols': 4,
+                                     'maskFile': maskFile})
+        for volIdx in range(series.shape[3]):
+            preprocVol = preprocessor.runPreprocessing(series[..., volIdx], volIdx)
+            maskedVol = preprocessor.get_maskedVol(volIdx)
+            np.testing.assert_array_equal(preprocVol[mask], maskedVol)
+            assert np.all(preprocVol[~mask] == 0)
+
+            baseline = series[mask][:, :min(volIdx, 4)]
+            if volIdx < 2:
+                assert np.all(maskedVol == 0)
+            else:
+                expected = ((series[..., volIdx][mask] - baseline.mean(axis=1))
+                            / baseline.std(axis=1, ddof=1))
+                np.testing.assert_allclose(maskedVol, expected)
+
+    def test_nuisanceRegression(self):
+        # the cleaned signal at each volume should match a batch fit of the
+        # nuisance regressors to every volume so far
+        mask = nib.load(maskFile).get_data() > 0
+        numTimepts = 30
+        t = np.arange(numTimepts)
+        rng = np.random.default_rng(0)
+        nuisance = .5 * t + 4 * np.cos(np.pi * (t + .5) / numTimepts)
+        series = (rng.normal(100, 5, size=mask.shape + (numTimepts,))
+                  + nuisance + rng.normal(0, 1, numTimepts))
+
+        for level in ['roi', 'voxel']:
+            preprocessor = Preprocessor({'launchDashboard': False,
+                                         'estimateMotion': False,
+                                         'preprocessingStages': ['nuisanceRegression'],
+                                         'nuisanceLevel': level,
+                                         'nuisanceCosines': 2,
+                                         'numTimepts': numTimepts,
+                                         'maskFile': maskFile})
+            stage = preprocessor.get_stage('nuisanceRegression')
+            X = np.array([stage.regressors(volIdx) for volIdx in range(numTimepts)])
+            for volIdx in range(numTimepts):
+                preprocessor.runPreprocessing(series[..., volIdx], volIdx)
+                maskedVol = preprocessor.get_maskedVol(volIdx)
+                if volIdx < 10:
+                    continue
+
+                Y = series[mask].T[:volIdx + 1]
+                if level == 'roi':
+                    Y = Y.mean(axis=1, keepdims=True)
+                beta = np.linalg.lstsq(X[:volIdx + 1], Y, rcond=None)[0]
+                expected = series[..., volIdx][mask] - X[volIdx, 1:].dot(beta[1:])
+                np.testing.assert_allclose(maskedVol, expected)
+
+        # motion params are recovered from the estimated transform
+        params = np.array([1, -.5, .2, .01, -.02, .03])
+        np.testing.assert_allclose(rigidParams(rigidMatrix(params)), params)
@@ -3,6 +3,10 @@ from os.path import join
 import sys
 import socket
 import json
+import struct
+import time
+import zlib
+from threading import Thread
 
 import zmq
 import numpy as np
@@ -19,18 +23,15 @@ port = 5555
 host = '127.0.0.1'
 
 
-from src.scanReceiver import ScanReceiver
+from src.scanReceiver import (ScanReceiver, VOL_HEADER_FORMAT, VOL_HEADER_MAGIC,
+                              SLICE_HEADER_FORMAT, SLICE_HEADER_MAGIC,
+                              VOL_FLAG_ZLIB, VOL_FLAG_DELTA)
 
-# Tests for functions within the resultsServer module
-def test_resultsServer():
-    """ tests pyneal.src.resultsServer """
 
-    # create settings dictionary
-    settings = {'pynealScannerPort': port,
-                'pynealHost': host,
-                'numTimepts': 3,
-                'launchDashboard': False,
-                'seriesOutputDir': paths['testDataDir']}
+def startScanReceiver(settings):
+    """ Launch a ScanReceiver thread and connect a simulated Pyneal Scanner
+    socket to it. Returns the scanReceiver and the connected socket
+    """
     scanReceiver = ScanReceiver(settings)
     scanReceiver.daemon = True
     scanReceiver.start()
@@ -38,7 +39,8 @@ def test_resultsServer():
     # Set up Pyneal Scanner simulator for making a connection to the scanReceiver
     context = zmq.Context.instance()
     socket = context.socket(zmq.PAIR)
-    socket.connect('tcp://{}:{}'.format(host, port))
+    socket.connect('tcp://{}:{}'.format(settings['pynealHost'],
+                                        settings['pynealScannerPort']))
 
     while True:
         msg = 'hello from test pyneal scanner simulator'
@@ -47,11 +49,11 @@ def test_resultsServer():
         if resp == msg:
             break
 
-    # Send data to scan receiver
-    ds = nib.load(join(paths['testDataDir'], 'testSeries.nii.gz'))
-    ds_array = ds.get_data()
-    ds_affine = ds.affine
+    return scanReceiver, socket
 
+
+def sendTestSeries(socket, ds_array, ds_affine, protocolVersion=1):
+    """ Send every volume in the 4D test series over the supplied socket """
     for volIdx in range(ds_array.shape[3]):
         # grab this volume from the dataset
         thisVol = np.ascontiguousarray(ds_array[:, :, :, volIdx])
@@ -63,8 +65,18 @@ def test_resultsServer():
                      'affine': json.dumps(ds_affine.tolist()),
                      'TR': str(1000)}
 
-        # send header as json
-        socket.send_json(volHeader, zmq.SNDMORE)
+        if protocolVersion == 1:
+            # send header as json
+            socket.send_json(volHeader, zmq.SNDMORE)
+        else:
+            # series header before first vol, then binary vol headers
+            if volIdx == 0:
+                seriesHeader = dict(volHeader, protocolVersion=protocolVersion)
+                del seriesHeader['volIdx']
+                socket.send_json(seriesHeader)
+                assert socket.recv_string() == 'received seriesHeader'
+            socket.send(struct.pack(VOL_HEADER_FORMAT, VOL_HEADER_MAGIC, volIdx, 1, 0.0),
+                        zmq.SNDMORE)
 
         # now send the voxel array for this volume
         socket.send(thisVol, flags=0, copy=False, track=False)
@@ -72,6 +84,25 @@ def test_resultsServer():
         # list for response
         socketResponse = socket.recv_string()
 
+
+# Tests for functions within the resultsServer module
+def test_resultsServer():
+    """ tests pyneal.src.resultsServer """
+
+    # create settings dictionary
+    settings = {'pynealScannerPort': port,
+                'pynealHost': host,
+                'numTimepts': 3,
+                'launchDashboard': False,
+                'seriesOutputDir': paths['testDataDir']}
+    scanReceiver, socket = startScanReceiver(settings)
+
+    # Send data to scan receiver
+    ds = nib.load(join(paths['testDataDir'], 'testSeries.nii.gz'))
+    ds_array = ds.get_data()
+    ds_affine = ds.affine
+    sendTestSeries(socket, ds_array, ds_affine)
+
     # test scanReceiver get functions
     np.testing.assert_equal(scanReceiver.get_affine(), ds_affine)
     np.testing.assert_equal(scanReceiver.get_slice(1,10), ds_array[:, :, 10, 1])
@@ -80,6 +111,479 @@ def test_resultsServer():
     # test saving (then delete)
     scanReceiver.saveResults()
     os.remove(join(paths['testDataDir'], 'receivedFunc.nii.gz'))
+    telemetry = np.genfromtxt(join(paths['testDataDir'], 'receiveTelemetry.tsv'),
+                              names=True, delimiter='\t')
+    np.testing.assert_equal(telemetry['volIdx'], [0, 1, 2])
+    assert (telemetry['nBytes'] == ds_array[:, :, :, 0].nbytes).all()
+    os.remove(join(paths['testDataDir'], 'receiveTelemetry.tsv'))
 
     # assuming nothing crashed, shutdown scanReceiver server
     scanReceiver.killServer()
+
+
+def test_memmapImageMatrix():
+    """ tests ScanReceiver with the image matrix memory-mapped to disk """
+    settings = {'pynealScannerPort': port + 10,
+                'pynealHost': host,
+                'numTimepts': 3,
+                'launchDashboard': False,
+                'memmapImageMatrix': True,
+                'seriesOutputDir': paths['testDataDir']}
+    scanReceiver, socket = startScanReceiver(settings)
+
+    # Send data to scan receiver
+    ds = nib.load(join(paths['testDataDir'], 'testSeries.nii.gz'))
+    ds_array = ds.get_data()
+    ds_affine = ds.affine
+    sendTestSeries(socket, ds_array, ds_affine)
+
+    np.testing.assert_equal(scanReceiver.get_vol(2), ds_array[:, :, :, 2])
+
+    # saved file should be a valid nifti containing the full series
+    scanReceiver.saveResults()
+    savedFile = join(paths['testDataDir'], 'receivedFunc.nii')
+    saved = nib.load(savedFile)
+    np.testing.assert_equal(np.asarray(saved.dataobj), ds_array)
+    np.testing.assert_almost_equal(saved.affine, ds_affine)
+    assert saved.header.get_zooms()[3] == 1000
+    del saved
+    scanReceiver.killServer()
+    os.remove(savedFile)
+    os.remove(join(paths['testDataDir'], 'receiveTelemetry.tsv'))
+
+
+def test_volumeMajorImageMatrix():
+    """ tests ScanReceiver with each volume stored contiguously """
+    settings = {'pynealScannerPort': port + 11,
+                'pynealHost': host,
+                'numTimepts': 3,
+                'launchDashboard': False,
+                'volumeMajorImageMatrix': True,
+                'seriesOutputDir': paths['testDataDir']}
+    scanReceiver, socket = startScanReceiver(settings)
+
+    # Send data to scan receiver
+    ds = nib.load(join(paths['testDataDir'], 'testSeries.nii.gz'))
+    ds_array = ds.get_data()
+    ds_affine = ds.affine
+    sendTestSeries(socket, ds_array, ds_affine)
+
+    # volumes are contiguous, zero-copy views onto the image matrix
+    vol = scanReceiver.get_vol(1)
+    assert vol.flags['C_CONTIGUOUS']
+    assert np.shares_memory(vol, scanReceiver.imageMatrix)
+    np.testing.assert_equal(vol, ds_array[:, :, :, 1])
+    np.testing.assert_equal(scanReceiver.get_slice(2, 10), ds_array[:, :, 10, 2])
+    np.testing.assert_equal(scanReceiver.imageMatrix, ds_array)
+
+    # a payload of the wrong size is rejected
+    volHeader = {'volIdx': 2,
+                 'dtype': str(ds_array.dtype),
+                 'shape': ds_array.shape[:3],
+                 'affine': json.dumps(ds_affine.tolist()),
+                 'TR': str(1000)}
+    socket.send_json(volHeader, zmq.SNDMORE)
+    socket.send(np.ascontiguousarray(ds_array[:, :, :2, 2]))
+    assert socket.recv_string().startswith('error')
+
+    scanReceiver.killServer()
+
+
+def test_wait_for_vol():
+    """ tests blocking on ScanReceiver for the scan start and new vols """
+    settings = {'pynealScannerPort': port + 12,
+                'pynealHost': host,
+                'numTimepts': 3,
+                'launchDashboard': False,
+                'seriesOutputDir': paths['testDataDir']}
+    scanReceiver, socket = startScanReceiver(settings)
+
+    # nothing has been sent yet, so waits should time out
+    assert not scanReceiver.scan_started.wait(timeout=.05)
+    assert not scanReceiver.wait_for_vol(0, timeout=.05)
+
+    # send data to scan receiver from a separate thread
+    ds = nib.load(join(paths['testDataDir'], 'testSeries.nii.gz'))
+    ds_array = ds.get_data()
+    sender = Thread(target=sendTestSeries, args=(socket, ds_array, ds.affine))
+    sender.start()
+
+    assert scanReceiver.scan_started.wait(timeout=5)
+    for volIdx in range(ds_array.shape[3]):
+        assert scanReceiver.wait_for_vol(volIdx, timeout=5)
+        np.testing.assert_equal(scanReceiver.get_vol(volIdx),
+                                ds_array[:, :, :, volIdx])
+
+    sender.join()
+    scanReceiver.killServer()
+
+
+def test_protocolVersion2():
+    """ tests ScanReceiver with series header and binary vol headers """
+    settings = {'pynealScannerPort': port + 13,
+                'pynealHost': host,
+                'numTimepts': 3,
+                'launchDashboard': False,
+                'seriesOutputDir': paths['testDataDir']}
+    scanReceiver, socket = startScanReceiver(settings)
+
+    # Send data to scan receiver
+    ds = nib.load(join(paths['testDataDir'], 'testSeries.nii.gz'))
+    ds_array = ds.get_data()
+    ds_affine = ds.affine
+    sendTestSeries(socket, ds_array, ds_affine, protocolVersion=2)
+
+    np.testing.assert_equal(scanReceiver.get_affine(), ds_affine)
+    assert scanReceiver.tr == 1000
+    np.testing.assert_equal(scanReceiver.imageMatrix, ds_array)
+
+    # receive telemetry for each vol
+    assert scanReceiver.wait_for_vol(2, timeout=5)
+    volTelemetry = scanReceiver.get_telemetry(1)
+    assert volTelemetry['scannerTime'] == 0.0
+    assert volTelemetry['headerTime'] <= volTelemetry['payloadTime']
+    assert volTelemetry['nBytes'] == ds_array[:, :, :, 1].nbytes
+    assert volTelemetry['interval'] >= 0
+    assert volTelemetry['trDelta'] == volTelemetry['interval'] - 1000
+    telemetry = scanReceiver.get_telemetry()
+    assert len(telemetry) == 3
+    assert np.isnan(telemetry['interval'][0])
+    assert scanReceiver.get_telemetry(3) is None
+
+    scanReceiver.killServer()
+
+
+def test_sliceStreaming():
+    """ tests ScanReceiver with slices streamed one at a time """
+    settings = {'pynealScannerPort': port + 14,
+                'pynealHost': host,
+                'numTimepts': 3,
+                'launchDashboard': False,
+                'seriesOutputDir': paths['testDataDir']}
+    scanReceiver, socket = startScanReceiver(settings)
+
+    ds = nib.load(join(paths['testDataDir'], 'testSeries.nii.gz'))
+    ds_array = ds.get_data()
+    nSlices = ds_array.shape[2]
+
+    seriesHeader = {'protocolVersion': 2,
+                    'dtype': str(ds_array.dtype),
+                    'shape': ds_array.shape[:3],
+                    'affine': json.dumps(ds.affine.tolist()),
+                    'TR': str(1000),
+                    'sliceAxis': 2}
+    socket.send_json(seriesHeader)
+    assert socket.recv_string() == 'received seriesHeader'
+
+    def sendSlice(volIdx, sliceIdx):
+        socket.send(struct.pack(SLICE_HEADER_FORMAT, SLICE_HEADER_MAGIC,
+                                volIdx, 1, 0.0, sliceIdx), zmq.SNDMORE)
+        thisSlice = np.ascontiguousarray(ds_array[:, :, sliceIdx, volIdx])
+        socket.send(thisSlice, flags=0, copy=False, track=False)
+        assert socket.recv_string() == 'received volIdx {} sliceIdx {}'.format(volIdx, sliceIdx)
+
+    # mask covering only the first two slices
+    mask = np.zeros(ds_array.shape[:3], dtype=bool)
+    mask[10:20, 10:20, :2] = True
+    maskSlices = scanReceiver.get_maskSlices(mask)
+    np.testing.assert_equal(maskSlices, [0, 1])
+
+    # send the first two slices of the first vol
+    for sliceIdx in range(2):
+        sendSlice(0, sliceIdx)
+    assert scanReceiver.wait_for_slices(0, maskSlices, timeout=5)
+    assert not scanReceiver.wait_for_vol(0, timeout=.1)
+    assert scanReceiver.get_vol(0) is None
+    np.testing.assert_equal(scanReceiver.get_slice(0, 1), ds_array[:, :, 1, 0])
+    assert scanReceiver.get_slice(0, 2) is None
+
+    # send the rest of the series
+    for volIdx in range(ds_array.shape[3]):
+        for sliceIdx in range(nSlices):
+            if volIdx > 0 or sliceIdx >= 2:
+                sendSlice(volIdx, sliceIdx)
+    assert scanReceiver.wait_for_vol(ds_array.shape[3] - 1, timeout=5)
+    np.testing.assert_equal(scanReceiver.imageMatrix, ds_array)
+
+    scanReceiver.killServer()
+
+
+def test_compression():
+    """ tests ScanReceiver with compressed (and delta encoded) volumes """
+    from pyneal_scanner.utils.general_utils import PynealSender
+
+    ds = nib.load(join(paths['testDataDir'], 'testSeries.nii.gz'))
+    ds_array = ds.get_data()
+
+    for portOffset, codec in [(15, 'zlib'), (16, 'zlib-delta')]:
+        settings = {'pynealScannerPort': port + portOffset,
+                    'pynealHost': host,
+                    'numTimepts': ds_array.shape[3],
+                    'launchDashboard': False,
+                    'seriesOutputDir': paths['testDataDir']}
+        scanReceiver, socket = startScanReceiver(settings)
+
+        sender = PynealSender(socket, protocolVersion=2, compression=codec)
+        for volIdx in range(ds_array.shape[3]):
+            thisVol = np.ascontiguousarray(ds_array[:, :, :, volIdx])
+            volHeader = {'volIdx': volIdx,
+                         'dtype': str(thisVol.dtype),
+                         'shape': thisVol.shape,
+                         'affine': json.dumps(ds.affine.tolist()),
+                         'TR': str(1000)}
+            assert sender.sendVolume(volHeader, thisVol) == 'received volIdx {}'.format(volIdx)
+
+        # codec was accepted, and data arrived intact
+        assert sender.compression == codec
+        assert scanReceiver.compression == codec
+        np.testing.assert_equal(scanReceiver.imageMatrix, ds_array)
+
+        stats = scanReceiver.get_compressionStats()
+        assert stats['nMessages'] == ds_array.shape[3]
+        assert stats['ratio'] > 1
+        assert sender.get_compressionStats()['sentBytes'] == stats['receivedBytes']
+
+        scanReceiver.killServer()
+
+
+def test_ringBuffer():
+    """ tests ScanReceiver keeping only the last few vols in memory """
+    settings = {'pynealScannerPort': port + 17,
+                'pynealHost': host,
+                'numTimepts': None,
+                'ringBufferSize': 2,
+                'launchDashboard': False,
+                'seriesOutputDir': paths['testDataDir']}
+    scanReceiver, socket = startScanReceiver(settings)
+
+    # send the test series twice over, as one 6 volume series
+    ds = nib.load(join(paths['testDataDir'], 'testSeries.nii.gz'))
+    ds_array = np.concatenate([ds.get_data()] * 2, axis=3)
+    sendTestSeries(socket, ds_array, ds.affine, protocolVersion=2)
+    assert scanReceiver.imageMatrix.shape[3] == 2
+
+    # only the last 2 vols are retained, but every vol has arrived
+    assert scanReceiver.wait_for_vol(5, timeout=5)
+    assert scanReceiver.wait_for_vol(0, timeout=5)
+    assert scanReceiver.get_vol(3) is None
+    np.testing.assert_equal(scanReceiver.get_vol(4), ds_array[:, :, :, 4])
+    volCopy = scanReceiver.get_vol(4, copy=True)
+    assert not np.shares_memory(volCopy, scanReceiver.imageMatrix)
+    np.testing.assert_equal(volCopy, ds_array[:, :, :, 4])
+    np.testing.assert_equal(scanReceiver.get_slice(5, 10), ds_array[:, :, 10, 5])
+
+    # saved file should contain the full series
+    scanReceiver.saveResults()
+    savedFile = join(paths['testDataDir'], 'receivedFunc.nii')
+    saved = nib.load(savedFile)
+    np.testing.assert_equal(np.asarray(saved.dataobj), ds_array)
+    np.testing.assert_almost_equal(saved.affine, ds.affine)
+    del saved
+    scanReceiver.killServer()
+    os.remove(savedFile)
+    os.remove(join(paths['testDataDir'], 'receiveTelemetry.tsv'))
+
+
+def test_niftiWriter():
+    """ tests ScanReceiver writing each vol to a chunked gzip file as it arrives """
+    settings = {'pynealScannerPort': port + 19,
+                'pynealHost': host,
+                'numTimepts': 3,
+                'niftiWriter': 'nii.gz',
+                'launchDashboard': False,
+                'seriesOutputDir': paths['testDataDir']}
+    scanReceiver, socket = startScanReceiver(settings)
+
+    ds = nib.load(join(paths['testDataDir'], 'testSeries.nii.gz'))
+    ds_array = ds.get_data()
+    sendTestSeries(socket, ds_array, ds.affine, protocolVersion=2)
+    assert scanReceiver.wait_for_vol(2, timeout=5)
+
+    # vols are written as they arrive, and saving only updates the header
+    savedFile = join(paths['testDataDir'], 'receivedFunc.nii.gz')
+    scanReceiver.saveResults()
+    assert scanReceiver.writtenVols == {0, 1, 2}
+    saved = nib.load(savedFile)
+    np.testing.assert_equal(np.asarray(saved.dataobj), ds_array)
+    np.testing.assert_almost_equal(saved.affine, ds.affine)
+    del saved
+    scanReceiver.killServer()
+    os.remove(savedFile)
+    os.remove(join(paths['testDataDir'], 'receiveTelemetry.tsv'))
+
+
+def test_maskedTimeseries():
+    """ tests ScanReceiver storing the voxels within the mask as vols arrive """
+    settings = {'pynealScannerPort': port + 20,
+                'pynealHost': host,
+                'numTimepts': 3,
+                'maskedTimeseries': True,
+                'maskFile': join(paths['testDataDir'], 'testSeries_mask.nii.gz'),
+                'memmapImageMatrix': True,
+                'launchDashboard': False,
+                'seriesOutputDir': paths['testDataDir']}
+    scanReceiver, socket = startScanReceiver(settings)
+    assert scanReceiver.get_maskedVol(0) is None
+
+    # memmapped image matrix is Fortran ordered; offsets follow the strides
+    ds = nib.load(join(paths['testDataDir'], 'testSeries.nii.gz'))
+    ds_array = ds.get_data()
+    mask = nib.load(settings['maskFile']).get_data() > 0
+    sendTestSeries(socket, ds_array, ds.affine, protocolVersion=2)
+    assert scanReceiver.wait_for_vol(2, timeout=5)
+
+    assert scanReceiver.maskedData.shape == (mask.sum(), 3)
+    np.testing.assert_equal(scanReceiver.get_maskedVol(1), ds_array[:, :, :, 1][mask])
+    np.testing.assert_equal(scanReceiver.get_maskedTimeseries(0, 3), ds_array[mask])
+    assert scanReceiver.get_maskedTimeseries(1, 4) is None
+
+    scanReceiver.killServer()
+    os.remove(join(paths['testDataDir'], 'receivedFunc.nii'))
+
+
+def test_sessionMode():
+    """ tests ScanReceiver receiving two series in a row """
+    settings = {'pynealScannerPort': port + 18,
+                'pynealHost': host,
+                'numTimepts': 3,
+                'sessionMode': True,
+                'launchDashboard': False,
+                'seriesOutputDir': paths['testDataDir']}
+    scanReceiver, socket = startScanReceiver(settings)
+
+    ds = nib.load(join(paths['testDataDir'], 'testSeries.nii.gz'))
+    ds_array = ds.get_data()
+    sendTestSeries(socket, ds_array, ds.affine, protocolVersion=2)
+    assert scanReceiver.wait_for_vol(2, timeout=5)
+    firstImageMatrix = scanReceiver.imageMatrix
+
+    # pyneal scanner reconnects for the next series. No reply until the
+    # current series has been wrapped up
+    socket.close(linger=0)
+    time.sleep(.5)      # PAIR sockets only take a new peer once the old one is gone
+    socket = zmq.Context.instance().socket(zmq.PAIR)
+    socket.connect('tcp://{}:{}'.format(host, settings['pynealScannerPort']))
+    socket.send_string('hello from next series')
+    assert not socket.poll(200)
+    scanReceiver.resetSeries(paths['testDataDir'])
+    assert socket.poll(5000)
+    assert socket.recv_string() == 'hello from next series'
+    assert not scanReceiver.scan_started.is_set()
+    assert scanReceiver.get_vol(0) is None
+
+    # second series reuses the image matrix. Slices that haven't arrived yet
+    # don't hold data from the first series
+    ds_array = ds_array[:, :, :, ::-1]
+    seriesHeader = {'protocolVersion': 2,
+                    'dtype': str(ds_array.dtype),
+                    'shape': ds_array.shape[:3],
+                    'affine': json.dumps(ds.affine.tolist()),
+                    'TR': str(1000)}
+    socket.send_json(seriesHeader)
+    assert socket.recv_string() == 'received seriesHeader'
+    socket.send(struct.pack(SLICE_HEADER_FORMAT, SLICE_HEADER_MAGIC, 0, 1, 0.0, 0), zmq.SNDMORE)
+    socket.send(np.ascontiguousarray(ds_array[:, :, 0, 0]))
+    assert socket.recv_string() == 'received volIdx 0 sliceIdx 0'
+    assert scanReceiver.imageMatrix is firstImageMatrix
+    partialVol = scanReceiver.get_vol(0, allowPartial=True)
+    np.testing.assert_equal(partialVol[:, :, 0], ds_array[:, :, 0, 0])
+    assert not partialVol[:, :, 1:].any()
+
+    for volIdx in range(ds_array.shape[3]):
+        socket.send(struct.pack(VOL_HEADER_FORMAT, VOL_HEADER_MAGIC, volIdx, 1, 0.0), zmq.SNDMORE)
+        socket.send(np.ascontiguousarray(ds_array[:, :, :, volIdx]))
+        assert socket.recv_string() == 'received volIdx {}'.format(volIdx)
+    assert scanReceiver.wait_for_vol(2, timeout=5)
+    assert scanReceiver.imageMatrix is firstImageMatrix
+    np.testing.assert_equal(scanReceiver.imageMatrix, ds_array)
+
+    scanReceiver.killServer()
+
+
+def test_badMessages():
+    """ tests ScanReceiver replying with an error to messages it can't handle """
+    settings = {'pynealScannerPort': port + 21,
+                'pynealHost': host,
+                'numTimepts': None,
+                'ringBufferSize': 1,
+                'launchDashboard': False,
+                'seriesOutputDir': paths['testDataDir']}
+    scanReceiver, socket = startScanReceiver(settings)
+
+    ds = nib.load(join(paths['testDataDir'], 'testSeries.nii.gz'))
+    ds_array = ds.get_data()
+
+    # vol header before the series header
+    thisVol = np.ascontiguousarray(ds_array[:, :, :, 0])
+    socket.send(struct.pack(VOL_HEADER_FORMAT, VOL_HEADER_MAGIC, 0, 1, 0.0), zmq.SNDMORE)
+    socket.send(thisVol)
+    assert socket.recv_string().startswith('error')
+
+    # delta encoding is declined, since there is only one slot
+    seriesHeader = {'protocolVersion': 2,
+                    'dtype': str(ds_array.dtype),
+                    'shape': ds_array.shape[:3],
+                    'affine': json.dumps(ds.affine.tolist()),
+                    'TR': str(1000),
+                    'compression': 'zlib-delta'}
+    socket.send_json(seriesHeader)
+    assert socket.recv_string() == 'received seriesHeader'
+
+    # unrecognized vol header, and a delta encoded vol without the previous vol
+    socket.send(struct.pack(VOL_HEADER_FORMAT, b'XXXX', 0, 1, 0.0), zmq.SNDMORE)
+    socket.send(thisVol)
+    assert socket.recv_string().startswith('error')
+    socket.send(struct.pack(VOL_HEADER_FORMAT, VOL_HEADER_MAGIC, 1, VOL_FLAG_ZLIB | VOL_FLAG_DELTA, 0.0),
+                zmq.SNDMORE)
+    socket.send(zlib.compress(thisVol))
+    assert socket.recv_string().startswith('error')
+
+    # the scan receiver is still running
+    socket.send(struct.pack(VOL_HEADER_FORMAT, VOL_HEADER_MAGIC, 2, 1, 0.0), zmq.SNDMORE)
+    socket.send(thisVol)
+    assert socket.recv_string() == 'received volIdx 2'
+    np.testing.assert_equal(scanReceiver.get_vol(2), thisVol)
+
+    scanReceiver.killServer()
+    os.remove(join(paths['testDataDir'], 'receivedFunc.nii'))
+
+
+def test_writerFailure():
+    """ tests ScanReceiver carrying on in ring buffer mode if writes fail """
+    settings = {'pynealScannerPort': port + 22,
+                'pynealHost': host,
+                'numTimepts': None,
+                'ringBufferSize': 2,
+                'launchDashboard': False,
+                'seriesOutputDir': paths['testDataDir']}
+    scanReceiver, socket = startScanReceiver(settings)
+
+    ds = nib.load(join(paths['testDataDir'], 'testSeries.nii.gz'))
+    ds_array = np.concatenate([ds.get_data()] * 2, axis=3)
+    seriesHeader = {'protocolVersion': 2,
+                    'dtype': str(ds_array.dtype),
+                    'shape': ds_array.shape[:3],
+                    'affine': json.dumps(ds.affine.tolist()),
+                    'TR': str(1000)}
+    socket.send_json(seriesHeader)
+    assert socket.recv_string() == 'received seriesHeader'
+    for volIdx in range(ds_array.shape[3]):
+        socket.send(struct.pack(VOL_HEADER_FORMAT, VOL_HEADER_MAGIC, volIdx, 1, 0.0),
+                    zmq.SNDMORE)
+        socket.send(np.ascontiguousarray(ds_array[:, :, :, volIdx]))
+        assert socket.poll(5000)
+        assert socket.recv_string() == 'received volIdx {}'.format(volIdx)
+
+        # the output file becomes unwritable after the first vol
+        if volIdx == 0:
+            scanReceiver.writerFile.close()
+
+    # every vol still arrived, but the output file is incomplete
+    assert scanReceiver.wait_for_vol(5, timeout=5)
+    np.testing.assert_equal(scanReceiver.get_vol(5), ds_array[:, :, :, 5])
+    assert scanReceiver.writerFailed
+    scanReceiver.saveResults()
+
+    scanReceiver.killServer()
+    os.remove(join(paths['testDataDir'], 'receivedFunc.nii'))
+    os.remove(join(paths['testDataDir'], 'receiveTelemetry.tsv'))
@@ -0,0 +1,143 @@
+"""
+Tool to compare the motion estimation backends on simulated head motion
+
+A series is simulated from a single volume by moving it with a random walk of
+small rigid-body motions. Motion is then estimated for every simulated volume
+with each backend ('nipy', and 'numpy'), just as Pyneal would during a scan.
+For each backend, this reports the mean time per volume, and the mean error
+of the rms_abs and rms_rel estimates, compared with the true motion.
+
+Usage:
+    python benchmarkMotion.py [-i inputFile] [-n numTimepts] [-s seed]
+
+By default, the first volume of the Pyneal test series is used.
+"""
+import os
+from os.path import join
+import sys
+import time
+import argparse
+
+import numpy as np
+import nibabel as nib
+
+# set the Pyneal root dir. Assumes this tool lives in .../pyneal/utils/
+utilsDir = os.path.abspath(os.path.dirname(__file__))
+pynealDir = os.path.dirname(utilsDir)
+sys.path.insert(0, pynealDir)
+from src.pynealPreprocessing import MotionProcessor, nostdout
+from src.rigidRegistration import rigidMatrix, trilinear
+
+
+def simulateSeries(vol, affine, numTimepts, seed=0, translationSD=.2,
+                   rotationSD=.2):
+    """ Simulate a series by moving a volume with a random walk
+
+    Parameters
+    ----------
+    vol : numpy array
+        3D volume to move
+    affine : (4,4) numpy array
+        affine of the volume
+    numTimepts : int
+        number of volumes to simulate (the first one doesn't move)
+    seed : int, optional
+        seed for the random walk
+    translationSD, rotationSD : float, optional
+        standard deviation of each step of the walk, in mm and degrees
+
+    Returns
+    -------
+    series : list of nibabel Nifti1Image
+        simulated volumes
+    transforms : list of (4,4) numpy arrays
+        true transformation from each simulated volume to the first one
+
+    """
+    rng = np.random.default_rng(seed)
+    center = affine[:3, :3].dot((np.array(vol.shape) - 1) / 2) + affine[:3, 3]
+    voxCoords = np.indices(vol.shape).reshape(3, -1)
+    worldCoords = affine[:3, :3].dot(voxCoords) + affine[:3, [3]]
+    invAffine = np.linalg.inv(affine)
+
+    params = np.zeros(6)
+    series, transforms = [], []
+    for volIdx in range(numTimepts):
+        if volIdx > 0:
+            params += np.r_[rng.normal(0, translationSD, 3),
+                            np.deg2rad(rng.normal(0, rotationSD, 3))]
+        T = rigidMatrix(params, center)
+
+        # each voxel in the simulated vol takes the value of the original vol
+        # at the transformed location
+        refCoords = T[:3, :3].dot(worldCoords) + T[:3, [3]]
+        refVox = invAffine[:3, :3].dot(refCoords) + invAffine[:3, [3]]
+        samples, valid = trilinear(vol[..., np.newaxis].astype(np.float64), refVox)
+        movedVol = np.where(valid, samples[:, 0], 0).reshape(vol.shape)
+
+        series.append(nib.Nifti1Image(movedVol, affine))
+        transforms.append(T)
+    return series, transforms
+
+
+def benchmarkBackend(backend, series, transforms):
+    """ Estimate motion for a simulated series with the given backend
+
+    Returns
+    -------
+    dict
+        mean time per volume, and mean absolute error of rms_abs and rms_rel
+
+    """
+    motionProcessor = MotionProcessor(refVolIdx=0, backend=backend)
+    times, absErrors, relErrors = [], [], []
+    for volIdx, niiVol in enumerate(series):
+        startTime = time.time()
+        with nostdout():
+            motionParams = motionProcessor.estimateMotion(niiVol, volIdx)
+        elapsed = time.time() - startTime
+        if motionParams is None:
+            continue
+
+        times.append(elapsed)
+        trueAbs = motionProcessor.computeRMS(transforms[0], transforms[volIdx])
+        trueRel = motionProcessor.computeRMS(transforms[volIdx - 1], transforms[volIdx])
+        absErrors.append(abs(motionParams['rms_abs'] - trueAbs))
+        relErrors.append(abs(motionParams['rms_rel'] - trueRel))
+
+    return {'timePerVol': np.mean(times),
+            'rmsAbsError': np.mean(absErrors),
+            'rmsRelError': np.mean(relErrors)}
+
+
+if __name__ == '__main__':
+    # parse arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--inputFile',
+                        default=join(pynealDir, 'tests/testData/testSeries.nii.gz'),
+                        type=str,
+                        help='series (or volume) to simulate motion from')
+    parser.add_argument('-n', '--numTimepts',
+                        default=20,
+                        type=int,
+                        help='number of volumes to simulate')
+    parser.add_argument('-s', '--seed',
+                        default=0,
+                        type=int,
+                        help='random seed for the simulated motion')
+    args = parser.parse_args()
+
+    img = nib.load(args.inputFile)
+    vol = np.asanyarray(img.dataobj)
+    if vol.ndim == 4:
+        vol = vol[..., 0]
+    series, transforms = simulateSeries(vol, img.affine, args.numTimepts,
+                                        seed=args.seed)
+
+    print('{:<8}{:>14}{:>16}{:>16}'.format('backend', 'time/vol (s)',
+                                          'rms_abs err (mm)', 'rms_rel err (mm)'))
+    for backend in ['nipy', 'numpy']:
+        results = benchmarkBackend(backend, series, transforms)
+        print('{:<8}{:>14.3f}{:>16.4f}{:>16.4f}'.format(
+            backend, results['timePerVol'], results['rmsAbsError'],
+            results['rmsRelError']))
@@ -0,0 +1,83 @@
+"""
+Tool to compare the weighted median of the Analyzer with the previous version
+
+The previous version sorted Python tuples of (value, weight) for every volume.
+The current version (src/weightedStats.py) uses an argsort and cumulative sum
+on NumPy arrays, with the weights normalized once. For each mask size, this
+reports the mean time per volume of both, and checks they give the same
+median.
+
+Usage:
+    python benchmarkWeightedStats.py [-n numVoxels ...] [-r repeats] [-s seed]
+
+"""
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+# set the Pyneal root dir. Assumes this tool lives in .../pyneal/utils/
+utilsDir = os.path.abspath(os.path.dirname(__file__))
+pynealDir = os.path.dirname(utilsDir)
+sys.path.insert(0, pynealDir)
+from src.weightedStats import WeightedStats
+
+
+def previousWeightedMedian(data, weights):
+    """ Weighted median, as previously computed by Analyzer.medianFromMask """
+    sorted_data, sorted_weights = map(np.array, zip(*sorted(zip(data, weights))))
+    midpoint = 0.5 * sum(sorted_weights)
+    if any(weights > midpoint):
+        return (data[weights == np.max(weights)])[0]
+    cumulative_weight = np.cumsum(sorted_weights)
+    below_midpoint_index = np.where(cumulative_weight <= midpoint)[0][-1]
+    if cumulative_weight[below_midpoint_index] == midpoint:
+        return np.mean(sorted_data[below_midpoint_index:below_midpoint_index + 2])
+    return sorted_data[below_midpoint_index + 1]
+
+
+def timePerVol(func, vols):
+    """ Return the mean time to call `func` on each vol, and the results """
+    results = []
+    startTime = time.time()
+    for vol in vols:
+        results.append(func(vol))
+    return (time.time() - startTime) / len(vols), np.array(results)
+
+
+if __name__ == '__main__':
+    # parse arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--numVoxels',
+                        default=[1000, 10000, 50000],
+                        nargs='+',
+                        type=int,
+                        help='mask sizes to test')
+    parser.add_argument('-r', '--repeats',
+                        default=10,
+                        type=int,
+                        help='number of volumes to time at each mask size')
+    parser.add_argument('-s', '--seed',
+                        default=0,
+                        type=int,
+                        help='random seed for the simulated data')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    print('{:>10}{:>16}{:>16}{:>10}'.format('voxels', 'previous (ms)',
+                                            'vectorized (ms)', 'speedup'))
+    for numVoxels in args.numVoxels:
+        weights = rng.random(numVoxels)
+        vols = rng.normal(1000, 50, size=(args.repeats, numVoxels))
+
+        previousTime, previousResults = timePerVol(
+            lambda vol: previousWeightedMedian(vol, weights), vols)
+        stats = WeightedStats(weights)
+        vectorizedTime, vectorizedResults = timePerVol(stats.median, vols)
+        assert np.allclose(previousResults, vectorizedResults)
+
+        print('{:>10}{:>16.2f}{:>16.2f}{:>9.1f}x'.format(
+            numVoxels, previousTime * 1000, vectorizedTime * 1000,
+            previousTime / vectorizedTime))
@@ -23,6 +23,11 @@ contain as many key:value pairs as needed. The entire dictionary will get
 passed along to the results server, where it will be tagged with a key
 indicating which volIdx the results pertain to.
 
+If the 'maskedTimeseries' setting is on, the voxels within the mask are
+gathered as each volume arrives. To receive them, add a `maskedVol=None`
+argument to the 'compute' method; it will be a 1D array in the same order as
+vol[mask].
+
 The CustomAnalysis template below has some specific variables pre-set that will
 ensure that the class can integrate into the rest of the Pyneal workflow.
 Please make sure to contain all of your edits within the sections labeled
@@ -1,9 +1,11 @@
 """ Simulate the output from Pyneal Scanner
 
 During a real-time scan, Pyneal Scanner will send data to pyneal over a socket
-connection. Each transmission comes in 2 phases: first a json header with
-metadata about the volume, then the volume itself. This tool will emulate that
-same behavior
+connection. Each transmission comes in 2 phases: first a header with metadata
+about the volume, then the volume itself. This tool will emulate that same
+behavior. With protocol version 1, every header is json. With protocol version
+2 (the default), the series metadata is sent once as a json series header, and
+each volume gets a compact binary header
 
 You can either supply real 4D image data (as .nii/.nii.gz), or use this tool
 to generate a fake dataset of random values.
@@ -20,6 +22,7 @@ from builtins import input
 
 import time
 import json
+import struct
 import argparse
 
 import zmq
@@ -86,7 +89,8 @@ def prepRandomDataset(dims):
     return ds
 
 
-def pynealScannerSimulator(dataset, TR=1000, host='127.0.0.1', port=5555):
+def pynealScannerSimulator(dataset, TR=1000, host='127.0.0.1', port=5555,
+                           protocolVersion=2):
     """ Pyneal Scanner Simulator
 
     Simulate Pyneal Scanner by sending the supplied dataset to Pyneal via
@@ -106,6 +110,8 @@ def pynealScannerSimulator(dataset, TR=1000, host='127.0.0.1', port=5555):
         address (default: '127.0.0.1')
     port : int
         Port number to use for sending data to Pyneal
+    protocolVersion : int, optional
+        Version of the Pyneal transfer protocol to use (default: 2)
 
     """
     print('TR: {}'.format(TR))
@@ -152,8 +158,18 @@ def pynealScannerSimulator(dataset, TR=1000, host='127.0.0.1', port=5555):
                      'affine': json.dumps(ds_affine.tolist()),
                      'TR': str(TR*1000)}
 
-        # send header as json
-        socket.send_json(volHeader, zmq.SNDMORE)
+        if protocolVersion == 1:
+            # send header as json
+            socket.send_json(volHeader, zmq.SNDMORE)
+        else:
+            # send series metadata once, then binary header for each volume
+            if volIdx == 0:
+                seriesHeader = dict(volHeader, protocolVersion=protocolVersion)
+                del seriesHeader['volIdx']
+                socket.send_json(seriesHeader)
+                socketResponse = socket.recv_string()
+            socket.send(struct.pack('<4sIId', b'PNV2', volIdx, 1, time.time()),
+                        zmq.SNDMORE)
 
         # now send the voxel array for this volume
         socket.send(thisVol, flags=0, copy=False, track=False)
@@ -197,6 +213,10 @@ if __name__ == '__main__':
     parser.add_argument('-sp', '--socketport',
                         default=5555,
                         help='Pyneal socket port')
+    parser.add_argument('-pv', '--protocolVersion',
+                        default=2,
+                        type=int,
+                        help='Pyneal transfer protocol version (1 or 2)')
     args = parser.parse_args()
 
     # Prep data, real or fake
@@ -209,4 +229,5 @@ if __name__ == '__main__':
     pynealScannerSimulator(dataset,
                            TR=args.TR,
                            host=args.sockethost,
-                           port=args.socketport)
+                           port=args.socketport,
+                           protocolVersion=args.protocolVersion)